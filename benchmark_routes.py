@@ -0,0 +1,93 @@
+import argparse
+import datetime
+import sqlite3
+
+import numpy as np
+from numpy.random import default_rng
+from osgeo import gdal, ogr
+
+from python.factors import EnvFactors
+from python.spatial_context import SpatialContext
+import python.routing as mar
+
+import config
+
+
+def rasterize_route(spatial_context, points):
+    """ Returns footprint of the cells burned by GDAL with ALL_TOUCHED of a WGS84 route, in a raster snapped to the base grid """
+    geometry = ogr.Geometry(ogr.wkbLineString)
+    for x, y, *_ in spatial_context.transformation.TransformPoints(np.asarray(points, dtype=np.float64)[:, 0:2]):
+        geometry.AddPoint_2D(x, y)
+
+    source = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = source.CreateLayer("route", spatial_context.proj, geom_type=ogr.wkbLineString)
+
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+
+    min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+    env_min_x, env_max_x, env_min_y, env_max_y, nr_rows, nr_cols = spatial_context._snap(min_x, max_x, min_y, max_y)
+
+    raster = gdal.GetDriverByName("MEM").Create("", nr_cols, nr_rows, 1, gdal.GDT_Byte)
+    raster.SetGeoTransform((env_min_x, spatial_context.cellsize, 0, env_max_y, 0, -spatial_context.cellsize))
+    raster.SetProjection(spatial_context.proj.ExportToWkt())
+
+    gdal.RasterizeLayer(raster, [1], layer, burn_values=[1], options=["ALL_TOUCHED=TRUE"])
+
+    return spatial_context._dataset_footprint(raster)
+
+
+def benchmark(nr_routes, seed):
+    """ Compares GDAL RasterizeLayer and NumPy rasterisation of OSRM routes """
+    rng = default_rng(seed)
+
+    exposure = EnvFactors(config.pollutant_db, "concentration", "area", config.workday)
+    routing_engine = mar.Routing(config.osrm_car, config.osrm_bike, config.osrm_foot, config.osrm_train)
+    spatial_context = SpatialContext(routing_engine, exposure.extent(), config.epsg)
+
+    connection = sqlite3.connect(config.building_db)
+    homes = np.array(connection.execute(f"SELECT wgs_x,wgs_y FROM {config.query_home_table}").fetchall())
+    works = np.array(connection.execute(f"SELECT wgs_x,wgs_y FROM {config.query_work_table}").fetchall())
+    connection.close()
+
+    home_idx = rng.choice(len(homes), nr_routes)
+    work_idx = rng.choice(len(works), nr_routes)
+
+    time_gdal = datetime.timedelta(0)
+    time_numpy = datetime.timedelta(0)
+    nr_cells = 0
+    nr_different = 0
+
+    for home, work in zip(homes[home_idx], works[work_idx]):
+        points = routing_engine.route(home[0], home[1], work[0], work[1], mar.Car)
+
+        start = datetime.datetime.now()
+        footprint_gdal = rasterize_route(spatial_context, points)
+        time_gdal += datetime.datetime.now() - start
+
+        start = datetime.datetime.now()
+        footprint_numpy = spatial_context._route_footprint(points)
+        time_numpy += datetime.datetime.now() - start
+
+        nr_cells += len(footprint_gdal)
+        if not np.array_equal(np.sort(footprint_gdal.indices), footprint_numpy.indices):
+            nr_different += 1
+
+    print(f"routes:           {nr_routes}")
+    print(f"cells per route:  {nr_cells / nr_routes:.1f}")
+    print(f"GDAL rasterise:   {time_gdal} ({time_gdal / nr_routes} per route)")
+    print(f"NumPy rasterise:  {time_numpy} ({time_numpy / nr_routes} per route)")
+    print(f"speedup:          {time_gdal / time_numpy:.1f}")
+    print(f"different routes: {nr_different}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("routes", type=int)
+    parser.add_argument("--seed", type=int, default=None)
+
+    args = parser.parse_args()
+
+    benchmark(args.routes, args.seed)
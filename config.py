@@ -15,6 +15,16 @@ osrm_car = str(pathlib.Path(input_dir, "osm", "nl_car.osrm"))
 osrm_bike = str(pathlib.Path(input_dir, "osm", "nl_bicycle.osrm"))
 osrm_foot = str(pathlib.Path(input_dir, "osm", "nl_foot.osrm"))
 osrm_train = str(pathlib.Path(input_dir, "osm", "nl_train.osrm"))
+# "engine": OSRM datasets above in process, "http": osrm-routed servers of osrm_urls, "stub": straight lines for tests
+routing_backend = "engine"
+# threads routing a batch of routes at once, the engine backend runs at most routing_engines of them,
+# one per loaded engine: more engines route concurrently at the memory cost of their datasets below,
+# the http backend runs all threads and keeps the datasets in the servers
+routing_threads = 4
+# OSRM engines per process of the engine backend, each one loads the datasets of all travel modes,
+# several GB for the Netherlands, and every worker process has its own engines
+routing_engines = 1
+osrm_urls = {"car": "http://localhost:5000", "bike": "http://localhost:5001", "foot": "http://localhost:5002", "train": "http://localhost:5003"}
 
 building_db = str(pathlib.Path(input_dir, "utrecht_province.sqlite3"))
 pollutant_db = str(pathlib.Path(input_dir, "nl_ap_noise.lue"))
@@ -24,6 +34,32 @@ weekend = ["NO2_hour_weekend", "PM25_hour_weekend", "noise"]
 
 epsg = 28992
 inmem_schedules = True
+# Keep the in-memory schedule database open from generation to aggregation,
+# the result is written compacted once at the end (requires inmem_schedules)
+inmem_pipeline = True
+# Run generation to aggregation per chunk of this many agents, appending to the output, None for all agents at once
+stream_agents = None
+
+# Enrich all activities of an exposure timestep at once instead of row by row
+batch_enrichment = True
+# Route cache shared between runs, set to None for an in-memory cache only
+route_cache = str(pathlib.Path(output_dir, "route_cache.sqlite3"))
+# Share the pollutant arrays between worker processes instead of loading them per worker.
+# Without it, each of the --workers processes loads the dataset in addition to the main process
+shared_exposure = True
+# Use focal rasters for buffer activities, cached next to the pollutant dataset
+focal_buffers = False
+# Memory-map the preprocessed pollutant arrays (python -m python.cube_cache) when present
+cube_cache = True
+# Adaptive number of realisations (main.py --adaptive), stops when the relative Monte Carlo standard
+# error of the daily exposure is below the tolerance for all exposure variables.
+# "agent": quantile of the errors of the agents' mean exposure, "percentile": error of the quantile over agents
+convergence_tolerance = 0.01
+convergence_statistic = "agent"
+convergence_quantile = 0.95
+convergence_min_realisations = 3
+# Store schedule times as INTEGER minutes since the start of the day instead of ISO strings
+integer_times = False
 
 query_work_table = "work"
 query_work_select = "idx AS agent_id,postcode2 as postcode,rd_x AS work_x,rd_y as work_y,wgs_x,wgs_y"
@@ -34,3 +70,19 @@ query_home_select = "idx AS agent_id,postcode2 AS postcode,rd_x AS home_x,rd_y A
 query_home_where = ""
 # Comment or modify if you want to run more agents
 query_home_where = "idx<1000"
+
+# Profiles following a fixed sequence of activities at the home location.
+# activity: point or buffer, description: ActivityDescription name, buffer_method: BufferCalculation name
+# buffer_size "arg" takes the --arg command line value
+# duration in t_delta units: ("fixed", n), ("uniform", low, high) with high exclusive, or ("final",) until the end of the day
+# homemakers do the same on workdays and in weekends, only the exposure variables differ
+homemaker_buffer_activities = [
+    {"activity": "buffer", "description": "home", "buffer_size": 50, "duration": ("uniform", 8 * 60, 21 * 60)},
+    {"activity": "buffer", "description": "leisure", "buffer_size": "arg", "duration": ("fixed", 120)},
+    {"activity": "buffer", "description": "home", "buffer_size": 50, "duration": ("final",)},
+]
+
+templates = {
+    "homemaker_buffer_workday": {"exposure": workday, "activities": homemaker_buffer_activities},
+    "homemaker_buffer_weekend": {"exposure": weekend, "activities": homemaker_buffer_activities},
+}
@@ -1,35 +1,73 @@
 import argparse
 import datetime
+import pathlib
 
 from numpy.random import default_rng
 
+from python.convergence import Convergence
+
 import config
 
 
-def do_profile(realisation, od_matrix=None):
+def do_profile(realisation, od_matrix=None, workers=1):
 
     run_start = datetime.datetime.now()
     seed = None
     rng = default_rng(seed)
 
-    profile = Profile(rng, realisation, od_matrix)
+    profile = Profile(rng, realisation, od_matrix, workers)
+
+    profile.log(f"Starting realisation {realisation} with seed {seed} using {workers} workers")
 
-    profile.log(f"Starting realisation {realisation} with seed {seed}")
+    # the schedules cover the first whole day of the pollutant dataset, and are split at its timesteps
+    exposure = profile.exposure_calculator(config.pollutant_db, profile.exposure_variables(), config.epsg)
 
-    t_start = datetime.datetime(2020, 7, 1, hour=0, minute=0)
-    t_end = datetime.datetime(2020, 7, 2, hour=0, minute=0)
+    t_start = exposure.time_axis.timesteps[0].ceil("D").to_pydatetime()
+    t_end = t_start + datetime.timedelta(days=1)
     t_delta = datetime.timedelta(days=0, seconds=0, microseconds=0, milliseconds=0, minutes=1, hours=0, weeks=0)
 
-    profile.init_time(t_start, t_end, t_delta, None)
+    profile.init_time(t_start, t_end, t_delta, exposure.time_axis)
 
-    profile.generate_schedules()
-    profile.enrich_schedules(config.pollutant_db, profile.exposure_variables(), config.epsg)
-    profile.aggregate(profile.exposure_variables())
+    if config.stream_agents:
+        profile.stream(config.pollutant_db, profile.exposure_variables(), config.epsg, config.stream_agents)
+    else:
+        profile.generate_schedules()
+        profile.enrich_schedules(config.pollutant_db, profile.exposure_variables(), config.epsg)
+        profile.aggregate(profile.exposure_variables())
 
     run_end = datetime.datetime.now()
     run_diff = run_end - run_start
     profile.log(f"Successful run {realisation} took {run_diff}; {profile.nr_home_locations} agents; {run_diff / profile.nr_home_locations} per agent")
 
+    return profile
+
+
+def do_adaptive(first, max_realisations, od_matrix=None, workers=1):
+    """ Runs realisations until the exposure converged, at most max_realisations """
+    convergence = Convergence(config.convergence_tolerance, config.convergence_statistic, config.convergence_quantile, config.convergence_min_realisations)
+
+    for realisation in range(first, max_realisations + 1):
+        profile = do_profile(realisation, od_matrix, workers)
+        name = profile.name_r[:profile.name_r.rindex("_")]
+
+        if realisation == first:
+            # reuse realisations of an earlier run
+            for earlier in range(1, first):
+                path = pathlib.Path(config.output_dir, f"{name}_{earlier}.sqlite3")
+                if path.exists():
+                    convergence.add(path, earlier)
+
+        convergence.add(pathlib.Path(config.output_dir, f"{profile.name_r}.sqlite3"), realisation)
+
+        errors = ", ".join(f"{variable} {error:.4f}" for variable, error in convergence.errors().items())
+        profile.log(f"Realisation {realisation}: {convergence.nr_realisations} realisations, relative standard error {errors}")
+
+        convergence.write_trace(pathlib.Path(config.output_dir, f"{name}_convergence.csv"))
+
+        if convergence.converged():
+            profile.log(f"Converged after {convergence.nr_realisations} realisations")
+            break
+
 
 if __name__ == '__main__':
 
@@ -39,6 +77,7 @@ if __name__ == '__main__':
     parser.add_argument("--workers", type=int, default=8)
     parser.add_argument("--min", type=int, default=1)
     parser.add_argument("--arg", type=int)
+    parser.add_argument("--adaptive", action="store_true", help="run realisations --min to realisations until converged")
 
     args = parser.parse_args()
 
@@ -50,7 +89,13 @@ if __name__ == '__main__':
         from profiles import HomemakerBufferWeekend as Profile
     elif args.profile == "commuter_workday":
         from profiles import CommuteWorkday as Profile
+    elif args.profile in config.templates:
+        from profiles import TemplateProfile
+        Profile = type(args.profile, (TemplateProfile,), {"template": args.profile})
     else:
         raise NotImplementedError(args.profile)
 
-    do_profile(args.realisations, args.arg)
+    if args.adaptive:
+        do_adaptive(args.min, args.realisations, args.arg, args.workers)
+    else:
+        do_profile(args.realisations, args.arg, args.workers)
@@ -1,6 +1,6 @@
 import argparse
 
-from python.weekly_exposure import Weekly
+from python.weekly_exposure import weekly_exposures
 from python.csv_export import to_csv
 import config
 
@@ -12,8 +12,12 @@ if __name__ == '__main__':
 
     realisations = args.realisations
 
-    Weekly(config.output_dir, "weekly_homemaker", realisations, [[5, f"homemaker_buffer_workday_OD10000", True], [2, f"homemaker_buffer_weekend_OD10000", True]], config.output_dir)
-    Weekly(config.output_dir, "weekly_commuter", realisations, [[5, f"commute_workday_OD01", True], [2, f"homemaker_buffer_weekend_OD10000", True]], config.output_dir)
+    targets = [
+        ("weekly_homemaker", [[5, f"homemaker_buffer_workday_OD10000", True], [2, f"homemaker_buffer_weekend_OD10000", True]]),
+        ("weekly_commuter", [[5, f"commute_workday_OD01", True], [2, f"homemaker_buffer_weekend_OD10000", True]]),
+    ]
+
+    weekly_exposures(config.output_dir, targets, realisations, config.output_dir)
 
     to_csv("no2", config.output_dir, ["weekly_homemaker", "weekly_commuter"])
     to_csv("pm25", config.output_dir, ["weekly_homemaker", "weekly_commuter"])
@@ -1,3 +1,4 @@
+from .template import *
 from .homemaker_workday import *
 from .homemaker_weekend import *
 from .commute import *
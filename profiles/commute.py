@@ -2,11 +2,11 @@ import sys
 import pickle
 import numpy as np
 
-from osgeo import ogr, gdal
+from osgeo import gdal
 
 import python.actgen as ag
-import python.routing as mar
-from python import ODMatrixSelect
+from python import ODMatrixSelect, WorkLocations
+from python.ws_work_locations import distance
 
 from python.profiles import Profile
 
@@ -14,6 +14,7 @@ import datetime
 import configparser
 
 import config
+from python.actgen.config import ActivityType
 from python.actgen.config import ActivityDescription as ad
 from python.actgen.config import BufferCalculation as bd
 from python.actgen.config import CommuteType as ct
@@ -22,19 +23,26 @@ gdal.UseExceptions()
 
 
 class CommuteWorkday(Profile):
-    def __init__(self, rng, realisation, od_matrix=None):
-        Profile.__init__(self, rng, realisation, od_matrix)
+    def __init__(self, rng, realisation, od_matrix=None, workers=1):
+        Profile.__init__(self, rng, realisation, od_matrix, workers)
 
         self._rng = rng
         self.od_matrix = ODMatrixSelect(rng)
 
         self.init("commute_workday")
 
-        self.r = mar.Routing(config.osrm_car, config.osrm_bike, config.osrm_foot, config.osrm_train)
+        self.work_locations = WorkLocations(self.building_connection)
+        self.logger.info(f"work locations: {len(self.work_locations)} in {len(self.work_locations.postcodes)} postcodes")
+
+        self.r = self.routing_engine
 
         self.max_eucl = 180000
         self.min_eucl = 25
 
+        # in minutes
+        self.min_commute_time = 5
+        self.max_commute_time = 150
+
         self.od_matrix_id = od_matrix
 
     def exposure_variables(self):
@@ -45,162 +53,134 @@ class CommuteWorkday(Profile):
         self.od_matrix.init(filename)
 
     def distance(self, x1, y1, x2, y2):
+        return distance(x1, y1, x2, y2)
 
-        wkt = f"POINT ({x1} {y1})"
-        point1 = ogr.CreateGeometryFromWkt(wkt)
+    def commute_modes(self, distance):
+        """ Returns random CommuteType value of each distance """
+        assert (distance >= 0).all()
 
-        wkt = f"POINT ({x2} {y2})"
-        point2 = ogr.CreateGeometryFromWkt(wkt)
+        dist1 = 1000
+        dist2 = 10000
 
-        dis = point1.Distance(point2)
+        # two equally likely modes per distance class
+        modes = np.array([[ct.foot.value, ct.bike.value], [ct.bike.value, ct.car.value], [ct.car.value, ct.train.value]])
+        distance_class = np.searchsorted([dist1, dist2], distance, side="right")
 
-        return dis
+        return modes[distance_class, (self.rng.random(len(distance)) >= 0.5).astype(np.int64)]
 
-    def pot_work_location(self, area_id):
-        query = f"SELECT idx,postcode,rd_x,rd_y,wgs_x,wgs_y FROM work WHERE postcode2={area_id}"
-        sql = self.building_connection.execute(query)
-        res = sql.fetchall()
-        nr_pot_work_locations = len(res)
+    def construct(self):
+        self.logger.info("")
+        self.logger.info(f"OD1 generate_schedules")
+        self.logger.info(f"OD1 generate_schedules commute min/max: {self.min_commute_time} {self.max_commute_time}")
 
-        pot_work_idx = self._rng.choice(nr_pot_work_locations, 1)[0]
-        row = res[pot_work_idx]
+        Profile.construct(self)
 
-        pot_work_x = round(row["rd_x"], 6)
-        pot_work_y = round(row["rd_y"], 6)
-        pot_work_ll_x = round(row["wgs_x"], 6)
-        pot_work_ll_y = round(row["wgs_y"], 6)
+    def draw_work_locations(self, home_municipality, home_x, home_y, home_ll_x, home_ll_y):
+        """ Returns work location, commute mode, distance and duration of all agents, and whether an agent has a work location
 
-        return pot_work_x, pot_work_y, pot_work_ll_x, pot_work_ll_y
+        Each round draws a destination municipality, a work location and a commute mode for the agents without an
+        accepted work location, and routes their candidates at once. After redraw_max rounds the home municipality is used,
+        agents without work locations in the distance band there are left out
+        """
+        nr_agents = len(home_municipality)
+        redraw_max = 20
 
-    def commute_mode_probs(self, distance):
-        assert distance >= 0
+        work = np.zeros((4, nr_agents))
+        mode = np.zeros(nr_agents, dtype=np.int64)
+        distance = np.zeros(nr_agents)
+        duration = np.zeros(nr_agents)
+        found = np.ones(nr_agents, dtype=bool)
 
-        probs = None
+        # whether a postcode has work locations in the distance band, by (agent, postcode) drawn before
+        in_band = {}
 
-        dist1 = 1000
-        dist2 = 10000
+        redraw = np.zeros(nr_agents, dtype=np.int64)
+        pending = np.arange(nr_agents)
 
-        if distance < dist1:
-            probs = [0.5, 0.5, 0, 0]
-        if distance >= dist1 and distance < dist2:
-            probs = [0, 0.5, 0.5, 0]
-        if distance >= dist2:
-            probs = [0, 0, 0.5, 0.5]
+        while len(pending) > 0:
+            municipality = home_municipality[pending]
+            destination = self.od_matrix.obtain_many(municipality)
 
-        assert sum(probs) == 1.0
+            no_od = destination < 0
+            exceeds = redraw[pending] > redraw_max
+            destination = np.where(no_od | exceeds, municipality, destination)
 
-        osrm = [mar.Foot, mar.Bike, mar.Car, mar.Train]
-        act = [ct.foot, ct.bike, ct.car, ct.train]
-        x = np.arange(4)
-        mode_idx = self.rng.choice(x, size=1, p=probs)[0]
+            if no_od.any():
+                self.logger.info(f"   used home municipality due to no OD for {no_od.sum()} agents ({np.unique(municipality[no_od])[:10]})")
+            if exceeds.any():
+                self.logger.info(f"   used home municipality due to exceedance for {exceeds.sum()} agents ({np.unique(municipality[exceeds])[:10]})")
 
-        return osrm[mode_idx], act[mode_idx]
+            if not (destination > 0).all():
+                raise NotImplementedError
 
-    def construct(self):
-        self.logger.info("")
-        self.logger.info(f"OD1 generate_schedules")
-        output_dir = f"{self.name_r}"
+            # without locations in the distance band a draw is always rejected, those agents redraw right away
+            keys = list(zip(pending.tolist(), destination.tolist()))
+            new = np.array([key for key in dict.fromkeys(keys) if key not in in_band], dtype=np.int64).reshape(-1, 2)
+            counts = self.work_locations.in_band(new[:, 1], home_x[new[:, 0]], home_y[new[:, 0]], self.min_eucl, self.max_eucl)
+            in_band.update(zip(map(tuple, new.tolist()), (counts > 0).tolist()))
+            possible = np.array([in_band[key] for key in keys], dtype=bool)
 
-        schedules = ag.Schedules(output_dir, self.t_start, self.t_end, self.t_delta, self.exposure_variables())
+            # the home municipality is used when all else fails, redrawing there would never end
+            skipped = (no_od | exceeds) & ~possible
+            if skipped.any():
+                self.logger.warning(f"   left out {skipped.sum()} agents without work locations in the distance band in home municipalities {np.unique(municipality[skipped])[:10]}")
+                found[pending[skipped]] = False
 
-        # in minutes
-        min_commute_time = 5
-        max_commute_time = 150
-
-        self.logger.info(f"OD1 generate_schedules commute min/max: {min_commute_time} {max_commute_time}")
-
-        count_agents = 0
-        count_exceed = 0
-        count_home_mun = 0
-        count_limited_work_loc = 0
-
-        cnt = 1
-        for row in self.building_connection.execute(self.home_query):
-            agent_id = int(row["agent_id"])
-            home_x = row["home_x"]
-            home_y = row["home_y"]
-            home_ll_x = row["wgs_x"]
-            home_ll_y = row["wgs_y"]
-
-            work_x = None
-            work_y = None
-            work_ll_x = None
-            work_ll_y = None
-
-            duration_car = None
-            duration_bike = None
-            duration_train = None
-            duration_foot = None
-
-            home_municipality = int(row["postcode"])
-
-            if cnt % 250 == 0:
-                self.logger.info(f"OD1 generate_schedules {cnt}")
-
-            suitable_workloc = False
-
-            redraw = 0
-            redraw_max = 20
-            exceeds_redraw = False
-
-            while not suitable_workloc:
-                distance = None
-                duration = None
-                dest_work_municipality = None
-
-                dest_work_municipality = self.od_matrix.obtain(home_municipality)
-                if dest_work_municipality < 0:
-                    dest_work_municipality = home_municipality
-                    self.logger.info(f"   used home municipality due to no OD ({home_municipality})")
-
-                if redraw > redraw_max:
-                    dest_work_municipality = home_municipality
-                    self.logger.info(f"   used home municipality due to exceedance ({home_municipality})")
-
-                if dest_work_municipality > 0:
-                    work_x, work_y, work_ll_x, work_ll_y = self.pot_work_location(dest_work_municipality)
-
-                    work_distance = self.distance(home_x, home_y, work_x, work_y)
-                    if work_distance > self.min_eucl and work_distance < self.max_eucl:
-                        # get commute mode based on distance
-                        osrm_mode, act_mode = self.commute_mode_probs(work_distance)
-                        distance, duration = self.r.distance(home_ll_x, home_ll_y, work_ll_x, work_ll_y, osrm_mode)
-                        if duration > 0 and duration < max_commute_time:
-                            suitable_workloc = True
-                            assert duration > 0, f"{home_ll_x}, {home_ll_y}, {work_ll_x}, {work_ll_y}, {osrm_mode}, {distance}, {duration}"
-                            assert distance > 0, f"{home_ll_x}, {home_ll_y}, {work_ll_x}, {work_ll_y}, {osrm_mode}, {distance}, {duration}"
-                else:
-                    raise NotImplementedError
-
-                redraw += 1
-
-            assert distance > 0
-            assert duration > 0
-            cnt += 1
-
-            end_min = 6 * 60 + 30
-            end_max = 7 * 60 + 30
-            x = np.arange(end_min, end_max)
-            act_end = self.rng.choice(x, size=1)[0] * self.t_delta
-
-            home_1 = ag.Buffer_Fixed(ad.home, home_x, home_y, act_end, 50)
-
-            route_1 = ag.Commute(ad.commute_home_to_work, home_ll_x, home_ll_y, work_ll_x, work_ll_y, act_mode, duration)
-
-            delta = 8 * 60 * self.t_delta
-            work = ag.Buffer_Fixed(ad.work, work_x, work_y, delta, 50)
-
-            route_2 = ag.Commute(ad.commute_work_to_home, work_ll_x, work_ll_y, home_ll_x, home_ll_y, act_mode, duration)
-
-            home_2 = ag.Buffer_Final(ad.home, home_x, home_y, act_end, 50)
-
-            schedule = ag.Schedule(self.t_start, self.t_end, self.t_delta, agent_id)
-            schedule.add_activity(home_1)
-            schedule.add_activity(route_1)
-            schedule.add_activity(work)
-            schedule.add_activity(route_2)
-            schedule.add_activity(home_2)
-            schedule.generate()
-            schedules.add(schedule)
-
-        schedules.commit()
+            drawn = pending[possible]
+            candidate = np.array(self.work_locations.draw_many(destination[possible], self._rng)).reshape(4, -1)
+
+            work_distance = self.distance(home_x[drawn], home_y[drawn], candidate[0], candidate[1])
+            band = (work_distance > self.min_eucl) & (work_distance < self.max_eucl)
+
+            # route the candidates in the distance band, the others are redrawn
+            routed = drawn[band]
+            candidate = candidate[:, band]
+            candidate_mode = self.commute_modes(work_distance[band])
+            candidate_distance, candidate_duration = self.route_cache.distances(self.r, home_ll_x[routed], home_ll_y[routed], candidate[2], candidate[3], candidate_mode)
+
+            accepted = (candidate_duration > 0) & (candidate_duration < self.max_commute_time)
+            agents = routed[accepted]
+
+            work[:, agents] = candidate[:, accepted]
+            mode[agents] = candidate_mode[accepted]
+            distance[agents] = candidate_distance[accepted]
+            duration[agents] = candidate_duration[accepted]
+
+            redraw[pending] += 1
+            pending = np.setdiff1d(pending, np.concatenate((agents, pending[skipped])), assume_unique=True)
+
+            self.logger.info(f"OD1 generate_schedules {nr_agents - len(pending)}/{nr_agents} agents with work location or left out")
+
+        assert (distance[found] > 0).all()
+        assert (duration[found] > 0).all()
+
+        return work, mode, distance, duration, found
+
+    def construct_agents(self, schedules, homes):
+        agent_ids = np.array([int(row["agent_id"]) for row in homes], dtype=np.int64)
+        home_x, home_y, home_ll_x, home_ll_y = (np.array([row[name] for row in homes], dtype=np.float64) for name in ("home_x", "home_y", "wgs_x", "wgs_y"))
+        home_municipality = np.array([int(row["postcode"]) for row in homes], dtype=np.int64)
+
+        work, mode, distance, duration, found = self.draw_work_locations(home_municipality, home_x, home_y, home_ll_x, home_ll_y)
+
+        agent_ids, home_x, home_y, home_ll_x, home_ll_y = (values[found] for values in (agent_ids, home_x, home_y, home_ll_x, home_ll_y))
+        (work_x, work_y, work_ll_x, work_ll_y), mode, duration = work[:, found], mode[found], duration[found]
+
+        end_min = 6 * 60 + 30
+        end_max = 7 * 60 + 30
+        x = np.arange(end_min, end_max)
+        act_end = self.rng.choice(x, size=len(agent_ids))
+
+        home = {"group": ActivityType.buffer.value, "description": ad.home.value, "xcoord": home_x, "ycoord": home_y, "buffer_size": 50, "buffer_method": bd.mean.value}
+        work = {"group": ActivityType.buffer.value, "description": ad.work.value, "xcoord": work_x, "ycoord": work_y, "buffer_size": 50, "buffer_method": bd.mean.value}
+        route = {"group": ActivityType.route.value, "travel_mode": mode, "duration": duration}
+
+        slots = [
+            dict(home, duration=act_end),
+            dict(route, description=ad.commute_home_to_work.value, xcoord=home_ll_x, ycoord=home_ll_y, xcoord2=work_ll_x, ycoord2=work_ll_y),
+            dict(work, duration=8 * 60),
+            dict(route, description=ad.commute_work_to_home.value, xcoord=work_ll_x, ycoord=work_ll_y, xcoord2=home_ll_x, ycoord2=home_ll_y),
+            dict(home, duration=None),
+        ]
+
+        schedules.add_batch(ag.ScheduleBatch.from_slots(agent_ids, self.t_start, self.t_end, self.t_delta, slots))
@@ -0,0 +1,27 @@
+import numpy as np
+
+from python.profiles import Profile
+
+import python.actgen as ag
+
+import config
+
+
+class TemplateProfile(Profile):
+    template = None
+
+    def __init__(self, rng, realisation, od_matrix=None, workers=1):
+        Profile.__init__(self, rng, realisation, od_matrix, workers)
+
+        self.init(self.template)
+
+    def exposure_variables(self):
+        return config.templates[self.template]["exposure"]
+
+    def construct_agents(self, schedules, homes):
+        agents = {name: np.array([row[name] for row in homes]) for name in ("agent_id", "home_x", "home_y")}
+
+        batch = ag.compile_template(config.templates[self.template]["activities"], agents, self.t_start, self.t_end, self.t_delta, self.rng, self.od_matrixid)
+        self.logger.info(f"{self.template} {len(homes)} agents, {len(batch)} activities")
+
+        schedules.add_batch(batch)
@@ -1 +1,2 @@
 from .ws_od_matrix import ODMatrixSelect
+from .ws_work_locations import WorkLocations
@@ -1,3 +1,6 @@
 from .act import *
 from .timer import *
 from .schedules import *
+from .batch import *
+from .template import *
+from .time_axis import *
@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+
+from .config import ActivityType, CommuteType, BufferCalculation
+from .time_axis import to_ticks
+
+
+def to_sql(values, kind=float):
+    """ Returns list of column values converted to kind, NaN and None as NULL """
+    values = np.asarray(values)
+    missing = pd.isna(values)
+
+    res = np.empty(len(values), dtype=object)
+    res[~missing] = values[~missing].astype(kind)
+
+    return res.tolist()
+
+
+class ScheduleBatch(object):
+    columns = ("agent_id", "act_idx", "start", "end", "group", "description",
+               "xcoord", "ycoord", "xcoord2", "ycoord2", "buffer_size", "buffer_method", "travel_mode")
+
+    def __init__(self, agent_id, act_idx, start, end, group, description, xcoord, ycoord,
+                 xcoord2=None, ycoord2=None, buffer_size=None, buffer_method=None, travel_mode=None):
+        """ Activities of many agents as columns, one row per activity in schedule order
+
+        start and end are int64 ticks, group, description, buffer_method and travel_mode enum values.
+        Point and buffer activities are located at xcoord, ycoord, routes run from there to xcoord2, ycoord2
+        """
+        self.agent_id = np.asarray(agent_id, dtype=np.int64)
+        size = len(self.agent_id)
+
+        def column(values, dtype, default):
+            if values is None:
+                return np.full(size, default, dtype=dtype)
+            return np.broadcast_to(np.asarray(values, dtype=dtype), (size,)).copy()
+
+        self.act_idx = column(act_idx, np.int64, 0)
+        self.start = column(start, np.int64, 0)
+        self.end = column(end, np.int64, 0)
+        self.group = column(group, np.int64, 0)
+        self.description = column(description, np.int64, 0)
+        self.xcoord = column(xcoord, np.float64, np.nan)
+        self.ycoord = column(ycoord, np.float64, np.nan)
+        self.xcoord2 = column(xcoord2, np.float64, np.nan)
+        self.ycoord2 = column(ycoord2, np.float64, np.nan)
+        self.buffer_size = column(buffer_size, np.float64, np.nan)
+        self.buffer_method = column(buffer_method, np.int64, BufferCalculation.unknown.value)
+        self.travel_mode = column(travel_mode, np.int64, CommuteType.unknown.value)
+
+    def __len__(self):
+        return len(self.agent_id)
+
+    @classmethod
+    def concatenate(cls, batches):
+        """ Returns one batch of the rows of all batches """
+        return cls(**{name: np.concatenate([getattr(batch, name) for batch in batches]) for name in cls.columns})
+
+    @classmethod
+    def from_slots(cls, agent_ids, t_start, t_end, t_delta, slots):
+        """ Returns schedules of agents doing the same sequence of activities
+
+        Each slot is a dict of ScheduleBatch columns, given per agent or as scalar, with a
+        duration in t_delta units. The duration of the last slot is None, it lasts until t_end
+        """
+        agent_ids = np.asarray(agent_ids, dtype=np.int64)
+        nr_agents = len(agent_ids)
+        nr_slots = len(slots)
+
+        assert nr_slots > 0
+        assert all(slot["duration"] is not None for slot in slots[:-1])
+        assert slots[-1]["duration"] is None
+
+        start, end = to_ticks([t_start, t_end])
+        delta = int(t_delta.total_seconds() * 10 ** 6)
+
+        # (slot, agent) arrays, activities of an agent are contiguous after transposing
+        durations = np.zeros((nr_slots, nr_agents), dtype=np.int64)
+        for idx, slot in enumerate(slots[:-1]):
+            durations[idx] = np.rint(np.broadcast_to(np.asarray(slot["duration"], dtype=np.float64), (nr_agents,)) * delta)
+
+        ends = start + np.cumsum(durations, axis=0)
+        ends[-1] = end
+        starts = np.vstack((np.full(nr_agents, start), ends[:-1]))
+
+        assert (starts <= ends).all(), "activities exceed the schedule period"
+
+        def stack(name, default):
+            return np.vstack([np.broadcast_to(np.asarray(slot.get(name, default)), (nr_agents,)) for slot in slots]).T.reshape(-1)
+
+        return cls(np.repeat(agent_ids, nr_slots),
+                   np.tile(np.arange(nr_slots), nr_agents),
+                   starts.T.reshape(-1),
+                   ends.T.reshape(-1),
+                   stack("group", 0),
+                   stack("description", 0),
+                   stack("xcoord", np.nan),
+                   stack("ycoord", np.nan),
+                   stack("xcoord2", np.nan),
+                   stack("ycoord2", np.nan),
+                   stack("buffer_size", np.nan),
+                   stack("buffer_method", BufferCalculation.unknown.value),
+                   stack("travel_mode", CommuteType.unknown.value))
+
+    @classmethod
+    def from_schedules(cls, schedules):
+        """ Returns batch of generated Schedule objects """
+        values = {name: [] for name in cls.columns}
+
+        for schedule in schedules:
+            for activity in schedule._activities:
+                act_type = activity._activity_type
+
+                values["agent_id"].append(schedule.agent_id)
+                values["act_idx"].append(activity._position)
+                values["start"].append(activity._activity_start)
+                values["end"].append(activity._activity_end)
+                values["group"].append(act_type.value)
+
+                if act_type == ActivityType.point:
+                    row = (activity.description.value, activity.xcoord, activity.ycoord, np.nan, np.nan, np.nan, BufferCalculation.unknown.value, CommuteType.unknown.value)
+                elif act_type == ActivityType.buffer:
+                    row = (activity.description.value, activity.xcoord, activity.ycoord, np.nan, np.nan, activity.buffersize, activity.buffer_method.value, CommuteType.unknown.value)
+                elif act_type == ActivityType.route:
+                    row = (activity._activity_description.value, activity.start_x, activity.start_y, activity.dest_x, activity.dest_y, np.nan, BufferCalculation.unknown.value, activity.travel_mode.value)
+                else:
+                    raise NotImplementedError
+
+                for name, value in zip(cls.columns[5:], row):
+                    values[name].append(value)
+
+        values["start"] = to_ticks(values["start"]) if values["start"] else []
+        values["end"] = to_ticks(values["end"]) if values["end"] else []
+
+        return cls(**values)
@@ -1,10 +1,12 @@
-import datetime
 import pathlib
 import sqlite3
 
+import numpy as np
 import pandas as pd
 
 from .config import ActivityType
+from .time_axis import TimeAxis, ScheduleTimes, to_ticks
+from .batch import ScheduleBatch, to_sql
 
 import config
 
@@ -14,7 +16,7 @@ def progress(status, remaining, total):
 
 
 class Schedules(object):
-    def __init__(self, output_dir, t_start, t_end, t_delta, props):
+    def __init__(self, output_dir, t_start, t_end, t_delta, props, time_axis=None):
         self.output_dir = output_dir
 
         self.all_schedules = []
@@ -23,6 +25,10 @@ class Schedules(object):
         self.total_end = t_end
         self.delta_t = t_delta
 
+        # time_start and time_end as ISO strings or INTEGER minutes since t_start
+        self.times = ScheduleTimes(t_start if config.integer_times else None, t_delta)
+
+        self.props = props
         self._init_db(output_dir, props)
 
         self._act_point_idx = 0
@@ -32,15 +38,15 @@ class Schedules(object):
         self._f4_idx = 0
         self._f5_idx = 0
 
-        ds_start_timesteps = pd.date_range('2020-07-01 00:00', periods=24, freq='h')
-        ds_end_timesteps = pd.date_range('2020-07-01 01:00', periods=24, freq='h')
+        # exposure timesteps at which activities are split, hourly by default
+        self.time_axis = TimeAxis.regular(t_start, t_end) if time_axis is None else time_axis
 
-        ends = ds_end_timesteps.strftime("%Y-%m-%d %H:%M:%S").tolist()
-        ends[23] = '2020-07-01 23:59:00'
-        ends[23] = '2020-07-02 00:00:00'
+        # number of agents split at once
+        self.make_agents = 100000
 
-        self.timesteps = pd.DataFrame({'ds_start_timesteps': ds_start_timesteps.strftime("%Y-%m-%d %H:%M:%S").tolist(),
-                                       'ds_end_timesteps': ends})
+        # Schedule objects are written in batches
+        self.batch_agents = 10000
+        self._pending = []
 
     def _init_db(self, output_dir, props):
         if config.inmem_schedules:
@@ -52,12 +58,14 @@ class Schedules(object):
             self.db_con.execute("pragma journal_mode=wal")
             self.db_con = sqlite3.connect(path)
 
-        self.db_con.execute('''CREATE TABLE file1 (
+        self.times.write(self.db_con)
+
+        self.db_con.execute(f'''CREATE TABLE file1 (
 activity_id INTEGER PRIMARY KEY,
 agent_id INTEGER NOT NULL,
 act_idx INTEGER NOT NULL,
-time_start timestep NOT NULL,
-time_end timestep NOT NULL,
+time_start {self.times.sql_type()} NOT NULL,
+time_end {self.times.sql_type()} NOT NULL,
 activity_group INTEGER NOT NULL,
 activity_index INTEGER NOT NULL
 )
@@ -78,8 +86,8 @@ buffer_method INTEGER
         self.db_con.execute(f'''CREATE TABLE process (
 activity_id INTEGER PRIMARY KEY,
 agent_id INTEGER NOT NULL,
-time_start timestep NOT NULL,
-time_end timestep NOT NULL,
+time_start {self.times.sql_type()} NOT NULL,
+time_end {self.times.sql_type()} NOT NULL,
 activity_group INTEGER NOT NULL,
 activity_index INTEGER NOT NULL,
 activity_description INTEGER,
@@ -170,182 +178,109 @@ ycoord REAL
         return
 
     def add(self, agent_agenda):
-        agent = agent_agenda
-        agent_id = agent.agent_id
-
-        for activity in agent._activities:
-            start = activity._activity_start
-            end = activity._activity_end
-            act_type = activity._activity_type
-
-            if act_type == ActivityType.point:
-                activity_type = activity.description.value
-                values = (activity_type, activity.xcoord, activity.ycoord)
-                self.db_con.execute("INSERT INTO point_activities(activity_type, xcoord, ycoord) VALUES (?, ?, ?)", values)
-                self._act_point_idx += 1
-                activity_group = ActivityType.point.value
-                values = (agent_id, activity._position, start, end, activity_group, self._act_point_idx)
-                self.db_con.execute("INSERT INTO file1(agent_id,act_idx,time_start,time_end,activity_group,activity_index) VALUES (?, ?, ?, ?, ?, ?)", values)
-            elif act_type == ActivityType.buffer:
-                activity_type = activity.description.value
-                values = (activity_type, activity.xcoord, activity.ycoord, activity.buffersize, activity.buffer_method.value)
-                self._act_buffer_idx += 1
-                self.db_con.execute("INSERT INTO buffer_activities(activity_type,xcoord,ycoord,buffer_size,buffer_method) VALUES (?, ?, ?, ?, ?)", values)
-                activity_group = ActivityType.buffer.value
-                values = (agent_id, activity._position, start, end, activity_group, self._act_buffer_idx)
-                self.db_con.execute("INSERT INTO file1(agent_id,act_idx,time_start,time_end,activity_group,activity_index) VALUES (?, ?, ?, ?, ?, ?)", values)
-            elif act_type == ActivityType.route:
-                values = (activity.travel_mode.value, activity.start_x, activity.start_y, activity.dest_x, activity.dest_y, activity._activity_description.value)
-                self.db_con.execute("INSERT INTO route_activities(travel_type,xcoord1,ycoord1,xcoord2,ycoord2,travel_descr) VALUES (?, ?, ?, ?, ?, ?)", values)
-                self._f5_idx += 1
-                self._act_route_idx += 1
-                values = (agent_id, activity._position, start, end, 3, self._act_route_idx)
-                self.db_con.execute("INSERT INTO file1(agent_id,act_idx,time_start,time_end,activity_group,activity_index) VALUES (?, ?, ?, ?, ?, ?)", values)
-            else:
-                raise NotImplementedError
-
-        agent_agenda = None
-
-    def create_index(self):
-        self.db_con.execute("CREATE INDEX file1_ixd ON file1 (agent_id)")
-
-    def create_indices(self):
-        self.db_con.execute("CREATE INDEX point1_ixd ON point_activities (activity_index)")
-        self.db_con.execute("CREATE INDEX buffer1_ixd ON buffer_activities (activity_index)")
-        self.db_con.execute("CREATE INDEX route1_ixd ON route_activities (activity_index)")
-        self.db_con.execute("CREATE INDEX process1_ixd ON process (activity_id)")
-        self.db_con.execute("CREATE INDEX process2_ixd ON process (time_start)")
-        self.db_con.execute("CREATE INDEX process3_ixd ON process (agent_id)")
-
-    def make(self, agent_id):
-        timesteps = self.timesteps
-        tmp_dataframe_data = {}
-        tmp_dataframe_data_idx = 0
-        activity_idx = 1
-
-        df_1 = {}
-        with self.db_con:
-            f1_idx_0 = 0
-            for row in self.db_con.execute("SELECT activity_id,agent_id,time_start,time_end,activity_group,activity_index,act_idx FROM file1 WHERE agent_id=?", (agent_id,)):
-                item = {'activity_id': row[0], 'agent_id': row[1], 'time_start': row[2], 'time_end': row[3], 'activity_group': row[4], 'activity_index': row[5], 'act_idx': row[6]}
-                df_1[f1_idx_0] = item
-                f1_idx_0 += 1
-
-        df_1 = pd.DataFrame.from_dict(df_1, "index")
-
-        act_row_idx = 0
-        agent_act = df_1
-
-        row = agent_act.iloc[0]
-        start = pd.Timestamp(row['time_start'])
-        end = pd.Timestamp(row['time_end'])
+        """ Adds a generated Schedule, written in batches of batch_agents schedules """
+        self._pending.append(agent_agenda)
 
-        curr_id = row['agent_id']
-        curr_group = row['activity_group']
-        curr_index = row['activity_index']
+        if len(self._pending) >= self.batch_agents:
+            self.flush()
 
-        nr_to_test = len(timesteps['ds_start_timesteps']) - 1
+    def flush(self):
+        """ Writes the pending Schedule objects """
+        if len(self._pending) > 0:
+            self.add_batch(ScheduleBatch.from_schedules(self._pending))
+            self._pending = []
 
-        exp_ts_idx = 0
-        exp_start = pd.Timestamp(timesteps['ds_start_timesteps'][exp_ts_idx])
-        exp_end = pd.Timestamp(timesteps['ds_end_timesteps'][exp_ts_idx])
+    def add_batch(self, batch):
+        """ Writes the activities of a ScheduleBatch, one executemany per table """
+        if len(batch) == 0:
+            return
 
-        last_ts = timesteps['ds_end_timesteps'][timesteps.shape[0] - 1]
+        point = batch.group == ActivityType.point.value
+        buffer = batch.group == ActivityType.buffer.value
+        route = batch.group == ActivityType.route.value
 
-        row = agent_act.iloc[act_row_idx]
-        start = pd.Timestamp(row['time_start'])
-        end = pd.Timestamp(row['time_end'])
+        if not (point | buffer | route).all():
+            raise NotImplementedError
 
-        curr_id = row['agent_id']
-        curr_group = row['activity_group']
-        curr_index = row['activity_index']
+        nr_point = int(point.sum())
+        nr_buffer = int(buffer.sum())
+        nr_route = int(route.sum())
 
-        while exp_ts_idx <= nr_to_test:
-            if end > exp_end:
-                act_end = exp_end
-                row = {'activity_id': activity_idx, 'agent_id': curr_id, 'time_start': start, 'time_end': act_end, 'activity_group': curr_group, 'activity_index': curr_index}
+        activity_index = np.zeros(len(batch), dtype=np.int64)
+        activity_index[point] = np.arange(self._act_point_idx + 1, self._act_point_idx + nr_point + 1)
+        activity_index[buffer] = np.arange(self._act_buffer_idx + 1, self._act_buffer_idx + nr_buffer + 1)
+        activity_index[route] = np.arange(self._act_route_idx + 1, self._act_route_idx + nr_route + 1)
 
-                tmp_dataframe_data[tmp_dataframe_data_idx] = row
-                tmp_dataframe_data_idx += 1
+        self._act_point_idx += nr_point
+        self._act_buffer_idx += nr_buffer
+        self._act_route_idx += nr_route
+        self._f5_idx += nr_route
 
-                activity_idx += 1
-                exp_ts_idx += 1
+        values = zip(activity_index[point].tolist(), batch.description[point].tolist(), to_sql(batch.xcoord[point]), to_sql(batch.ycoord[point]))
+        self.db_con.executemany("INSERT INTO point_activities(activity_index,activity_type,xcoord,ycoord) VALUES (?, ?, ?, ?)", values)
 
-                exp_start = pd.Timestamp(timesteps['ds_start_timesteps'][exp_ts_idx])
-                exp_end = pd.Timestamp(timesteps['ds_end_timesteps'][exp_ts_idx])
+        values = zip(activity_index[buffer].tolist(), batch.description[buffer].tolist(), to_sql(batch.xcoord[buffer]), to_sql(batch.ycoord[buffer]),
+                     to_sql(batch.buffer_size[buffer]), batch.buffer_method[buffer].tolist())
+        self.db_con.executemany("INSERT INTO buffer_activities(activity_index,activity_type,xcoord,ycoord,buffer_size,buffer_method) VALUES (?, ?, ?, ?, ?, ?)", values)
 
-                start = act_end
-            elif start >= exp_start and end < exp_end:
-                act_end = end
-                row = {'activity_id': activity_idx, 'agent_id': curr_id, 'time_start': start, 'time_end': end, 'activity_group': curr_group, 'activity_index': curr_index}
-                tmp_dataframe_data[tmp_dataframe_data_idx] = row
-                tmp_dataframe_data_idx += 1
+        values = zip(activity_index[route].tolist(), batch.travel_mode[route].tolist(), to_sql(batch.xcoord[route]), to_sql(batch.ycoord[route]),
+                     to_sql(batch.xcoord2[route]), to_sql(batch.ycoord2[route]), batch.description[route].tolist())
+        self.db_con.executemany("INSERT INTO route_activities(activity_index,travel_type,xcoord1,ycoord1,xcoord2,ycoord2,travel_descr) VALUES (?, ?, ?, ?, ?, ?, ?)", values)
 
-                act_row_idx += 1
-                row = agent_act.iloc[act_row_idx]
-                start = act_end
-                try:
-                    end = pd.Timestamp(row['time_end'])
-                except ValueError:
-                    end = last_ts
+        values = zip(batch.agent_id.tolist(), batch.act_idx.tolist(), self.times.encode(batch.start), self.times.encode(batch.end), batch.group.tolist(), activity_index.tolist())
+        self.db_con.executemany("INSERT INTO file1(agent_id,act_idx,time_start,time_end,activity_group,activity_index) VALUES (?, ?, ?, ?, ?, ?)", values)
 
-                curr_id = row['agent_id']
-                curr_group = row['activity_group']
-                curr_index = row['activity_index']
-                activity_idx += 1
-
-                assert exp_start < exp_end
-            elif start >= exp_start and end == exp_end:
-                act_end = end
-                row = {'activity_id': activity_idx, 'agent_id': curr_id, 'time_start': start, 'time_end': end, 'activity_group': curr_group, 'activity_index': curr_index}
-                tmp_dataframe_data[tmp_dataframe_data_idx] = row
-                tmp_dataframe_data_idx += 1
-                exp_ts_idx += 1
+    def create_index(self):
+        self.db_con.execute("CREATE INDEX file1_ixd ON file1 (agent_id)")
 
-                if exp_ts_idx <= nr_to_test:
-                    exp_start = pd.Timestamp(timesteps['ds_start_timesteps'][exp_ts_idx])
-                    exp_end = pd.Timestamp(timesteps['ds_end_timesteps'][exp_ts_idx])
+    def create_indices(self):
+        self.db_con.execute("CREATE INDEX point1_ixd ON point_activities (activity_index)")
+        self.db_con.execute("CREATE INDEX buffer1_ixd ON buffer_activities (activity_index)")
+        self.db_con.execute("CREATE INDEX route1_ixd ON route_activities (activity_index)")
+        self.db_con.execute("CREATE INDEX process1_ixd ON process (activity_id)")
+        self.db_con.execute("CREATE INDEX process2_ixd ON process (time_start)")
+        self.db_con.execute("CREATE INDEX process3_ixd ON process (agent_id)")
 
-                    act_row_idx += 1
-                    row = agent_act.iloc[act_row_idx]
-                    start = act_end
-                    end = pd.Timestamp(row['time_end'])
+    def make(self, agent_min, agent_max):
+        """ Splits the activities of a range of agents at the exposure timesteps into process rows """
+        # process rows are written in agent id order, whatever order the agents were added in
+        rows = self.db_con.execute("SELECT agent_id,time_start,time_end,activity_group,activity_index FROM file1 WHERE agent_id BETWEEN ? AND ? ORDER BY agent_id,activity_id", (agent_min, agent_max)).fetchall()
 
-                    curr_id = row['agent_id']
-                    curr_group = row['activity_group']
-                    curr_index = row['activity_index']
+        if len(rows) == 0:
+            return
 
-                    activity_idx += 1
-            else:
-                raise NotImplementedError
+        agent_ids, time_starts, time_ends, groups, indices = zip(*rows)
 
-        df2 = pd.DataFrame.from_dict(tmp_dataframe_data, "index")
+        agent_ids = np.array(agent_ids, dtype=np.int64)
+        groups = np.array(groups, dtype=np.int64)
+        indices = np.array(indices, dtype=np.int64)
 
-        total_diff = self.total_end - self.total_start
-        curr_diff = total_diff
+        activity, starts, ends = self.time_axis.split(self.times.decode(time_starts), self.times.decode(time_ends))
 
-        values = []
+        # the activities of each agent add up to the schedule period
+        total_diff = to_ticks([self.total_end])[0] - to_ticks([self.total_start])[0]
+        agents, agent_idx = np.unique(agent_ids[activity], return_inverse=True)
+        curr_diff = np.bincount(agent_idx.reshape(-1), weights=ends - starts, minlength=len(agents))
 
-        for idx, item in df2.iterrows():
-            values.append((item.iloc[1], item.iloc[2].to_pydatetime(), item.iloc[3].to_pydatetime(), item.iloc[4], item.iloc[5]))
-            act_diff = item.iloc[3] - item.iloc[2]
-            curr_diff -= act_diff
+        wrong = curr_diff != total_diff
+        assert not wrong.any(), f"activities do not add up to {total_diff} ticks for agents {agents[wrong][:10]}, durations {curr_diff[wrong][:10]}"
 
-        assert curr_diff == datetime.timedelta(0), f"activities do not add up to {total_diff}, difference is {curr_diff}\n{df_1}\n{df2}"
+        values = zip(agent_ids[activity].tolist(), self.times.encode(starts), self.times.encode(ends), groups[activity].tolist(), indices[activity].tolist())
 
         self.db_con.executemany("INSERT INTO process(agent_id,time_start,time_end,activity_group,activity_index) VALUES (?, ?, ?, ?, ?)", values)
         self.db_con.commit()
 
     def commit(self):
-        self.create_index()
+        """ Splits the activities into process rows and writes the database
 
-        for row in self.db_con.execute("SELECT DISTINCT agent_id FROM file1"):
-            home_egid = int(row[0])
-            self.make(home_egid)
+        Returns the open in-memory database instead of writing it with config.inmem_pipeline
+        """
+        self._split()
 
-        self.create_indices()
-
-        if config.inmem_schedules:
+        if config.inmem_schedules and config.inmem_pipeline:
+            self.db_con.commit()
+            return self.db_con
+        elif config.inmem_schedules:
             path = pathlib.Path(config.output_dir, f"{self.output_dir}.sqlite3")
             path.unlink(missing_ok=True)
 
@@ -357,6 +292,34 @@ ycoord REAL
         else:
             self.db_con.close()
 
+    def commit_chunk(self):
+        """ Splits the activities added since the previous chunk and returns their in-memory database
+
+        The next chunk starts in a new database, activity indices continue over the chunks
+        """
+        assert config.inmem_schedules, "chunks require inmem_schedules"
+
+        self._split()
+        self.db_con.commit()
+
+        connection = self.db_con
+        self._init_db(self.output_dir, self.props)
+
+        return connection
+
+    def _split(self):
+        """ Writes pending schedules and splits all activities into process rows """
+        self.flush()
+        self.create_index()
+
+        agent_ids = np.array(self.db_con.execute("SELECT DISTINCT agent_id FROM file1 ORDER BY agent_id").fetchall(), dtype=np.int64).reshape(-1)
+
+        for first in range(0, len(agent_ids), self.make_agents):
+            chunk = agent_ids[first:first + self.make_agents]
+            self.make(int(chunk[0]), int(chunk[-1]))
+
+        self.create_indices()
+
     def to_csv(self):
         pathlib.Path(self.output_dir).mkdir(parents=False, exist_ok=True)
 
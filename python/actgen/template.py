@@ -0,0 +1,52 @@
+import numpy as np
+
+from .config import ActivityType, ActivityDescription, BufferCalculation
+from .batch import ScheduleBatch
+
+
+def draw_durations(duration, nr_agents, rng):
+    """ Returns durations in t_delta units of all agents, None until the end of the day """
+    kind = duration[0]
+
+    if kind == "fixed":
+        return np.full(nr_agents, duration[1], dtype=np.int64)
+    elif kind == "uniform":
+        return rng.integers(duration[1], duration[2], size=nr_agents)
+    elif kind == "final":
+        return None
+    else:
+        raise NotImplementedError(kind)
+
+
+def compile_template(activities, agents, t_start, t_end, t_delta, rng, arg=None):
+    """ Returns ScheduleBatch of agents following a profile template
+
+    agents holds the columns of the home query, activities take place at home_x, home_y
+    """
+    nr_agents = len(agents["agent_id"])
+    slots = []
+
+    for spec in activities:
+        group = ActivityType[spec["activity"]]
+
+        slot = {
+            "group": group.value,
+            "description": ActivityDescription[spec["description"]].value,
+            "xcoord": agents["home_x"],
+            "ycoord": agents["home_y"],
+            "duration": draw_durations(spec["duration"], nr_agents, rng),
+        }
+
+        if group == ActivityType.buffer:
+            buffer_size = spec["buffer_size"]
+            if buffer_size == "arg":
+                buffer_size = np.nan if arg is None else arg
+
+            slot["buffer_size"] = buffer_size
+            slot["buffer_method"] = BufferCalculation[spec.get("buffer_method", "mean")].value
+        elif group != ActivityType.point:
+            raise NotImplementedError(spec["activity"])
+
+        slots.append(slot)
+
+    return ScheduleBatch.from_slots(agents["agent_id"], t_start, t_end, t_delta, slots)
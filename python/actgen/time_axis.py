@@ -0,0 +1,187 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+
+# commute durations are fractional minutes, times are kept as int64 microseconds
+TICK = "datetime64[us]"
+TICKS_PER_MINUTE = 60 * 10 ** 6
+
+
+def to_ticks(values):
+    """ Returns int64 microseconds since 1970 of an array of datetimes, timestamps or ISO strings """
+    return np.asarray(pd.to_datetime(np.asarray(values), format="ISO8601"), dtype=TICK).astype(np.int64)
+
+
+def from_ticks(ticks):
+    """ Returns DatetimeIndex of int64 microseconds since 1970 """
+    return pd.DatetimeIndex(np.asarray(ticks, dtype=np.int64).astype(TICK))
+
+
+def to_text(ticks):
+    """ Returns ISO strings as written by sqlite3 for datetimes, formatting each distinct value once """
+    unique, inverse = np.unique(ticks, return_inverse=True)
+    text = np.array([str(timestep) for timestep in from_ticks(unique).to_pydatetime()], dtype=object)
+
+    return text[inverse.reshape(-1)]
+
+
+class TimeAxis(object):
+    def __init__(self, timesteps, end=None):
+        """ Exposure timesteps, timestep i covers [cuts[i], cuts[i + 1]) ticks
+
+        Without end the last timestep lasts as long as the one before, or an hour
+        """
+        self.timesteps = pd.DatetimeIndex(timesteps)
+
+        assert len(self.timesteps) > 0
+        assert self.timesteps.is_monotonic_increasing and self.timesteps.is_unique
+
+        self.ticks = to_ticks(self.timesteps)
+
+        if end is not None:
+            end = to_ticks([end])[0]
+        elif len(self.ticks) > 1:
+            end = self.ticks[-1] + (self.ticks[-1] - self.ticks[-2])
+        else:
+            end = self.ticks[-1] + 60 * TICKS_PER_MINUTE
+
+        assert end > self.ticks[-1]
+
+        self.cuts = np.append(self.ticks, end)
+
+    @classmethod
+    def regular(cls, start, end, freq="h"):
+        """ Returns axis of equidistant timesteps between start and end """
+        return cls(pd.date_range(start, end, freq=freq, inclusive="left"), end)
+
+    def __len__(self):
+        return len(self.timesteps)
+
+    def __eq__(self, other):
+        return isinstance(other, TimeAxis) and np.array_equal(self.cuts, other.cuts)
+
+    @property
+    def end(self):
+        return from_ticks(self.cuts[-1:])[0]
+
+    def covers(self, start, end):
+        """ Returns whether the period [start, end) lies within the timesteps """
+        start, end = to_ticks([start, end])
+
+        return bool(self.cuts[0] <= start and end <= self.cuts[-1])
+
+    def index(self, ticks):
+        """ Returns indices of the timesteps containing the ticks, -1 before the first timestep """
+        return np.searchsorted(self.ticks, ticks, side="right") - 1
+
+    def nearest(self, timestep):
+        """ Returns the latest timestep not after timestep, None if there is none """
+        idx = self.index(to_ticks([timestep]))[0]
+
+        return None if idx < 0 else self.timesteps[idx]
+
+    def boundaries(self, start, end):
+        """ Returns start and end ticks of the timesteps overlapping [start, end), clipped to that period """
+        start, end = to_ticks([start, end])
+
+        assert start < end
+
+        first = max(self.index(start), 0)
+        last = np.searchsorted(self.ticks, end, side="left")
+
+        starts = np.maximum(self.cuts[first:last], start)
+        ends = np.minimum(self.cuts[first + 1:last + 1], end)
+
+        # periods outside the axis are part of the first or last timestep
+        starts[0] = start
+        ends[-1] = end
+
+        return starts, ends
+
+    def split(self, starts, ends):
+        """ Cuts periods at the timestep boundaries
+
+        Returns the period index, start and end ticks of each piece
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        cuts = self.cuts[1:-1]
+
+        first = np.searchsorted(cuts, starts, side="right")
+        last = np.searchsorted(cuts, ends, side="left")
+
+        # empty periods are kept as a single piece
+        nr_pieces = np.maximum(last - first + 1, 1)
+
+        period = np.repeat(np.arange(len(starts)), nr_pieces)
+        offset = np.arange(len(period)) - np.repeat(np.cumsum(nr_pieces) - nr_pieces, nr_pieces)
+        timestep = first[period] + offset
+
+        piece_starts = np.where(offset == 0, starts[period], self.cuts[timestep])
+        piece_ends = np.where(offset == nr_pieces[period] - 1, ends[period], self.cuts[timestep + 1])
+
+        return period, piece_starts, piece_ends
+
+
+class ScheduleTimes(object):
+    def __init__(self, epoch=None, t_delta=None):
+        """ Encoding of the times in a schedule database
+
+        ISO strings, or with an epoch INTEGER minutes since that epoch, truncated to whole minutes like minutes()
+        """
+        self.epoch = None if epoch is None else int(to_ticks([epoch])[0])
+        self.t_delta = t_delta
+
+    @property
+    def integer(self):
+        return self.epoch is not None
+
+    def sql_type(self):
+        """ Returns the column type of time_start and time_end """
+        return "INTEGER" if self.integer else "timestep"
+
+    def encode(self, ticks):
+        """ Returns list of database values of int64 ticks """
+        if self.integer:
+            return ((np.asarray(ticks, dtype=np.int64) - self.epoch) // TICKS_PER_MINUTE).tolist()
+
+        return to_text(ticks).tolist()
+
+    def decode(self, values):
+        """ Returns int64 ticks of database values """
+        if self.integer:
+            return self.epoch + np.asarray(values, dtype=np.int64) * TICKS_PER_MINUTE
+
+        return to_ticks(values)
+
+    def minutes(self, time_start, time_end):
+        """ Returns durations between arrays of database values in whole minutes, truncated """
+        return (self.decode(time_end) - self.decode(time_start)) // TICKS_PER_MINUTE
+
+    def write(self, connection):
+        """ Stores the encoding in the metadata table """
+        connection.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+
+        values = [("time_format", "minutes" if self.integer else "iso")]
+        if self.integer:
+            values.append(("epoch", str(from_ticks([self.epoch])[0])))
+        if self.t_delta is not None:
+            values.append(("t_delta", str(self.t_delta.total_seconds() / 60)))
+
+        connection.executemany("INSERT OR REPLACE INTO metadata(key, value) VALUES (?, ?)", values)
+
+    @classmethod
+    def read(cls, connection):
+        """ Returns the encoding of a schedule database, ISO strings without metadata """
+        exists = connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='metadata'").fetchone()[0]
+        metadata = dict(connection.execute("SELECT key,value FROM metadata").fetchall()) if exists else {}
+
+        t_delta = metadata.get("t_delta")
+        t_delta = None if t_delta is None else datetime.timedelta(minutes=float(t_delta))
+
+        if metadata.get("time_format", "iso") == "minutes":
+            return cls(metadata["epoch"], t_delta)
+
+        return cls(None, t_delta)
@@ -1,3 +1,5 @@
+import concurrent.futures
+import logging
 import pathlib
 import sqlite3
 import numpy as np
@@ -8,7 +10,14 @@ import datetime
 
 from .spatial_context import SpatialContext
 from .factors import EnvFactors
+from .focal import FocalSurfaces
+from .route_cache import RouteCache
+from .routing_backend import routing_backend
+from .shared_cube import SharedCube, attach
+from .group import agent_chunks, in_order
+from .actgen.batch import to_sql
 from .actgen.config import ActivityType, BufferCalculation
+from .actgen.time_axis import ScheduleTimes, from_ticks
 
 import config
 
@@ -16,9 +25,48 @@ import config
 gdal.UseExceptions()
 
 
+# Exposure calculator of a worker process, opened once per process
+_worker = None
+
+
+def _init_worker(filename, props, epsg, logger_name, descriptor=None):
+    global _worker
+
+    # attach to the pollutant arrays of the parent process when shared
+    exposure = None if descriptor is None else attach(descriptor)
+
+    # the parent process checked the source of the route cache and is its only writer
+    _worker = ExposureCalculator(filename, props, epsg, logging.getLogger(logger_name), routing_backend(), RouteCache(config.route_cache, readonly=True), exposure)
+
+
+def _enrich_worker(batch):
+    """ Returns process updates of a batch and the routes to add to the route cache """
+    updates = _worker._enrich_batch(batch)
+
+    route_cache = _worker._spatial_context.route_cache
+    routes = ([], []) if route_cache is None else route_cache.take_pending()
+
+    return updates, routes
+
+
+def _enrich_chunk(path, agent_min, agent_max):
+    """ Returns process updates and new routes of the agents in [agent_min, agent_max] """
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    batch = _worker._load_batch(connection, agent_min, agent_max)
+    connection.close()
+
+    return _enrich_worker(batch)
+
+
+def _enrich_loaded(batch):
+    """ Returns process updates and new routes of a batch loaded by the parent process """
+    return _enrich_worker(batch)
+
+
 class ExposureCalculator(object):
-    def __init__(self, filename, props, epsg, logger, routing_engine):
+    def __init__(self, filename, props, epsg, logger, routing_engine, route_cache=None, exposure=None):
 
+        self.filename = filename
         self.logger = logger
         self.epsg = epsg
         self.props = props
@@ -26,40 +74,59 @@ class ExposureCalculator(object):
         phen_name = "concentration"
         pset_name = "area"
 
-        self._exposure = EnvFactors(filename, phen_name, pset_name, self.props)
-        self._spatial_context = SpatialContext(routing_engine, self._exposure.extent(), self.epsg)
+        if exposure is None:
+            self._exposure = EnvFactors(filename, phen_name, pset_name, self.props, use_cache=config.cube_cache)
+        else:
+            self._exposure = exposure
+        self._spatial_context = SpatialContext(routing_engine, self._exposure.extent(), self.epsg, route_cache)
 
-    def calc_schedule(self, data_dir):
-        self.data_dir = data_dir
-        path = pathlib.Path(config.output_dir, f"{self.data_dir}.sqlite3")
-        source = sqlite3.connect(path)
-        self.conn = sqlite3.connect(":memory:")
-        source.backup(self.conn)
-        source.close()
+        # exposure timesteps, schedules are split at these
+        self.time_axis = self._exposure.time_axis
 
-        self.conn.row_factory = sqlite3.Row
-        self.conn.execute("pragma journal_mode=wal")
+        # maximum number of raster cells gathered at once for buffer activities
+        self.gather_cells = 2 ** 24
 
-        self.calc()
+        self._focal = FocalSurfaces(self._exposure, filename) if config.focal_buffers else None
 
-        dest = sqlite3.connect(path)
+        # worker pool and shared pollutant arrays kept over several calc_schedule calls
+        self._executor = None
+        self._shared = None
 
-        with dest:
-            self.conn.backup(dest)
-        dest.close()
-        self.conn.close()
+    def calc_schedule(self, data_dir, workers=1, connection=None):
+        """ Enriches the process rows of the schedule database data_dir
 
-    def travel_type(self, t_type):
-        act = self._travel_type.loc[self._travel_type['travel_type'] == t_type]
-        v = act['travel_descr']
-        assert len(v) == 1
+        With a connection, the in-memory database of the pipeline is enriched in place and left open
+        """
+        self.data_dir = data_dir
+        path = pathlib.Path(config.output_dir, f"{self.data_dir}.sqlite3")
 
-        return v.values[0]
+        if connection is None:
+            source = sqlite3.connect(path)
+            self.conn = sqlite3.connect(":memory:")
+            source.backup(self.conn)
+            source.close()
+        else:
+            self.conn = connection
 
-    def buffer_method(self, buff_method):
-        act = self._buffer_method.loc[self._buffer_method['buffer_type'] == buff_method]
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("pragma journal_mode=wal")
+
+        if config.batch_enrichment and workers > 1:
+            self.calc_parallel(path if connection is None else None, workers)
+        elif config.batch_enrichment:
+            self.calc_batch()
+        else:
+            self.calc()
+
+        if connection is None:
+            dest = sqlite3.connect(path)
 
-        return act['buffer_descr'].values[0]
+            with dest:
+                self.conn.backup(dest)
+            dest.close()
+            self.conn.close()
+        else:
+            self.conn.row_factory = None
 
     def calc(self):
         cur = self.conn.cursor()
@@ -69,6 +136,8 @@ class ExposureCalculator(object):
 
         count = 0
 
+        times = ScheduleTimes.read(self.conn)
+
         t_start = datetime.datetime.now()
         self.logger.info(f"activity {count:8d}/{all_activities} {t_start}")
         for row in self.conn.execute('SELECT activity_id,agent_id,time_start,activity_group,activity_index FROM process ORDER BY time_start'):
@@ -85,7 +154,7 @@ class ExposureCalculator(object):
                 t_start = t_end
 
             # get exposure timestep nearest to current activity
-            activity_start = self._exposure._nearest_timestep(pd.to_datetime(activity_start))
+            activity_start = self._exposure._nearest_timestep(from_ticks(times.decode([activity_start]))[0])
 
             if activity_group == ActivityType.point.value:
                 # Query current activity
@@ -106,11 +175,9 @@ class ExposureCalculator(object):
                 for prop in self.props:
                     scontext_values = self._exposure.data(activity_start, scontext, prop)
 
-                    shape_x, shape_y = scontext_values.shape
-                    assert shape_x == 1
-                    assert shape_y == 1
+                    assert len(scontext_values) == 1
 
-                    point_value = scontext_values[0][0]
+                    point_value = scontext_values[0]
 
                     if np.isnan(point_value):
                         point_value = None
@@ -155,9 +222,6 @@ class ExposureCalculator(object):
                     # correct for some exposure values below 0
                     scontext_raster = np.maximum(0.0, scontext_raster)
 
-                    shape_x, shape_y = scontext_raster.shape
-                    assert shape_x == shape_y
-
                     buffer_value = None
 
                     if buff_method == BufferCalculation.mean.value:
@@ -204,7 +268,6 @@ class ExposureCalculator(object):
                         scontext_raster = self._exposure.data(activity_start, scontext, prop)
                         scontext_raster = np.where(scontext_raster < -10, np.nan, scontext_raster)
                         scontext_values = np.maximum(0.0, scontext_raster)
-                        shape_x, shape_y = scontext_values.shape
                         route_value = -9
 
                         if np.isnan(scontext_values).all():
@@ -227,3 +290,241 @@ class ExposureCalculator(object):
                 raise NotImplementedError
 
         self.conn.commit()
+
+        if self._spatial_context.route_cache is not None:
+            self._spatial_context.route_cache.flush()
+
+    def _load_batch(self, connection, agent_min=None, agent_max=None):
+        """ Returns process rows joined with their activity attributes, optionally for a range of agents """
+        where = "" if agent_min is None else "WHERE p.agent_id BETWEEN ? AND ?"
+        params = () if agent_min is None else (agent_min, agent_max)
+
+        query = f"""SELECT p.activity_id,p.time_start,p.activity_group,p.activity_index,
+pa.activity_type AS point_type,pa.xcoord AS point_x,pa.ycoord AS point_y,
+ba.activity_type AS buffer_type,ba.xcoord AS buffer_x,ba.ycoord AS buffer_y,ba.buffer_size,ba.buffer_method,
+ra.travel_type,ra.xcoord1,ra.ycoord1,ra.xcoord2,ra.ycoord2
+FROM process p
+LEFT JOIN point_activities pa ON p.activity_group={ActivityType.point.value} AND pa.activity_index=p.activity_index
+LEFT JOIN buffer_activities ba ON p.activity_group={ActivityType.buffer.value} AND ba.activity_index=p.activity_index
+LEFT JOIN route_activities ra ON p.activity_group={ActivityType.route.value} AND ra.activity_index=p.activity_index
+{where}
+ORDER BY p.time_start"""
+
+        batch = pd.read_sql_query(query, connection, params=params)
+        batch["time_start"] = ScheduleTimes.read(connection).decode(batch["time_start"].values)
+
+        return batch
+
+    def _footprint_cells(self, activities, xcolumn, ycolumn):
+        """ Returns cell indices per split, calculated once per activity """
+        indices, first, inverse = np.unique(activities["activity_index"].values, return_index=True, return_inverse=True)
+
+        rows, cols = self._spatial_context.cells(activities[xcolumn].values[first], activities[ycolumn].values[first])
+
+        return rows[inverse], cols[inverse]
+
+    def _point_values(self, cubes, activities):
+        rows, cols = self._footprint_cells(activities, "point_x", "point_y")
+        t_idx = activities["t_idx"].values
+
+        return {prop: cubes[prop][t_idx, rows, cols] for prop in self.props}
+
+    def _buffer_values(self, cubes, activities, buffer_size, buff_method):
+        if buff_method == BufferCalculation.mean.value:
+            reduce = np.nanmean
+        elif buff_method == BufferCalculation.unknown.value:
+            raise RuntimeError
+        elif buff_method == BufferCalculation.sum.value:
+            reduce = np.nansum
+        else:
+            raise NotImplementedError
+
+        rows, cols = self._footprint_cells(activities, "buffer_x", "buffer_y")
+        t_idx = activities["t_idx"].values
+
+        if self._focal is not None:
+            # buffer values are a single lookup in the precomputed focal rasters
+            mask = self._spatial_context.buffer_mask(buffer_size)
+            res = {prop: np.empty(len(rows)) for prop in self.props}
+
+            for t in np.unique(t_idx):
+                timestep = self._exposure.timesteps()[t]
+                sel = t_idx == t
+                for prop in self.props:
+                    res[prop][sel] = self._focal.surface(timestep, prop, mask, buff_method)[rows[sel], cols[sel]]
+
+            return res
+
+        row_offsets, col_offsets = self._spatial_context.buffer_offsets(buffer_size)
+
+        radius = row_offsets.max()
+        assert (rows - radius >= 0).all() and (rows + radius < self._exposure.nr_rows).all()
+        assert (cols - radius >= 0).all() and (cols + radius < self._exposure.nr_cols).all()
+
+        # gather the buffer cells of several splits at once, bounded in memory
+        step = max(1, self.gather_cells // len(row_offsets))
+
+        res = {prop: np.empty(len(rows)) for prop in self.props}
+
+        for start in range(0, len(rows), step):
+            window_t = t_idx[start:start + step, np.newaxis]
+            window_rows = rows[start:start + step, np.newaxis] + row_offsets
+            window_cols = cols[start:start + step, np.newaxis] + col_offsets
+
+            for prop in self.props:
+                window = cubes[prop][window_t, window_rows, window_cols].astype(np.float64)
+                res[prop][start:start + step] = reduce(window, axis=1)
+
+        return res
+
+    def _route_values(self, cubes, activities):
+        res = {prop: np.empty(len(activities)) for prop in self.props}
+
+        # route all activities at once, then gather the time series of the splits of each
+        groups = activities.groupby("activity_index", sort=False)
+        first = groups.head(1)
+
+        assert (first["travel_type"].values >= 0).all()
+
+        footprints = self._spatial_context.routes(first["xcoord1"].values, first["ycoord1"].values, first["xcoord2"].values, first["ycoord2"].values, first["travel_type"].values.astype(np.int64), 4326)
+
+        for (activity_index, splits), scontext in zip(groups, footprints):
+            assert scontext
+
+            t_idx = splits["t_idx"].values
+            pos = activities.index.get_indexer(splits.index)
+
+            for prop in self.props:
+                values = scontext.gather(cubes[prop], t_idx).astype(np.float64)
+                valid = ~np.isnan(values).all(axis=1)
+
+                route_values = np.full(len(splits), np.nan)
+                route_values[valid] = np.nanmean(values[valid], axis=1)
+                res[prop][pos] = route_values
+
+        return res
+
+    def _update_query(self):
+        a = ",".join(map(str, [f"{prop}=?" for prop in self.props]))
+
+        return f"UPDATE process SET {a},activity_description=? WHERE activity_id=?"
+
+    def _enrich_batch(self, batch):
+        """ Returns process updates of a batch, spatial contexts are determined once per activity """
+        all_activities = len(batch)
+
+        self.logger.info(f"batch of {all_activities} activities {datetime.datetime.now()}")
+
+        if all_activities == 0:
+            return []
+
+        # get exposure timestep nearest to the activities
+        batch["t_idx"] = self.time_axis.index(batch["time_start"].values)
+        assert (batch["t_idx"] >= 0).all(), "activities before the first exposure timestep"
+
+        groups = set(batch["activity_group"].unique())
+        if not groups <= {ActivityType.point.value, ActivityType.buffer.value, ActivityType.route.value}:
+            raise NotImplementedError
+
+        cubes = {prop: self._exposure.cube(prop) for prop in self.props}
+
+        updates = []
+        count = 0
+
+        def collect(activities, res, descriptions):
+            nonlocal count
+
+            columns = [to_sql(res[prop]) for prop in self.props]
+            columns.append(descriptions.astype(np.int64).tolist())
+            columns.append(activities["activity_id"].values.astype(np.int64).tolist())
+
+            updates.extend(zip(*columns))
+
+            count += len(activities)
+            self.logger.info(f"activity {count:8d}/{all_activities} {100 * count / all_activities:.1f} {datetime.datetime.now()}")
+
+        points = batch[batch["activity_group"] == ActivityType.point.value]
+        if len(points) > 0:
+            collect(points, self._point_values(cubes, points), points["point_type"].values)
+
+        buffers = batch[batch["activity_group"] == ActivityType.buffer.value]
+        for (buffer_size, buff_method), group in buffers.groupby(["buffer_size", "buffer_method"]):
+            collect(group, self._buffer_values(cubes, group, buffer_size, buff_method), group["buffer_type"].values)
+
+        routes = batch[batch["activity_group"] == ActivityType.route.value]
+        if len(routes) > 0:
+            collect(routes, self._route_values(cubes, routes), routes["travel_type"].values)
+
+        return updates
+
+    def calc_batch(self):
+        """ Enriches all process rows at once """
+        updates = self._enrich_batch(self._load_batch(self.conn))
+
+        self.conn.executemany(self._update_query(), updates)
+        self.conn.commit()
+
+    def start_workers(self, workers):
+        """ Starts the process pool used by calc_parallel until stop_workers
+
+        The pollutant arrays are shared with config.shared_exposure, otherwise each worker loads
+        its own copy, in both cases once for all following calc_schedule calls
+        """
+        assert self._executor is None, "workers already started"
+
+        # load the pollutant arrays once, workers attach to them without copying
+        self._shared = SharedCube(self._exposure, self.props) if config.shared_exposure else None
+        descriptor = None if self._shared is None else self._shared.descriptor
+
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.filename, self.props, self.epsg, self.logger.name, descriptor))
+
+    def stop_workers(self):
+        """ Shuts the process pool down and frees the shared pollutant arrays """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        if self._shared is not None:
+            self._shared.close()
+            self._shared = None
+
+    def calc_parallel(self, path, workers):
+        """ Enriches process rows in a pool of processes, partitioned by agent
+
+        Without a path, the chunks are loaded here and passed to the workers. The pool of
+        start_workers is used when started, otherwise one is started for this call only
+        """
+        agent_ids = [row[0] for row in self.conn.execute("SELECT DISTINCT agent_id FROM process")]
+        # several chunks per worker to balance the load
+        chunks = agent_chunks(agent_ids, 4 * workers)
+
+        self.logger.info(f"enriching {len(agent_ids)} agents in {len(chunks)} chunks with {workers} workers")
+
+        started = self._executor is None
+        if started:
+            self.start_workers(workers)
+
+        executor = self._executor
+
+        try:
+            if path is None:
+                def submit(chunk):
+                    return executor.submit(_enrich_loaded, self._load_batch(self.conn, *chunk))
+            else:
+                def submit(chunk):
+                    return executor.submit(_enrich_chunk, str(path), *chunk)
+
+            # merge in chunk order, independent of completion order, one chunk queued
+            # besides those being enriched
+            for idx, (rows, routes) in enumerate(in_order(submit, chunks, workers + 1)):
+                self.conn.executemany(self._update_query(), rows)
+
+                if self._spatial_context.route_cache is not None:
+                    self._spatial_context.route_cache.store(*routes)
+
+                self.logger.info(f"chunk {idx + 1}/{len(chunks)} merged {datetime.datetime.now()}")
+        finally:
+            if started:
+                self.stop_workers()
+
+        self.conn.commit()
@@ -0,0 +1,83 @@
+import csv
+
+import numpy as np
+
+from .weekly_exposure import Accumulator, read_exp_day
+
+
+class Convergence(object):
+    def __init__(self, tolerance, statistic="agent", quantile=0.95, min_realisations=3):
+        """ Monte Carlo standard error of the daily exposure over realisations
+
+        statistic "agent" uses the quantile of the relative standard errors of the agents' mean exposure,
+        "percentile" the relative standard error of the quantile of the agents' exposures
+        """
+        if statistic not in ("agent", "percentile"):
+            raise NotImplementedError(statistic)
+
+        self.tolerance = tolerance
+        self.statistic = statistic
+        self.quantile = quantile
+        self.min_realisations = max(2, min_realisations)
+
+        self.agent_ids = None
+        self.variables = None
+        self.accumulators = None
+
+        self.nr_realisations = 0
+        self.trace = []
+
+    def add(self, fname, realisation):
+        """ Folds in exp_day of a realisation database and records the errors """
+        agent_ids, variables, values = read_exp_day(fname, self.agent_ids)
+
+        if self.agent_ids is None:
+            self.agent_ids = agent_ids
+            self.variables = variables
+            size = len(agent_ids) if self.statistic == "agent" else 1
+            self.accumulators = {variable: Accumulator(size) for variable in variables}
+
+        assert variables == self.variables, f"{fname} has exposure variables {variables}, expected {self.variables}"
+
+        for column, variable in enumerate(self.variables):
+            if self.statistic == "agent":
+                self.accumulators[variable].add(values[:, column])
+            else:
+                with np.errstate(invalid="ignore"):
+                    self.accumulators[variable].add(np.array([np.nanquantile(values[:, column], self.quantile)]))
+
+        self.nr_realisations += 1
+        self.trace.append((realisation, self.nr_realisations, self.errors()))
+
+    def errors(self):
+        """ Returns the relative standard error per exposure variable, inf with less than two realisations """
+        res = {}
+
+        for variable, accumulator in self.accumulators.items():
+            if self.nr_realisations < 2:
+                res[variable] = np.inf
+                continue
+
+            std_error = np.sqrt(accumulator.m2 / (accumulator.count - 1) / accumulator.count)
+
+            # agents without exposure values do not count, nor agents with a zero mean
+            # exposure, whose relative error is undefined
+            valid = ~np.isnan(std_error) & ~np.isnan(accumulator.mean) & (accumulator.mean != 0)
+            relative = std_error[valid] / np.abs(accumulator.mean[valid])
+            res[variable] = float(np.quantile(relative, self.quantile)) if len(relative) > 0 else np.inf
+
+        return res
+
+    def converged(self):
+        if self.nr_realisations < self.min_realisations:
+            return False
+
+        return all(error <= self.tolerance for error in self.errors().values())
+
+    def write_trace(self, fname):
+        """ Writes realisation, number of realisations and the error per exposure variable """
+        with open(fname, "w", newline="") as content:
+            writer = csv.writer(content)
+            writer.writerow(["realisation", "realisations"] + self.variables)
+            for realisation, nr_realisations, errors in self.trace:
+                writer.writerow([realisation, nr_realisations] + [errors[variable] for variable in self.variables])
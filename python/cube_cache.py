@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import pathlib
+
+import numpy as np
+
+
+def cache_path(filename):
+    """ Returns directory of the cube cache of a LUE dataset """
+    return pathlib.Path(filename).with_suffix(".cube")
+
+
+def dataset_stamp(filename):
+    """ Returns modification time and size identifying the contents of a dataset, None if it does not exist """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def write_cube_cache(exposure, props, dtype=None):
+    """ Writes cleaned, contiguous (time, row, col) arrays per property with the grid description
+
+    The description records the modification time and size of the dataset the arrays were read from
+    """
+    path = cache_path(exposure.filename)
+    path.mkdir(parents=True, exist_ok=True)
+
+    grid = exposure.grid()
+    xul, yul, xlr, ylr, cellsize_x, cellsize_y, nr_rows, nr_cols = grid["extent"]
+
+    description = {
+        "phenomenon": grid["phenomenon"],
+        "property_set": grid["property_set"],
+        "extent": [float(xul), float(yul), float(xlr), float(ylr), float(cellsize_x), float(cellsize_y), int(nr_rows), int(nr_cols)],
+        "geotransform": [float(xul), float(cellsize_x), 0.0, float(yul), 0.0, -float(cellsize_y)],
+        "timesteps": [str(t) for t in exposure.timesteps()],
+        "source": dataset_stamp(exposure.filename),
+        "props": {},
+    }
+
+    for prop in props:
+        cube = np.ascontiguousarray(exposure.cube(prop), dtype=dtype)
+
+        # write to a temporary file first, other runs may read the cache
+        tmp_path = pathlib.Path(path, f"{prop}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as content:
+            np.save(content, cube)
+        os.replace(tmp_path, pathlib.Path(path, f"{prop}.npy"))
+
+        description["props"][prop] = cube.dtype.str
+
+        exposure.release(prop)
+
+    # merge with properties converted earlier from the same dataset
+    grid_file = pathlib.Path(path, "grid.json")
+    if grid_file.exists():
+        with open(grid_file) as content:
+            previous = json.load(content)
+        if previous.get("source") == description["source"]:
+            previous["props"].update(description["props"])
+            description["props"] = previous["props"]
+
+    tmp_path = grid_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as content:
+        json.dump(description, content, indent=1)
+    os.replace(tmp_path, grid_file)
+
+
+def read_cube_cache(filename, props):
+    """ Returns grid description and memory-mapped arrays
+
+    None if a property is not cached or the cache is older than the dataset
+    """
+    path = cache_path(filename)
+    grid_file = pathlib.Path(path, "grid.json")
+
+    if not grid_file.exists():
+        return None
+
+    with open(grid_file) as content:
+        description = json.load(content)
+
+    if not all(prop in description["props"] for prop in props):
+        return None
+
+    # the dataset changed since the cache was written
+    stamp = dataset_stamp(filename)
+    if stamp is not None and description.get("source") != stamp:
+        return None
+
+    grid = {
+        "filename": filename,
+        "phenomenon": description["phenomenon"],
+        "property_set": description["property_set"],
+        "prop": props,
+        "extent": tuple(description["extent"]),
+        "timesteps": description["timesteps"],
+    }
+
+    cubes = {prop: np.load(pathlib.Path(path, f"{prop}.npy"), mmap_mode="r") for prop in props}
+
+    return grid, cubes
+
+
+if __name__ == '__main__':
+    from python.factors import EnvFactors
+    import config
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--float32", action="store_true")
+    args = parser.parse_args()
+
+    props = list(dict.fromkeys(config.workday + config.weekend))
+
+    exposure = EnvFactors(config.pollutant_db, "concentration", "area", props, use_cache=False)
+    write_cube_cache(exposure, props, np.float32 if args.float32 else None)
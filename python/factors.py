@@ -4,10 +4,14 @@ import pandas as pd
 import lue.data_model as ldm
 import campo
 
+from .footprint import Footprint
+from .cube_cache import read_cube_cache
+from .actgen.time_axis import TimeAxis
+
 
 class EnvFactors(object):
-    def __init__(self, filename, phenomenon, property_set, prop, regular=True):
-        """ Initialise with LUE dataset """
+    def __init__(self, filename, phenomenon, property_set, prop, regular=True, use_cache=True):
+        """ Initialise with LUE dataset, or its memory-mapped cube cache when that exists """
         self.filename = filename
         self.phenomenon = phenomenon
         self.property_set = property_set
@@ -19,6 +23,14 @@ class EnvFactors(object):
         if not regular:
             raise NotImplementedError
 
+        self._cubes = {}
+
+        cached = read_cube_cache(filename, prop) if use_cache else None
+
+        if cached is not None:
+            self._init_cubes(*cached)
+            return
+
         self.dataset = ldm.open_dataset(filename)
 
         if self.regular:
@@ -43,11 +55,41 @@ class EnvFactors(object):
             self.ylr = self.area_agent.ycoord.data[0]
 
             self.ds_timesteps = pd.DatetimeIndex(self.area_agent.time.data)
+            self.time_axis = TimeAxis(self.ds_timesteps)
 
             self.nr_timesteps = self.area_agent.shape[0]
             self.nr_rows = self.area_agent.shape[1]
             self.nr_cols = self.area_agent.shape[2]
 
+    def grid(self):
+        """ Returns the discretisation of the dataset, suitable for pickling """
+        return {"filename": self.filename, "phenomenon": self.phenomenon, "property_set": self.property_set,
+                "prop": self.prop, "extent": self.extent(), "timesteps": self.ds_timesteps.values}
+
+    @classmethod
+    def from_cubes(cls, grid, cubes):
+        """ Initialise with cleaned (time, row, col) arrays instead of the LUE dataset """
+        self = cls.__new__(cls)
+        self._init_cubes(grid, cubes)
+
+        return self
+
+    def _init_cubes(self, grid, cubes):
+        self.filename = grid["filename"]
+        self.phenomenon = grid["phenomenon"]
+        self.property_set = grid["property_set"]
+        self.prop = grid["prop"]
+        self.regular = True
+
+        self.dataset = None
+        self._cubes = dict(cubes)
+
+        self.xul, self.yul, self.xlr, self.ylr, self.cellsize_x, self.cellsize_y, self.nr_rows, self.nr_cols = grid["extent"]
+
+        self.ds_timesteps = pd.DatetimeIndex(grid["timesteps"])
+        self.time_axis = TimeAxis(self.ds_timesteps)
+        self.nr_timesteps = len(self.ds_timesteps)
+
     def nr_timeboxes(self):
         """ Returns number fof time boxes in dataset """
         pass
@@ -65,26 +107,18 @@ class EnvFactors(object):
         return self.ds_timesteps
 
     def _nearest_timestep(self, timestep):
-        # First round down to the nearest hour
-        timestep = timestep.replace(second=0, minute=0)
-
-        # Then find the nearest previous timestep
-        # Not super efficient, but should work as first version
-        min_val = 1e31
-        old_min = 1e31
-        ts_val = None
-        for t in self.ds_timesteps:
-            diff = (timestep - t).total_seconds()
-            if diff >= 0:
-                min_val = diff
-                if min_val < old_min:
-                    ts_val = t
-
-        return ts_val
+        """ Returns the latest dataset timestep not after timestep """
+        return self.time_axis.nearest(timestep)
 
     def data(self, timestep, spatial_context, prop):
-        """ Returns spatial dataset for the specific timestep. Currently works for resolutions of hours """
-        area_ts = self.area_propertyset[prop][0].loc[timestep].data
+        """ Returns values of the footprint cells for the specific timestep. Currently works for resolutions of hours """
+        if self.dataset is None:
+            area_ts = self.values(timestep, prop)
+        else:
+            area_ts = self.area_propertyset[prop][0].loc[timestep].data
+
+        if isinstance(spatial_context, Footprint):
+            return spatial_context.gather(area_ts)
 
         # Get extent from the spatial context
         geoTransform = spatial_context.GetGeoTransform()
@@ -110,6 +144,27 @@ class EnvFactors(object):
 
         return res
 
+    def cube(self, prop):
+        """ Returns the cleaned (time, row, col) array of a property """
+        if prop not in self._cubes:
+            area = self.area_propertyset[prop][0].data
+
+            # correct for broken no_data values
+            values = np.where(area < -10, np.nan, area)
+            # correct for some exposure values below 0
+            self._cubes[prop] = np.maximum(0.0, values)
+
+        return self._cubes[prop]
+
+    def release(self, prop):
+        """ Drops the cleaned array of a property, memory-mapped arrays are kept """
+        if self.dataset is not None:
+            self._cubes.pop(prop, None)
+
+    def values(self, timestep, prop):
+        """ Returns the cleaned raster of a property for the specific timestep """
+        return self.cube(prop)[self._timestep_to_timebox_index(timestep)]
+
     def epsg(self):
         """ Returns epsg code of the dataset"""
         pass
@@ -124,4 +179,4 @@ class EnvFactors(object):
 
     def _timestep_to_timebox_index(self, timestep):
         """ Returns the timebox index for specific time step """
-        pass
+        return self.ds_timesteps.get_loc(timestep)
@@ -0,0 +1,98 @@
+import os
+import pathlib
+
+import numpy as np
+
+from .actgen.config import BufferCalculation
+from .cube_cache import dataset_stamp
+
+
+def _convolve(array, kernel):
+    """ Returns the convolution of array and a symmetric kernel, same shape as array """
+    radius_y = kernel.shape[0] // 2
+    radius_x = kernel.shape[1] // 2
+
+    shape = (array.shape[0] + kernel.shape[0] - 1, array.shape[1] + kernel.shape[1] - 1)
+
+    spectrum = np.fft.rfft2(array, shape) * np.fft.rfft2(kernel, shape)
+    full = np.fft.irfft2(spectrum, shape)
+
+    return full[radius_y:radius_y + array.shape[0], radius_x:radius_x + array.shape[1]]
+
+
+def focal_statistics(values, mask):
+    """ Returns NaN aware focal sum and mean of values within a circular mask
+
+    Cells outside the raster count as missing, near the edges the statistics are those of the cells within the raster
+    """
+    valid = ~np.isnan(values)
+    kernel = mask.astype(np.float64)
+
+    count = np.rint(_convolve(valid.astype(np.float64), kernel))
+    focal_sum = _convolve(np.where(valid, values, 0.0).astype(np.float64), kernel)
+
+    # no valid cells in the window, remove FFT round-off
+    focal_sum[count == 0] = 0.0
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        focal_mean = np.where(count > 0, focal_sum / count, np.nan)
+
+    return focal_sum, focal_mean
+
+
+class FocalSurfaces(object):
+    def __init__(self, exposure, filename):
+        """ Focal sum and mean rasters of buffer activities, cached next to the dataset
+
+        Unlike gathering the buffer cells, buffers may extend beyond the raster, see focal_statistics.
+        Each version of the dataset, by modification time and size, has its own cache directory,
+        so rasters other runs may still read are never removed or overwritten
+        """
+        self._exposure = exposure
+
+        stamp = dataset_stamp(filename)
+        version = "unknown" if stamp is None else f"{stamp['mtime_ns']}_{stamp['size']}"
+
+        self.cache_dir = pathlib.Path(filename).with_suffix(".focal") / version
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self._surfaces = {}
+
+    def _path(self, timestep, prop, radius, statistic):
+        return pathlib.Path(self.cache_dir, f"{prop}_{timestep:%Y%m%dT%H%M}_r{radius}_{statistic}.npy")
+
+    def precompute(self, timestep, prop, mask):
+        """ Calculates and stores focal rasters for one property, timestep and buffer radius """
+        radius = mask.shape[0] // 2
+
+        focal_sum, focal_mean = focal_statistics(self._exposure.values(timestep, prop), mask)
+
+        for statistic, raster in (("sum", focal_sum), ("mean", focal_mean)):
+            path = self._path(timestep, prop, radius, statistic)
+            # write to a temporary file first, other runs may use the same cache
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as content:
+                np.save(content, raster)
+            os.replace(tmp_path, path)
+
+    def surface(self, timestep, prop, mask, buff_method):
+        """ Returns focal raster matching the buffer calculation method """
+        if buff_method == BufferCalculation.mean.value:
+            statistic = "mean"
+        elif buff_method == BufferCalculation.sum.value:
+            statistic = "sum"
+        else:
+            raise NotImplementedError
+
+        radius = mask.shape[0] // 2
+        key = (timestep, prop, radius, statistic)
+
+        if key not in self._surfaces:
+            path = self._path(timestep, prop, radius, statistic)
+
+            if not path.exists():
+                self.precompute(timestep, prop, mask)
+
+            self._surfaces[key] = np.load(path, mmap_mode="r")
+
+        return self._surfaces[key]
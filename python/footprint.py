@@ -0,0 +1,131 @@
+import numpy as np
+
+
+def _runs(start, end, position):
+    """ Returns cells of axis parallel runs, in the order (along, across) """
+    first = np.floor(np.minimum(start, end)).astype(np.int64)
+    # GDAL does not burn a run into a cell it only touches by less than 1e-4 pixel
+    length = np.maximum(0, np.floor(np.maximum(start, end) - 1e-4).astype(np.int64) - first + 1)
+    offsets = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length)
+
+    return np.repeat(first, length) + offsets, np.repeat(np.floor(position).astype(np.int64), length)
+
+
+def supercover(px, py):
+    """ Returns row and column indices of all cells touched by a polyline in pixel coordinates,
+    following the GDAL ALL_TOUCHED line burning rules
+
+    Cells a segment passes only in a corner point are left out, except the cell below and right of
+    the corner for segments with a negative slope in pixel coordinates. GDAL decides these cells
+    by rounding and can differ there
+    """
+    x0 = px[:-1]
+    x1 = px[1:]
+    y0 = py[:-1]
+    y1 = py[1:]
+
+    dx = x1 - x0
+    dy = y1 - y0
+
+    # GDAL burns segments within one column or row, or almost axis parallel, as straight runs
+    vertical = (np.floor(x0) == np.floor(x1)) | (np.fabs(dx) < .01)
+    horizontal = ~vertical & ((np.floor(y0) == np.floor(y1)) | (np.fabs(dy) < .01))
+    general = ~vertical & ~horizontal
+
+    # vertical runs are burned in the column of the rightmost end
+    seg = np.nonzero(vertical)[0]
+    run_rows, run_cols = _runs(y0[seg], y1[seg], np.maximum(x0[seg], x1[seg]))
+    rows = [run_rows]
+    cols = [run_cols]
+
+    # horizontal runs are burned in the row of the leftmost end
+    seg = np.nonzero(horizontal)[0]
+    run_cols, run_rows = _runs(x0[seg], x1[seg], np.where(x1[seg] >= x0[seg], y0[seg], y1[seg]))
+    rows.append(run_rows)
+    cols.append(run_cols)
+
+    # general segments burn the cell of the leftmost end
+    seg = np.nonzero(general)[0]
+    left = np.where(x1[seg] >= x0[seg], 0.0, 1.0)
+    rows.append(np.floor(y0[seg] + left * dy[seg]).astype(np.int64))
+    cols.append(np.floor(x0[seg] + left * dx[seg]).astype(np.int64))
+
+    # and the cells of all pieces between two consecutive crossings with a cell boundary
+    params = [np.zeros(len(seg)), np.ones(len(seg))]
+    seg_ids = [seg, seg]
+
+    for axis, (a0, a1) in enumerate(((x0[seg], x1[seg]), (y0[seg], y1[seg]))):
+        first = np.floor(np.minimum(a0, a1)).astype(np.int64) + 1
+        nr_crossings = np.maximum(0, np.ceil(np.maximum(a0, a1)).astype(np.int64) - first)
+        ids = np.repeat(np.arange(len(seg)), nr_crossings)
+        lines = np.repeat(first, nr_crossings) + np.arange(nr_crossings.sum()) - np.repeat(np.cumsum(nr_crossings) - nr_crossings, nr_crossings)
+        params.append((lines - a0[ids]) / (a1 - a0)[ids])
+        seg_ids.append(seg[ids])
+
+        if axis == 0:
+            # segments with a negative slope in pixel coordinates passing exactly through a cell corner
+            # also burn the cell right below that corner
+            crossing_y = y0[seg[ids]] + params[-1] * dy[seg[ids]]
+            corner = (crossing_y == np.floor(crossing_y)) & (dx[seg[ids]] * dy[seg[ids]] < 0)
+            rows.append(crossing_y[corner].astype(np.int64))
+            cols.append(lines[corner])
+
+    params = np.concatenate(params)
+    seg_ids = np.concatenate(seg_ids)
+    order = np.lexsort((params, seg_ids))
+    params = params[order]
+    seg_ids = seg_ids[order]
+
+    piece = (seg_ids[1:] == seg_ids[:-1]) & (params[1:] > params[:-1])
+    middle = (params[1:][piece] + params[:-1][piece]) / 2.0
+    ids = seg_ids[1:][piece]
+    rows.append(np.floor(y0[ids] + middle * dy[ids]).astype(np.int64))
+    cols.append(np.floor(x0[ids] + middle * dx[ids]).astype(np.int64))
+
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+class Footprint(object):
+    __slots__ = ("indices", "weights", "nr_rows", "nr_cols")
+
+    def __init__(self, indices, nr_rows, nr_cols, weights=None):
+        """ Raster cells covered by a spatial context, as flat cell indices of the base grid """
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.nr_rows = int(nr_rows)
+        self.nr_cols = int(nr_cols)
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+
+        assert self.weights is None or self.weights.shape == self.indices.shape
+
+    @classmethod
+    def from_cells(cls, rows, cols, nr_rows, nr_cols, weights=None):
+        """ Returns footprint of row and column indices """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+
+        assert (rows >= 0).all() and (rows < nr_rows).all()
+        assert (cols >= 0).all() and (cols < nr_cols).all()
+
+        return cls(rows * int(nr_cols) + cols, nr_rows, nr_cols, weights)
+
+    def __len__(self):
+        return len(self.indices)
+
+    @property
+    def rows(self):
+        return self.indices // self.nr_cols
+
+    @property
+    def cols(self):
+        return self.indices % self.nr_cols
+
+    def gather(self, values, timesteps=None):
+        """ Returns values of the footprint cells of a (row, col) or (time, row, col) array """
+        assert values.shape[-2:] == (self.nr_rows, self.nr_cols), f"{values.shape} {self.nr_rows} {self.nr_cols}"
+
+        flat = values.reshape(values.shape[:-2] + (-1,))
+
+        if timesteps is None:
+            return flat[..., self.indices]
+
+        return flat[np.asarray(timesteps)[:, np.newaxis], self.indices]
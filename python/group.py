@@ -1,143 +1,261 @@
-from datetime import datetime
+import collections
+import concurrent.futures
+import pathlib
 import sqlite3
 
+import numpy as np
+import pandas as pd
 
-def exposure_per_activity(filename, props):
-    source = sqlite3.connect(filename)
+from .actgen.batch import to_sql
+from .actgen.config import ActivityType
+from .actgen.time_axis import ScheduleTimes
 
-    conection = sqlite3.connect(":memory:")
-    source.backup(conection)
-    source.close()
 
-    conection.execute("DROP TABLE IF EXISTS exp_act")
-    conection.execute("DROP TABLE IF EXISTS exp_day")
+def agent_chunks(agent_ids, nr_chunks):
+    """ Returns (first, last) agent ids of consecutive chunks of sorted agent ids """
+    agent_ids = np.sort(np.asarray(agent_ids))
+    chunks = np.array_split(agent_ids, max(1, min(nr_chunks, len(agent_ids))))
 
-    cols = ", ".join(map(str, [f"{key} REAL" for key in props]))
+    return [(int(chunk[0]), int(chunk[-1])) for chunk in chunks if len(chunk) > 0]
 
-    conection.execute(f'''CREATE TABLE exp_act (
-idx INTEGER PRIMARY KEY,
-agent_id INTEGER NOT NULL,
-act_idx INTEGER NOT NULL,
-duration INTEGER NOT NULL,
-activity_type INTEGER NOT NULL,
-activity_description INTEGER,
-commute_mode INTEGER,
-{cols}
-)
-''')
 
-    conection.execute(f'''CREATE TABLE exp_day (
-agent_id INTEGER PRIMARY KEY,
-{cols}
-)
-''')
+def in_order(submit, chunks, window):
+    """ Yields the results of submit(chunk), a future, in the order of chunks
+
+    A chunk is only submitted when fewer than window are pending, so at most window
+    loaded chunks and results are held at once
+    """
+    pending = collections.deque()
+
+    for chunk in chunks:
+        if len(pending) == window:
+            yield pending.popleft().result()
+
+        pending.append(submit(chunk))
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def _load_exposure(conection, props, agent_min, agent_max):
+    """ Returns schedule times, file1 activities and process splits of the agents in [agent_min, agent_max] """
+    times = ScheduleTimes.read(conection)
+    c = ",".join(map(str, [f"p.{value}" for value in props]))
 
-    start_t = datetime.now()
+    activities = pd.read_sql_query("SELECT agent_id,time_start,time_end,activity_group,activity_index FROM file1 WHERE agent_id BETWEEN ? AND ? ORDER BY agent_id,activity_id", conection, params=(agent_min, agent_max))
 
-    for agents in conection.execute("SELECT DISTINCT agent_id FROM file1"):
-        agent_id = agents[0]
+    query = f"""SELECT p.time_start,p.time_end,p.activity_group,p.activity_index,p.activity_description,ra.travel_descr,{c}
+FROM process p
+LEFT JOIN route_activities ra ON p.activity_group={ActivityType.route.value} AND ra.activity_index=p.activity_index
+WHERE p.agent_id BETWEEN ? AND ?
+ORDER BY p.activity_id"""
+    splits = pd.read_sql_query(query, conection, params=(agent_min, agent_max))
 
-        a = ",".join(map(str, [f"{value}=?" for value in props]))
-        b = [f"{value}" for value in props]
-        c = ",".join(map(str, [f"{value}" for value in props]))
-        d = ", ".join(map(str, ["?" for value in props]))
+    return times, activities, splits
 
-        act_cnt = 0
 
-        day_value = {}
-        for p in props:
-            day_value[p] = 0
+def _exposure_rows(props, times, activities, splits):
+    """ Returns exp_act and exp_day rows of loaded activities and splits
 
-        for activities in conection.execute("SELECT time_start,time_end FROM file1 WHERE agent_id=?", (agent_id,)):
-            agent_id = agents[0]
+    Splits in process are weighted by their duration in whole minutes and summed per file1
+    activity and per agent, a NULL split makes the activity and the day value NULL
+    """
+    if len(activities) == 0:
+        return [], []
 
-            act_start = activities[0]
-            act_end = activities[1]
-            act_delta = datetime.fromisoformat(act_end) - datetime.fromisoformat(act_start)
-            act_delta_minutes = int(act_delta.total_seconds() / 60)
-            query = f"SELECT time_start,time_end,activity_group,activity_index,activity_description,{c} FROM process WHERE agent_id=? AND time_start>=? AND time_end<=?"
-            query_tuple = []
-            query_tuple.append(agent_id)
-            query_tuple.append(act_start)
-            query_tuple.append(act_end)
+    # file1 activity of each split, activity indices are unique per activity group
+    nr_groups = ActivityType.route.value + 1
+    act_keys = activities["activity_index"].values.astype(np.int64) * nr_groups + activities["activity_group"].values
+    split_keys = splits["activity_index"].values.astype(np.int64) * nr_groups + splits["activity_group"].values
 
-            act_value = {}
-            act_value["agent_id"] = agent_id
-            act_value["act_idx"] = act_cnt
-            act_cnt += 1
-            act_value["duration"] = act_delta_minutes
+    order = np.argsort(act_keys, kind="stable")
+    pos = np.minimum(np.searchsorted(act_keys[order], split_keys), len(order) - 1)
+    found = act_keys[order][pos] == split_keys
+    splits = splits[found]
+    split_act = order[pos[found]]
 
-            for p in props:
-                act_value[p] = 0
+    nr_activities = len(activities)
+    assert np.bincount(split_act, minlength=nr_activities).all(), "activities without splits in process"
 
-            for split in conection.execute(query, tuple(query_tuple)):
-                split_start = split[0]
-                split_end = split[1]
-                activity_group = split[2]
-                activity_index = split[3]
+    act_minutes = times.minutes(activities["time_start"].values, activities["time_end"].values)
+    assert (act_minutes > 0).all(), f"activities shorter than a minute of agents {np.unique(activities['agent_id'].values[act_minutes <= 0])[:10]}"
+    split_minutes = times.minutes(splits["time_start"].values, splits["time_end"].values)
 
-                route_descr_val = None
-                if activity_group == 3:
-                    cur = conection.cursor()
-                    cur.execute("SELECT travel_descr FROM route_activities WHERE activity_index=?", (activity_index,))
-                    route_descr_val = cur.fetchone()[0]
+    agents, act_agent = np.unique(activities["agent_id"].values, return_inverse=True)
+    act_agent = act_agent.reshape(-1)
+    split_agent = act_agent[split_act]
 
-                activity_description = split[4]
-                act_value["type"] = activity_group
-                act_value["descr"] = activity_description
-                act_value["commute_mode"] = route_descr_val
+    # position of the activity within the schedule of its agent
+    first = np.searchsorted(act_agent, np.arange(len(agents)))
+    act_idx = np.arange(nr_activities) - first[act_agent]
 
-                if activity_group == 3:
+    # type and description of the last split of each activity
+    last = np.zeros(nr_activities, dtype=np.int64)
+    np.maximum.at(last, split_act, np.arange(len(splits)))
 
-                    act_value["descr"] = route_descr_val
-                    act_value["commute_mode"] = activity_description
+    act_type = splits["activity_group"].values[last]
+    description = splits["activity_description"].values[last]
+    travel_descr = splits["travel_descr"].values[last]
 
-                split_delta = datetime.fromisoformat(split_end) - datetime.fromisoformat(split_start)
-                split_delta_minutes = int(split_delta.total_seconds() / 60)
+    route = act_type == ActivityType.route.value
+    descr = np.where(route, travel_descr, description)
+    commute_mode = np.where(route, description, travel_descr)
 
-                for idx, p in enumerate(props):
-                    value = None
-                    value = split[5 + idx]
-                    if value is not None:
-                        if act_value[p] is not None:
-                            act_value[p] += value * split_delta_minutes
-                        if day_value[p] is not None:
-                            day_value[p] += value * split_delta_minutes
-                    else:
-                        act_value[p] = None
-                        day_value[p] = None
+    act_columns = [activities["agent_id"].tolist(), act_idx.tolist(), act_minutes.tolist(), act_type.tolist(), to_sql(descr, int), to_sql(commute_mode, int)]
+    day_columns = [agents.tolist()]
 
-            for p in props:
-                if act_value[p] is not None:
-                    act_value[p] /= act_delta_minutes
+    for p in props:
+        values = splits[p].values.astype(np.float64)
+        missing = np.isnan(values)
+        weighted = np.where(missing, 0.0, values * split_minutes)
+
+        act_value = np.bincount(split_act, weights=weighted, minlength=nr_activities)
+        act_missing = np.bincount(split_act, weights=missing, minlength=nr_activities) > 0
+        day_value = np.bincount(split_agent, weights=weighted, minlength=len(agents))
+        day_missing = np.bincount(split_agent, weights=missing, minlength=len(agents)) > 0
+
+        act_value = act_value / act_minutes
+        day_value = day_value / 1440
+
+        act_value[act_missing] = np.nan
+        day_value[day_missing] = np.nan
+
+        act_columns.append(to_sql(act_value, float))
+        day_columns.append(to_sql(day_value, float))
+
+    return list(zip(*act_columns)), list(zip(*day_columns))
+
+
+def _exposure_chunk(filename, props, agent_min, agent_max):
+    """ Returns exp_act and exp_day rows of the agents in [agent_min, agent_max] """
+    conection = sqlite3.connect(f"file:{filename}?mode=ro", uri=True)
+    rows = _exposure_rows(props, *_load_exposure(conection, props, agent_min, agent_max))
+    conection.close()
 
-            insert_query = f"INSERT INTO exp_act(agent_id,act_idx,duration,activity_type,activity_description,commute_mode,{c}) VALUES (?, ?, ?, ?, ?, ?, {d})"
-            insert_values = [act_value["agent_id"], act_value["act_idx"], act_value["duration"], act_value["type"], act_value["descr"], act_value["commute_mode"]]
+    return rows
 
-            for p in props:
-                insert_values.append(act_value[p])
 
-            conection.execute(insert_query, insert_values)
+# row ids renumbered when appending a chunk, not referenced by other tables
+_renumbered = {"file1": "activity_id", "process": "activity_id", "exp_act": "idx"}
 
-        for p in props:
-            if day_value[p] is not None:
-                day_value[p] /= 1440
 
-        insert_query = f"INSERT INTO exp_day(agent_id,{c}) VALUES (?, {d})"
-        insert_values = [act_value["agent_id"]]
+def append_database(conection, filename):
+    """ Appends the rows of the tables to the database filename with the same tables """
+    tables = [row[0] for row in conection.execute("SELECT name FROM main.sqlite_master WHERE type='table' AND name!='metadata'")]
 
-        for p in props:
-            insert_values.append(day_value[p])
+    conection.execute("ATTACH DATABASE ? AS dest", (str(filename),))
 
-        conection.execute(insert_query, insert_values)
+    for table in tables:
+        key = _renumbered.get(table)
+        c = ",".join([row[1] for row in conection.execute(f"PRAGMA main.table_info({table})") if row[1] != key])
+
+        conection.execute(f"INSERT INTO dest.{table}({c}) SELECT {c} FROM main.{table} ORDER BY {key or 'rowid'}")
+
+    conection.commit()
+    conection.execute("DETACH DATABASE dest")
+
+
+def exposure_per_activity(filename, props, workers=1, chunk_agents=100000, connection=None, append=False, executor=None):
+    """ Adds exp_act and exp_day to the schedule database filename
+
+    With a connection, the tables are added to that in-memory database of the pipeline,
+    which is then written compacted to filename, or appended to it, and closed.
+    With workers > 1 the process pool executor is used when given, so that several calls share it
+    """
+    if connection is None:
+        source = sqlite3.connect(filename)
+
+        conection = sqlite3.connect(":memory:")
+        source.backup(conection)
+        source.close()
+    else:
+        conection = connection
+
+    conection.execute("DROP TABLE IF EXISTS exp_act")
+    conection.execute("DROP TABLE IF EXISTS exp_day")
+
+    cols = ", ".join(map(str, [f"{key} REAL" for key in props]))
+
+    conection.execute(f'''CREATE TABLE exp_act (
+idx INTEGER PRIMARY KEY,
+agent_id INTEGER NOT NULL,
+act_idx INTEGER NOT NULL,
+duration INTEGER NOT NULL,
+activity_type INTEGER NOT NULL,
+activity_description INTEGER,
+commute_mode INTEGER,
+{cols}
+)
+''')
+
+    conection.execute(f'''CREATE TABLE exp_day (
+agent_id INTEGER PRIMARY KEY,
+{cols}
+)
+''')
+
+    c = ",".join(map(str, [f"{value}" for value in props]))
+    d = ", ".join(map(str, ["?" for value in props]))
+
+    act_query = f"INSERT INTO exp_act(agent_id,act_idx,duration,activity_type,activity_description,commute_mode,{c}) VALUES (?, ?, ?, ?, ?, ?, {d})"
+    day_query = f"INSERT INTO exp_day(agent_id,{c}) VALUES (?, {d})"
+
+    agent_ids = [row[0] for row in conection.execute("SELECT DISTINCT agent_id FROM file1 ORDER BY agent_id")]
+
+    if workers > 1:
+        chunks = agent_chunks(agent_ids, 4 * workers)
+
+        if connection is None:
+            source = pathlib.Path(filename)
+        else:
+            # workers query a snapshot of the in-memory database
+            source = pathlib.Path(filename).with_name(f"{pathlib.Path(filename).stem}_aggregate.sqlite3")
+            source.unlink(missing_ok=True)
+
+            snapshot = sqlite3.connect(source)
+            with snapshot:
+                conection.backup(snapshot)
+            snapshot.close()
+
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if executor is None else executor
+
+        try:
+            def submit(chunk):
+                return pool.submit(_exposure_chunk, str(source), props, *chunk)
+
+            # merge in chunk order, independent of completion order, one chunk queued
+            # besides those being aggregated
+            for act_rows, day_rows in in_order(submit, chunks, workers + 1):
+                conection.executemany(act_query, act_rows)
+                conection.executemany(day_query, day_rows)
+        finally:
+            if executor is None:
+                pool.shutdown()
+
+            if connection is not None:
+                source.unlink(missing_ok=True)
+    else:
+        # bounded number of agents in memory at once
+        for agent_min, agent_max in agent_chunks(agent_ids, -(-len(agent_ids) // chunk_agents)):
+            act_rows, day_rows = _exposure_rows(props, *_load_exposure(conection, props, agent_min, agent_max))
+            conection.executemany(act_query, act_rows)
+            conection.executemany(day_query, day_rows)
 
     conection.execute("CREATE INDEX exp_act_ixd ON exp_act (agent_id)")
     conection.execute("CREATE INDEX exp_day_ixd ON exp_day (agent_id)")
     conection.commit()
 
-    dest = sqlite3.connect(filename)
+    if connection is None:
+        dest = sqlite3.connect(filename)
+
+        with dest:
+            conection.backup(dest)
+        dest.close()
+    elif append:
+        append_database(conection, filename)
+    else:
+        # single compacted copy, replaces the separate VACUUM of the file
+        pathlib.Path(filename).unlink(missing_ok=True)
+        conection.execute("VACUUM INTO ?", (str(filename),))
 
-    with dest:
-        conection.backup(dest)
-    dest.close()
     conection.close()
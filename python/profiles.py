@@ -1,3 +1,4 @@
+import concurrent.futures
 import datetime
 import logging
 import sqlite3
@@ -6,7 +7,9 @@ import subprocess
 import shlex
 
 from python.calc_model import ExposureCalculator
-import python.routing as mar
+from python.route_cache import RouteCache
+from python.routing_backend import routing_backend
+import python.actgen as ag
 
 from .group import exposure_per_activity
 
@@ -14,7 +17,7 @@ import config
 
 
 class Profile(object):
-    def __init__(self, rng, realisation, od_matrix=None):
+    def __init__(self, rng, realisation, od_matrix=None, workers=1):
 
         self.name = None
         self.name_r = None
@@ -32,13 +35,24 @@ class Profile(object):
 
         self.logger = None
 
-        self.routing_engine = mar.Routing(config.osrm_car, config.osrm_bike, config.osrm_foot, config.osrm_train)
+        # shared by the stages, engines are loaded on first use
+        self.routing_engine = routing_backend()
+        self.route_cache = RouteCache(config.route_cache, source=self.routing_engine.source())
 
         self.rng = rng
         self.realisation = realisation
 
         self.od_matrixid = od_matrix
 
+        # number of processes used for enrichment and aggregation
+        self.workers = workers
+
+        # open schedule database of the in-memory pipeline, None when the stages exchange files
+        self.connection = None
+
+        # enrichment of the run, the pollutant dataset is loaded once
+        self.exposure = None
+
     def init(self, name):
 
         self.name = name
@@ -78,9 +92,23 @@ class Profile(object):
         self.t_end = end
         self.t_delta = delta
 
+        # exposure timesteps at which activities are split, the time axis of the pollutant
+        # dataset (ExposureCalculator.time_axis), hourly if not given
+        if cuts is None:
+            self.t_cuts = ag.TimeAxis.regular(start, end)
+        elif isinstance(cuts, ag.TimeAxis):
+            self.t_cuts = cuts
+        else:
+            self.t_cuts = ag.TimeAxis(cuts)
+
+        # split would put the periods outside the axis in its first or last timestep
+        if not self.t_cuts.covers(start, end):
+            raise ValueError(f"schedules {start} - {end} outside the exposure timesteps {self.t_cuts.timesteps[0]} - {self.t_cuts.end}")
+
         self.logger.info(f"Profile start {self.t_start}")
         self.logger.info(f"Profile end   {self.t_end}")
         self.logger.info(f"Profile delta {self.t_delta}")
+        self.logger.info(f"Profile cuts  {len(self.t_cuts)} timesteps until {self.t_cuts.end}")
 
     def _init_home_locations(self, building_locations):
 
@@ -116,25 +144,46 @@ class Profile(object):
         start = datetime.datetime.now()
         self.construct()
 
-        # routing_engine
-        self.routing_engine = mar.Routing(config.osrm_car, config.osrm_bike, config.osrm_foot, config.osrm_train)
         end = datetime.datetime.now()
         self.logger.info(f"generating schedules took:    {end - start}")
 
+    def new_schedules(self):
+        """ Returns empty Schedules of the profile """
+        return ag.Schedules(self.name_r, self.t_start, self.t_end, self.t_delta, self.exposure_variables(), self.t_cuts)
+
+    def construct(self):
+        schedules = self.new_schedules()
+        self.construct_agents(schedules, self.building_connection.execute(self.home_query).fetchall())
+        self.connection = schedules.commit()
+
+    def construct_agents(self, schedules, homes):
+        """ Adds the schedules of the agents of home location rows """
+        pass
+
     def exposure_variables(self):
         pass
 
+    def exposure_calculator(self, poll_filename, props, epsg):
+        """ Returns the ExposureCalculator of the run, created on first use """
+        if self.exposure is None:
+            self.exposure = ExposureCalculator(poll_filename, props, epsg, self.logger, self.routing_engine, self.route_cache)
+
+        # the schedules are split at the timesteps the activities are enriched with
+        assert self.t_cuts is None or self.exposure.time_axis == self.t_cuts, "schedule cuts differ from the timesteps of the pollutant dataset"
+
+        return self.exposure
+
     def enrich_schedules(self, poll_filename, props, epsg):
         self.logger.info("")
         start = datetime.datetime.now()
 
-        exp = ExposureCalculator(poll_filename, props, epsg, self.logger, self.routing_engine)
+        exp = self.exposure_calculator(poll_filename, props, epsg)
 
-        exp.calc_schedule(f'{self.name_r}')
-        self.routing_engine = mar.Routing(config.osrm_car, config.osrm_bike, config.osrm_foot, config.osrm_train)
+        exp.calc_schedule(f'{self.name_r}', self.workers, self.connection)
 
         end = datetime.datetime.now()
         self.logger.info(f"enrich schedules took:        {end - start}")
+        self.logger.info(f"route cache hits/misses:      {self.route_cache.hits}/{self.route_cache.misses}")
 
     def aggregate(self, props):
         self.logger.info("")
@@ -142,12 +191,65 @@ class Profile(object):
         start = datetime.datetime.now()
         path = pathlib.Path(config.output_dir, f"{self.name_r}.sqlite3")
 
-        exposure_per_activity(path, props)
+        exposure_per_activity(path, props, self.workers, connection=self.connection)
         end = datetime.datetime.now()
         self.logger.info(f"exposure per activity took:   {end - start}")
 
-        command = f"sqlite3 {path} 'VACUUM;'"
-        subprocess.run(shlex.split(command), check=True)
+        if self.connection is None:
+            command = f"sqlite3 {path} 'VACUUM;'"
+            subprocess.run(shlex.split(command), check=True)
+
+        # written and closed by exposure_per_activity
+        self.connection = None
+
+    def stream(self, poll_filename, props, epsg, chunk_agents):
+        """ Generates, enriches and aggregates chunks of chunk_agents agents, appending each to the output
+
+        Memory use depends on the chunk size instead of the number of agents
+        """
+        self.logger.info("")
+        start = datetime.datetime.now()
+
+        path = pathlib.Path(config.output_dir, f"{self.name_r}.sqlite3")
+        path.unlink(missing_ok=True)
+
+        schedules = self.new_schedules()
+        exp = self.exposure_calculator(poll_filename, props, epsg)
+
+        homes = self.building_connection.execute(self.home_query)
+        count = 0
+
+        # one pool of enrichment workers for all chunks, the pollutant arrays are shared or loaded once
+        if config.batch_enrichment and self.workers > 1:
+            exp.start_workers(self.workers)
+
+        # and one pool of aggregation workers
+        aggregation = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+
+        try:
+            while True:
+                rows = homes.fetchmany(chunk_agents)
+
+                if len(rows) == 0:
+                    break
+
+                self.construct_agents(schedules, rows)
+                connection = schedules.commit_chunk()
+
+                exp.calc_schedule(f'{self.name_r}', self.workers, connection)
+                exposure_per_activity(path, props, self.workers, connection=connection, append=count > 0, executor=aggregation)
+
+                count += len(rows)
+                self.logger.info(f"chunk of {len(rows)} agents, {count}/{self.nr_home_locations} done {datetime.datetime.now()}")
+        finally:
+            exp.stop_workers()
+
+            if aggregation is not None:
+                aggregation.shutdown()
+
+        end = datetime.datetime.now()
+        self.logger.info(f"streaming pipeline took:      {end - start}")
+        self.logger.info(f"route cache hits/misses:      {self.route_cache.hits}/{self.route_cache.misses}")
 
     def commute_distance(self, start_ll_x, start_ll_y, end_ll_x, end_ll_y, osrm_mode):
         return self.routing_engine.distance(start_ll_x, start_ll_y, end_ll_x, end_ll_y, osrm_mode)
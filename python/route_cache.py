@@ -0,0 +1,317 @@
+import collections
+import pathlib
+import sqlite3
+
+import numpy as np
+
+from .actgen.config import CommuteType
+from .footprint import Footprint
+
+
+def osrm_mode(travel_mode):
+    """ Returns the routing engine mode of a CommuteType value """
+    import python.routing as mar
+
+    if travel_mode == CommuteType.bike.value:
+        return mar.Bike
+    elif travel_mode == CommuteType.car.value:
+        return mar.Car
+    elif travel_mode == CommuteType.train.value:
+        return mar.Train
+    elif travel_mode == CommuteType.foot.value:
+        return mar.Foot
+    else:
+        raise NotImplementedError
+
+
+class RouteCache(object):
+    _distance_query = "SELECT distance,duration FROM routes WHERE x1=? AND y1=? AND x2=? AND y2=? AND travel_type=?"
+    _footprint_query = "SELECT cells FROM footprints WHERE x1=? AND y1=? AND x2=? AND y2=? AND travel_type=? AND grid=?"
+    _distance_insert = "INSERT OR IGNORE INTO routes(x1,y1,x2,y2,travel_type,distance,duration) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    _footprint_insert = "INSERT OR IGNORE INTO footprints(x1,y1,x2,y2,travel_type,grid,cells) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, filename=None, maxsize=65536, symmetric=(CommuteType.foot.value,), round_digits=6, source=None, readonly=False):
+        """ Routes keyed by rounded WGS84 endpoints and CommuteType, in memory and optionally on disk
+
+        source identifies the routing data, routes stored for other routing data or another rounding are removed.
+        A readonly cache, as used by worker processes, only reads the file, its new routes are kept
+        until take_pending hands them to the process writing the file
+        """
+        self.readonly = readonly
+        self.maxsize = maxsize
+        self.symmetric = set(symmetric)
+        self.scale = 10 ** round_digits
+
+        self._distances = collections.OrderedDict()
+        self._footprints = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+        # routes of single lookups are written in one transaction per commit_rows rows
+        self.commit_rows = 1000
+        self._pending_distances = []
+        self._pending_footprints = []
+
+        self.db_con = None
+
+        if filename is not None and readonly:
+            if pathlib.Path(filename).exists():
+                self.db_con = sqlite3.connect(f"file:{filename}?mode=ro", uri=True, timeout=60)
+        elif filename is not None:
+            pathlib.Path(filename).parent.mkdir(parents=True, exist_ok=True)
+            self.db_con = sqlite3.connect(filename, timeout=60)
+            self.db_con.execute("pragma journal_mode=wal")
+            self.db_con.execute("pragma synchronous=normal")
+
+            self.db_con.execute('''CREATE TABLE IF NOT EXISTS routes (
+x1 INTEGER NOT NULL,
+y1 INTEGER NOT NULL,
+x2 INTEGER NOT NULL,
+y2 INTEGER NOT NULL,
+travel_type INTEGER NOT NULL,
+distance REAL NOT NULL,
+duration REAL NOT NULL,
+PRIMARY KEY (x1, y1, x2, y2, travel_type)
+)
+''')
+
+            self.db_con.execute('''CREATE TABLE IF NOT EXISTS footprints (
+x1 INTEGER NOT NULL,
+y1 INTEGER NOT NULL,
+x2 INTEGER NOT NULL,
+y2 INTEGER NOT NULL,
+travel_type INTEGER NOT NULL,
+grid TEXT NOT NULL,
+cells BLOB NOT NULL,
+PRIMARY KEY (x1, y1, x2, y2, travel_type, grid)
+)
+''')
+
+            self.db_con.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+
+            expected = {"round_digits": str(round_digits)}
+            if source is not None:
+                expected["source"] = source
+
+            stored = dict(self.db_con.execute("SELECT key,value FROM metadata").fetchall())
+
+            if any(stored.get(key) != value for key, value in expected.items()):
+                self.db_con.execute("DELETE FROM routes")
+                self.db_con.execute("DELETE FROM footprints")
+                self.db_con.executemany("INSERT OR REPLACE INTO metadata(key, value) VALUES (?, ?)", expected.items())
+
+            self.db_con.commit()
+
+    def _key(self, x1, y1, x2, y2, travel_mode):
+        return (round(x1 * self.scale), round(y1 * self.scale), round(x2 * self.scale), round(y2 * self.scale), int(travel_mode))
+
+    def _keys(self, x1, y1, x2, y2, travel_mode):
+        """ Returns lookup keys, including the reverse direction on symmetric networks """
+        key = self._key(x1, y1, x2, y2, travel_mode)
+
+        if travel_mode in self.symmetric:
+            return key, (key[2], key[3], key[0], key[1], key[4])
+
+        return key, None
+
+    def _remember(self, lru, key, value):
+        lru[key] = value
+        lru.move_to_end(key)
+
+        if len(lru) > self.maxsize:
+            lru.popitem(last=False)
+
+    def _lookup(self, lru, keys, query):
+        for key in keys:
+            if key is None:
+                continue
+
+            if key in lru:
+                lru.move_to_end(key)
+                return lru[key]
+
+            if self.db_con is not None:
+                row = self.db_con.execute(query, key).fetchone()
+                if row is not None:
+                    return row
+
+        return None
+
+    def distance(self, routing_engine, x1, y1, x2, y2, travel_mode):
+        """ Returns distance and duration of the route between two WGS84 coordinates """
+        keys = self._keys(x1, y1, x2, y2, travel_mode)
+
+        res = self._lookup(self._distances, keys, self._distance_query)
+
+        if res is None:
+            self.misses += 1
+            res = self._route_distances(routing_engine, [(x1, y1, x2, y2, travel_mode)])[0]
+
+            self._pending_distances.append(keys[0] + tuple(res))
+            self._flush_pending()
+        else:
+            self.hits += 1
+
+        res = tuple(res)
+        self._remember(self._distances, keys[0], res)
+
+        return res
+
+    def distances(self, routing_engine, x1, y1, x2, y2, travel_modes):
+        """ Returns arrays of distance and duration of the routes between arrays of WGS84 coordinates
+
+        Routes missing in the cache are routed once per key and stored in one transaction
+        """
+        pairs = list(zip(*[np.asarray(values).tolist() for values in (x1, y1, x2, y2, travel_modes)]))
+        res = np.zeros((len(pairs), 2))
+
+        # positions in pairs of each missing route
+        missing = collections.OrderedDict()
+
+        for idx, pair in enumerate(pairs):
+            keys = self._keys(*pair)
+            found = self._lookup(self._distances, keys, self._distance_query)
+
+            if found is None:
+                missing.setdefault(keys[0], (pair, []))[1].append(idx)
+            else:
+                self.hits += 1
+                res[idx] = found
+                self._remember(self._distances, keys[0], tuple(found))
+
+        routed = self._route_distances(routing_engine, [pair for pair, positions in missing.values()])
+
+        for (key, (pair, positions)), values in zip(missing.items(), routed):
+            self.misses += 1
+            self.hits += len(positions) - 1
+            res[positions] = values
+            self._remember(self._distances, key, tuple(values))
+
+        self._pending_distances.extend(key + tuple(values) for key, values in zip(missing.keys(), routed))
+        self.flush()
+
+        return res[:, 0], res[:, 1]
+
+    def _route_distances(self, routing_engine, pairs):
+        """ Returns distance and duration of each (x1, y1, x2, y2, travel_mode), in one batch for a routing backend """
+        if hasattr(routing_engine, "distances"):
+            return routing_engine.distances(pairs)
+
+        return [routing_engine.distance(x1, y1, x2, y2, osrm_mode(travel_mode)) for x1, y1, x2, y2, travel_mode in pairs]
+
+    def _route_points(self, routing_engine, pairs):
+        """ Returns route points of each (x1, y1, x2, y2, travel_mode), in one batch for a routing backend """
+        if hasattr(routing_engine, "routes"):
+            return routing_engine.routes(pairs)
+
+        return [routing_engine.route(x1, y1, x2, y2, osrm_mode(travel_mode)) for x1, y1, x2, y2, travel_mode in pairs]
+
+    def footprints(self, routing_engine, pairs, grid, rasterize):
+        """ Returns the rasterised route of each (x1, y1, x2, y2, travel_mode)
+
+        Routes missing in the cache are routed together and stored in one transaction
+        """
+        grid_id, nr_rows, nr_cols = grid
+        res = [None] * len(pairs)
+
+        # positions in pairs of each missing route
+        missing = collections.OrderedDict()
+
+        for idx, pair in enumerate(pairs):
+            keys = self._keys(*pair)
+            lru_keys = tuple(None if key is None else key + (grid_id,) for key in keys)
+            found = self._lookup(self._footprints, lru_keys, self._footprint_query)
+
+            if found is None:
+                missing.setdefault(lru_keys[0], (pair, []))[1].append(idx)
+            else:
+                self.hits += 1
+
+                if not isinstance(found, Footprint):
+                    found = Footprint(np.frombuffer(found[0], dtype=np.int64), nr_rows, nr_cols)
+
+                res[idx] = found
+                self._remember(self._footprints, lru_keys[0], found)
+
+        routed = [rasterize(points) for points in self._route_points(routing_engine, [pair for pair, positions in missing.values()])]
+
+        for (key, (pair, positions)), footprint in zip(missing.items(), routed):
+            self.misses += 1
+            self.hits += len(positions) - 1
+
+            for idx in positions:
+                res[idx] = footprint
+            self._remember(self._footprints, key, footprint)
+
+        self._pending_footprints.extend(key + (footprint.indices.tobytes(),) for key, footprint in zip(missing.keys(), routed))
+        self.flush()
+
+        return res
+
+    def footprint(self, routing_engine, x1, y1, x2, y2, travel_mode, grid, rasterize):
+        """ Returns the rasterised route between two WGS84 coordinates
+
+        grid identifies the base grid, rasterize turns the route points into a Footprint
+        """
+        keys = self._keys(x1, y1, x2, y2, travel_mode)
+        grid_id, nr_rows, nr_cols = grid
+
+        lru_keys = tuple(None if key is None else key + (grid_id,) for key in keys)
+        res = self._lookup(self._footprints, lru_keys, self._footprint_query)
+
+        if res is None:
+            self.misses += 1
+            points = self._route_points(routing_engine, [(x1, y1, x2, y2, travel_mode)])[0]
+            res = rasterize(points)
+
+            self._pending_footprints.append(lru_keys[0] + (res.indices.tobytes(),))
+            self._flush_pending()
+        else:
+            self.hits += 1
+
+            if not isinstance(res, Footprint):
+                res = Footprint(np.frombuffer(res[0], dtype=np.int64), nr_rows, nr_cols)
+
+        self._remember(self._footprints, lru_keys[0], res)
+
+        return res
+
+    def _flush_pending(self):
+        if len(self._pending_distances) + len(self._pending_footprints) >= self.commit_rows:
+            self.flush()
+
+    def take_pending(self):
+        """ Returns and forgets the distance and footprint rows not stored yet """
+        res = (self._pending_distances, self._pending_footprints)
+
+        self._pending_distances = []
+        self._pending_footprints = []
+
+        return res
+
+    def store(self, distances, footprints):
+        """ Writes distance and footprint rows of take_pending of another cache """
+        self._pending_distances.extend(distances)
+        self._pending_footprints.extend(footprints)
+        self.flush()
+
+    def flush(self):
+        """ Writes the routes not stored yet in one transaction, a readonly cache keeps them """
+        if self.readonly:
+            return
+
+        if self.db_con is not None and len(self._pending_distances) + len(self._pending_footprints) > 0:
+            self.db_con.executemany(self._distance_insert, self._pending_distances)
+            self.db_con.executemany(self._footprint_insert, self._pending_footprints)
+            self.db_con.commit()
+
+        self._pending_distances = []
+        self._pending_footprints = []
+
+    def close(self):
+        self.flush()
+
+        if self.db_con is not None:
+            self.db_con.close()
+            self.db_con = None
@@ -0,0 +1,287 @@
+import concurrent.futures
+import contextlib
+import http.client
+import json
+import math
+import os
+import pathlib
+import queue
+import threading
+import urllib.parse
+
+import numpy as np
+
+from .actgen.config import CommuteType
+from .route_cache import osrm_mode
+
+import config
+
+
+class RoutingBackend(object):
+    def __init__(self, threads=1):
+        """ Routes between WGS84 coordinates, one pair at a time or as batches of pairs
+
+        Pairs are (x1, y1, x2, y2, travel_mode) with travel_mode a CommuteType value, distances
+        in metres and durations in minutes. distance and route take routing engine modes, so
+        a backend can be used wherever a python.routing.Routing engine is
+        """
+        self.threads = threads
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _map(self, function, pairs):
+        """ Returns function applied to each pair, in a pool of threads for more than one pair """
+        if self.threads <= 1 or len(pairs) <= 1:
+            return [function(*pair) for pair in pairs]
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+
+        return list(self._executor.map(lambda pair: function(*pair), pairs))
+
+    def distance(self, x1, y1, x2, y2, routing_mode):
+        return self.distances([(x1, y1, x2, y2, travel_mode(routing_mode))])[0]
+
+    def route(self, x1, y1, x2, y2, routing_mode):
+        return self.routes([(x1, y1, x2, y2, travel_mode(routing_mode))])[0]
+
+    def distances(self, pairs):
+        """ Returns (distance, duration) of each pair """
+        raise NotImplementedError
+
+    def routes(self, pairs):
+        """ Returns the (lon, lat) points of the route of each pair """
+        raise NotImplementedError
+
+    def source(self):
+        """ Returns text identifying the routing data, cached routes of other routing data are not used """
+        raise NotImplementedError
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+class EngineBackend(RoutingBackend):
+    def __init__(self, threads=1, engines=1):
+        """ In-process OSRM engines, loaded on first use and shared by the threads
+
+        Each engine holds the datasets of all travel modes in memory, at most engines are
+        loaded per process and batches are routed by as many threads
+        """
+        RoutingBackend.__init__(self, min(threads, engines))
+        self.engines = engines
+        self._idle = queue.Queue()
+        self._loaded = 0
+
+    @contextlib.contextmanager
+    def engine(self):
+        """ Returns an engine for exclusive use by the calling thread """
+        try:
+            engine = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                load = self._loaded < self.engines
+                if load:
+                    self._loaded += 1
+
+            if load:
+                import python.routing as mar
+
+                engine = mar.Routing(config.osrm_car, config.osrm_bike, config.osrm_foot, config.osrm_train)
+            else:
+                engine = self._idle.get()
+
+        try:
+            yield engine
+        finally:
+            self._idle.put(engine)
+
+    def source(self):
+        # modification time and size of the files of each dataset
+        stamps = {}
+        for filename in (config.osrm_car, config.osrm_bike, config.osrm_foot, config.osrm_train):
+            path = pathlib.Path(filename)
+            files = [stat for stat in (item.stat() for item in path.parent.glob(f"{path.name}*")) if stat.st_size > 0]
+            stamps[filename] = [max((stat.st_mtime_ns for stat in files), default=0), sum(stat.st_size for stat in files)]
+
+        return json.dumps({"engine": stamps}, sort_keys=True)
+
+    def _distance(self, x1, y1, x2, y2, mode):
+        with self.engine() as engine:
+            return tuple(engine.distance(x1, y1, x2, y2, osrm_mode(mode)))
+
+    def _route(self, x1, y1, x2, y2, mode):
+        with self.engine() as engine:
+            return engine.route(x1, y1, x2, y2, osrm_mode(mode))
+
+    def distances(self, pairs):
+        return self._map(self._distance, pairs)
+
+    def routes(self, pairs):
+        return self._map(self._route, pairs)
+
+
+class HttpBackend(RoutingBackend):
+    # OSRM profile in the request paths by CommuteType, osrm-routed serves its own dataset whatever
+    # the profile, the server of each mode in osrm_urls selects the network
+    profiles = {CommuteType.car.value: "driving", CommuteType.bike.value: "cycling", CommuteType.foot.value: "walking", CommuteType.train.value: "train"}
+
+    def __init__(self, urls, threads=1, table_size=100):
+        """ osrm-routed servers by CommuteType name, durations from the table service, one connection per thread and server """
+        RoutingBackend.__init__(self, threads)
+        self.urls = {CommuteType[name].value: urllib.parse.urlsplit(url) for name, url in urls.items()}
+        # destinations per table request
+        self.table_size = table_size
+        self._local = threading.local()
+
+    def source(self):
+        return json.dumps({"http": {mode: url.geturl() for mode, url in self.urls.items()}}, sort_keys=True)
+
+    def _get(self, mode, path):
+        """ Returns the decoded response of a request to the server of a mode """
+        url = self.urls[mode]
+
+        if not hasattr(self._local, "connections"):
+            self._local.connections = {}
+        if mode not in self._local.connections:
+            self._local.connections[mode] = http.client.HTTPConnection(url.netloc, timeout=60)
+
+        connection = self._local.connections[mode]
+
+        try:
+            connection.request("GET", f"{url.path.rstrip('/')}{path}")
+            response = json.loads(connection.getresponse().read())
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            raise
+
+        assert response["code"] == "Ok", response
+
+        return response
+
+    def _table(self, mode, pairs):
+        """ Returns (distance, duration) of pairs of one mode and source, from a table of the source and their unique destinations
+
+        Unreachable destinations give NaN
+        """
+        x1, y1 = pairs[0][:2]
+        destinations = list(dict.fromkeys((x2, y2) for _, _, x2, y2, _ in pairs))
+
+        coordinates = ";".join(f"{x},{y}" for x, y in [(x1, y1)] + destinations)
+        destination_idx = ";".join(map(str, range(1, len(destinations) + 1)))
+
+        response = self._get(mode, f"/table/v1/{self.profiles[mode]}/{coordinates}?sources=0&destinations={destination_idx}&annotations=distance,duration")
+
+        destination_pos = {point: idx for idx, point in enumerate(destinations)}
+
+        res = []
+        for _, _, x2, y2, _ in pairs:
+            distance = response["distances"][0][destination_pos[(x2, y2)]]
+            duration = response["durations"][0][destination_pos[(x2, y2)]]
+            res.append((math.nan, math.nan) if duration is None else (distance, duration / 60))
+
+        return res
+
+    def _route(self, x1, y1, x2, y2, mode):
+        response = self._get(mode, f"/route/v1/{self.profiles[mode]}/{x1},{y1};{x2},{y2}?overview=full&geometries=geojson")
+
+        return response["routes"][0]["geometry"]["coordinates"]
+
+    def distances(self, pairs):
+        res = [None] * len(pairs)
+
+        # one table request per mode, source and block of destinations, a table of all sources
+        # and destinations of a batch would mostly hold pairs that are not asked for
+        groups = {}
+        for idx, (x1, y1, _, _, mode) in enumerate(pairs):
+            groups.setdefault((mode, x1, y1), []).append(idx)
+
+        blocks = []
+        for (mode, _, _), positions in groups.items():
+            blocks.extend((mode, positions[first:first + self.table_size]) for first in range(0, len(positions), self.table_size))
+
+        tables = self._map(lambda mode, positions: self._table(mode, [pairs[idx] for idx in positions]), blocks)
+
+        for (mode, positions), values in zip(blocks, tables):
+            for idx, value in zip(positions, values):
+                res[idx] = value
+
+        return res
+
+    def routes(self, pairs):
+        return self._map(self._route, pairs)
+
+
+class StubBackend(RoutingBackend):
+    # detour factor and speed in km/h by CommuteType
+    detour = 1.3
+    speeds = {CommuteType.car.value: 60, CommuteType.bike.value: 15, CommuteType.foot.value: 5, CommuteType.train.value: 90}
+
+    def __init__(self, threads=1):
+        """ Straight line routes without a routing engine, for tests """
+        RoutingBackend.__init__(self, threads)
+
+    def source(self):
+        return json.dumps({"stub": [self.detour, self.speeds]}, sort_keys=True)
+
+    def _distance(self, x1, y1, x2, y2, mode):
+        # equirectangular approximation
+        x = math.radians(x2 - x1) * math.cos(math.radians((y1 + y2) / 2))
+        y = math.radians(y2 - y1)
+        distance = self.detour * 6371000 * math.hypot(x, y)
+
+        return distance, distance / (self.speeds[mode] * 1000 / 60)
+
+    def distances(self, pairs):
+        return [self._distance(*pair) for pair in pairs]
+
+    def routes(self, pairs):
+        return [np.column_stack((np.linspace(x1, x2, 11), np.linspace(y1, y2, 11))).tolist() for x1, y1, x2, y2, _ in pairs]
+
+
+def travel_mode(routing_mode):
+    """ Returns the CommuteType value of a routing engine mode """
+    import python.routing as mar
+
+    modes = {mar.Car: CommuteType.car.value, mar.Bike: CommuteType.bike.value, mar.Foot: CommuteType.foot.value, mar.Train: CommuteType.train.value}
+
+    return modes[routing_mode]
+
+
+# backend of this process, created on first use
+_backend = None
+
+
+def _close_executor():
+    if _backend is not None:
+        _backend.close()
+
+
+def _forget_backend():
+    global _backend
+    _backend = None
+
+
+# threads, engines and connections are not inherited by forked worker processes,
+# the pool threads are stopped before forking and restarted on first use
+os.register_at_fork(before=_close_executor, after_in_child=_forget_backend)
+
+
+def routing_backend():
+    """ Returns the routing backend of config.routing_backend, shared within a process """
+    global _backend
+
+    if _backend is None:
+        if config.routing_backend == "engine":
+            _backend = EngineBackend(config.routing_threads, config.routing_engines)
+        elif config.routing_backend == "http":
+            _backend = HttpBackend(config.osrm_urls, config.routing_threads)
+        elif config.routing_backend == "stub":
+            _backend = StubBackend()
+        else:
+            raise NotImplementedError(config.routing_backend)
+
+    return _backend
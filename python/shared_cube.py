@@ -0,0 +1,55 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .factors import EnvFactors
+
+
+class SharedCube(object):
+    def __init__(self, exposure, props):
+        """ Copies the cleaned property arrays of an EnvFactors instance into shared memory """
+        self._blocks = []
+
+        self.descriptor = {"grid": exposure.grid(), "props": {}}
+
+        for prop in props:
+            cube = exposure.cube(prop)
+
+            block = shared_memory.SharedMemory(create=True, size=max(1, cube.nbytes))
+            shared = np.ndarray(cube.shape, dtype=cube.dtype, buffer=block.buf)
+            shared[...] = cube
+            del shared
+
+            self._blocks.append(block)
+            self.descriptor["props"][prop] = (block.name, cube.shape, cube.dtype.str)
+
+            # the loader keeps no private copy
+            exposure.release(prop)
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+
+        self._blocks = []
+
+
+def attach(descriptor):
+    """ Returns EnvFactors instance using the shared arrays read-only, without copying """
+    blocks = []
+    cubes = {}
+
+    for prop, (name, shape, dtype) in descriptor["props"].items():
+        block = shared_memory.SharedMemory(name=name)
+
+        cube = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        cube.flags.writeable = False
+
+        blocks.append(block)
+        cubes[prop] = cube
+
+    exposure = EnvFactors.from_cubes(descriptor["grid"], cubes)
+    # keep the blocks mapped as long as the arrays are in use
+    exposure._blocks = blocks
+
+    return exposure
@@ -3,18 +3,18 @@ import numpy as np
 
 from osgeo import gdal, osr
 
-import python.routing as mar
-
-from python.actgen.config import CommuteType
+from python.footprint import Footprint, supercover
+from python.route_cache import osrm_mode
 
 
 gdal.UseExceptions()
 
 
 class SpatialContext(object):
-    def __init__(self, routing_engine, geotransform, epsg):
+    def __init__(self, routing_engine, geotransform, epsg, route_cache=None):
         self.round_digits = 4
         self.r = routing_engine
+        self.route_cache = route_cache
 
         self.epsg = epsg
         self.proj = osr.SpatialReference()
@@ -28,17 +28,18 @@ class SpatialContext(object):
         self.cellsize = round(geotransform[4], self.round_digits)
         self.cellsize_y = round(geotransform[5], self.round_digits)
 
-        self.nr_rows = geotransform[6]
-        self.nr_cols = geotransform[7]
+        self.nr_rows = int(geotransform[6])
+        self.nr_cols = int(geotransform[7])
+
+        # identifies the base grid of cached route footprints
+        self.grid = (f"{self.min_x}_{self.max_y}_{self.cellsize}_{self.cellsize_y}_{self.nr_rows}_{self.nr_cols}", self.nr_rows, self.nr_cols)
 
-        # options for reprojecting the WGS84 route to the target CRS
-        self.vectortranslateoptions = gdal.VectorTranslateOptions(
-            format="MEMORY",
-            srcSRS="EPSG:4326",
-            dstSRS=self.proj,
-            reproject=True,
-            layers="route"
-        )
+        # transformation of WGS84 route coordinates (lon, lat) to the target CRS
+        wgs84 = osr.SpatialReference()
+        wgs84.ImportFromEPSG(4326)
+        wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self.proj.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self.transformation = osr.CoordinateTransformation(wgs84, self.proj)
 
     def _coord_to_rc(self, xcoord, ycoord):
         assert xcoord >= self.min_x, f"{xcoord} / {self.min_x}"
@@ -91,60 +92,77 @@ class SpatialContext(object):
 
         return new_min_x, new_max_x, new_min_y, new_max_y, int(new_nr_rows), int(new_nr_cols)
 
-    def point(self, xcoord, ycoord, crs=None):
-        """ Spatial context of a point coordinate
+    def buffer_mask(self, buffer_size):
+        """ Returns circular mask of a buffer, centered on the middle cell
         """
-        if crs is not None:
-            raise NotImplementedError
+        bsize_cells, remainder = divmod(math.fabs(buffer_size / self.cellsize), 1)
+        bsize_cells = int(bsize_cells)
 
-        return self.buffer(xcoord, ycoord, 0, crs)
+        y, x = np.ogrid[-bsize_cells: bsize_cells + 1, -bsize_cells: bsize_cells + 1]
+        mask = x * x + y * y <= bsize_cells * bsize_cells
 
-    def buffer(self, xcoord, ycoord, buffer_size, crs=None):
-        """ Returns spatial context and mask of a buffered coordinate
+        return mask
+
+    def cells(self, xcoords, ycoords):
+        """ Returns row and column indices of the raster cells containing the coordinates
+        """
+        xcoords = np.asarray(xcoords, dtype=np.float64)
+        ycoords = np.asarray(ycoords, dtype=np.float64)
+
+        assert (xcoords >= self.min_x).all(), f"{xcoords.min()} / {self.min_x}"
+        assert (xcoords <= self.max_x).all(), f"{xcoords.max()} / {self.max_x}"
+        assert (ycoords >= self.min_y).all(), f"{ycoords.min()} / {self.min_y}"
+        assert (ycoords <= self.max_y).all(), f"{ycoords.max()} / {self.max_y}"
+
+        rows = ((ycoords - self.max_y) / -self.cellsize_y).astype(np.int64)
+        cols = ((xcoords - self.min_x) / self.cellsize).astype(np.int64)
+
+        assert (rows >= 0).all() and (rows < self.nr_rows).all()
+        assert (cols >= 0).all() and (cols < self.nr_cols).all()
+
+        return rows, cols
+
+    def buffer_offsets(self, buffer_size):
+        """ Returns row and column offsets of the cells within a circular buffer
         """
         assert buffer_size >= 0
 
-        if crs is not None:
-            raise NotImplementedError
+        mask = self.buffer_mask(buffer_size)
+        radius = (mask.shape[0] - 1) // 2
+        row_offsets, col_offsets = np.nonzero(mask)
 
-        bsize_cells = ""
-
-        if buffer_size == 0:
-            # Spatial context of a point coordinate (ie return raster cell)
-            env_minX = xcoord - self.cellsize / 2.0
-            env_maxX = xcoord + self.cellsize / 2.0
-            env_minY = ycoord - self.cellsize / 2.0
-            env_maxY = ycoord + self.cellsize / 2.0
-            rows = 1
-            cols = 1
-            env_minX, env_maxX, env_minY, env_maxY, rows, cols = self._snap(xcoord, xcoord, ycoord, ycoord)
-            assert rows == 1
-            assert cols == 1
-            array = np.ones((rows, cols), dtype=np.int32)
-        else:
-            # Spatial context of a buffer
-            bsize, remainder = divmod(buffer_size, self.cellsize)
-            env_minX, env_maxX, env_minY, env_maxY, rows, cols = self._snap(xcoord, xcoord, ycoord, ycoord)
+        return row_offsets - radius, col_offsets - radius
+
+    def _dataset_footprint(self, dataset):
+        """ Returns footprint of the cells with value 1 in a dataset matched to the base grid
+        """
+        geoTransform = dataset.GetGeoTransform()
+
+        row_idx = round((self.max_y - geoTransform[3]) / self.cellsize_y)
+        col_idx = round((geoTransform[0] - self.min_x) / self.cellsize)
 
-            # Create buffer mask
-            bsize_cells, remainder = divmod(math.fabs(buffer_size / self.cellsize), 1)
-            bsize_cells = int(bsize_cells)
+        rows, cols = np.nonzero(dataset.ReadAsArray() == 1)
 
-            assert rows == cols
+        return Footprint.from_cells(rows + row_idx, cols + col_idx, self.nr_rows, self.nr_cols)
+
+    def to_dataset(self, footprint):
+        """ Returns GDAL dataset of the bounding box of a footprint, for debugging or export
+        """
+        rows = footprint.rows
+        cols = footprint.cols
 
-            y, x = np.ogrid[-bsize_cells: bsize_cells + 1, -bsize_cells: bsize_cells + 1]
-            mask = x * x + y * y <= bsize_cells * bsize_cells
-            array = mask.astype(np.int32)
+        row_min = int(rows.min())
+        col_min = int(cols.min())
+        nr_rows = int(rows.max()) - row_min + 1
+        nr_cols = int(cols.max()) - col_min + 1
 
-            # Correct extent
-            rows, cols = array.shape
-            multiplier = (rows - 1) / 2
-            env_minX = env_minX - multiplier * self.cellsize
-            env_maxX = env_maxX + multiplier * self.cellsize
-            env_minY = env_minY - multiplier * self.cellsize
-            env_maxY = env_maxY + multiplier * self.cellsize
+        array = np.zeros((nr_rows, nr_cols), dtype=np.uint8)
+        array[rows - row_min, cols - col_min] = 1
 
-        target_ds = gdal.GetDriverByName('MEM').Create('', xsize=cols, ysize=rows, bands=1, eType=gdal.GDT_Byte)
+        env_minX = round(self.min_x + self.cellsize * col_min, self.round_digits)
+        env_maxY = round(self.max_y - self.cellsize_y * row_min, self.round_digits)
+
+        target_ds = gdal.GetDriverByName('MEM').Create('', xsize=nr_cols, ysize=nr_rows, bands=1, eType=gdal.GDT_Byte)
         target_ds.SetGeoTransform((env_minX, self.cellsize, 0, env_maxY, 0, -self.cellsize_y))
         target_ds.SetProjection(self.proj.ExportToWkt())
 
@@ -154,63 +172,82 @@ class SpatialContext(object):
 
         return target_ds
 
+    def point(self, xcoord, ycoord, crs=None):
+        """ Spatial context of a point coordinate
+        """
+        if crs is not None:
+            raise NotImplementedError
+
+        return self.buffer(xcoord, ycoord, 0, crs)
+
+    def buffer(self, xcoord, ycoord, buffer_size, crs=None):
+        """ Returns footprint of a buffered coordinate
+        """
+        assert buffer_size >= 0
+
+        if crs is not None:
+            raise NotImplementedError
+
+        rows, cols = self.cells([xcoord], [ycoord])
+        row_offsets, col_offsets = self.buffer_offsets(buffer_size)
+
+        return Footprint.from_cells(rows[0] + row_offsets, cols[0] + col_offsets, self.nr_rows, self.nr_cols)
+
     def route(self, xcoord1, ycoord1, xcoord2, ycoord2, travel_mode, crs=None):
-        """ Returns rasterised route, matched to a base grid
+        """ Returns footprint of the rasterised route, matched to a base grid
         """
         if crs is None:
             raise NotImplementedError
         else:
             assert crs == 4326
 
-        if travel_mode == CommuteType.bike.value:
-            travel_type = mar.Bike
-        elif travel_mode == CommuteType.car.value:
-            travel_type = mar.Car
-        elif travel_mode == CommuteType.train.value:
-            travel_type = mar.Train
-        elif travel_mode == CommuteType.foot.value:
-            travel_type = mar.Foot
+        if self.route_cache is not None:
+            return self.route_cache.footprint(self.r, xcoord1, ycoord1, xcoord2, ycoord2, travel_mode, self.grid, self._route_footprint)
+
+        if hasattr(self.r, "routes"):
+            points = self.r.routes([(xcoord1, ycoord1, xcoord2, ycoord2, travel_mode)])[0]
         else:
+            points = self.r.route(xcoord1, ycoord1, xcoord2, ycoord2, osrm_mode(travel_mode))
+
+        return self._route_footprint(points)
+
+    def routes(self, xcoords1, ycoords1, xcoords2, ycoords2, travel_modes, crs=None):
+        """ Returns footprints of the rasterised routes of arrays of coordinates, routed as one batch
+        """
+        if crs is None:
             raise NotImplementedError
+        else:
+            assert crs == 4326
 
-        points = self.r.route(xcoord1, ycoord1, xcoord2, ycoord2, travel_type)
-
-        coordinates = str(points)
-        coordinates = coordinates.replace("(", "[")
-        coordinates = coordinates.replace(")", "]")
-
-        # Make coordinate list suitable for GDAL
-        content = \
-            """{
-"type": "FeatureCollection",
-"name": "route",
-"features": [
-{ "type": "Feature", "properties": { }, "geometry":
-{ "type": "LineString", "coordinates":""" +\
-            "{}".format(coordinates) +\
-            """ } }
-]
-}
-"""
-
-        # Route to GDAL dataset, route is in wgs84
-        ds = gdal.OpenEx(content)
-        assert ds is not None, 'Failed to open datasource'
-
-        # Reproject route to the target CRS
-        mem_ds = gdal.VectorTranslate("", ds, options=self.vectortranslateoptions)
-
-        # Determine target raster extent, start with current extent
-        dst_layer = mem_ds.GetLayer()
-        source_feature = dst_layer.GetNextFeature()
-        env = source_feature.GetGeometryRef().GetEnvelope()
-        env_minX, env_maxX, env_minY, env_maxY, rows, cols = self._snap(env[0], env[1], env[2], env[3])
-
-        # Burn route into the raster
-        target_ds = gdal.GetDriverByName('MEM').Create('', xsize=cols, ysize=rows, bands=1, eType=gdal.GDT_Byte)
-        target_ds.SetGeoTransform((env_minX, self.cellsize, 0, env_maxY, 0, -self.cellsize))
-        target_ds.SetProjection(self.proj.ExportToWkt())
+        pairs = list(zip(*[np.asarray(values).tolist() for values in (xcoords1, ycoords1, xcoords2, ycoords2, travel_modes)]))
 
-        gdal.RasterizeLayer(target_ds, [1], dst_layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
+        if self.route_cache is not None:
+            return self.route_cache.footprints(self.r, pairs, self.grid, self._route_footprint)
 
-        return target_ds
+        if hasattr(self.r, "routes"):
+            return [self._route_footprint(points) for points in self.r.routes(pairs)]
+
+        return [self.route(*pair, crs) for pair in pairs]
+
+    def _route_footprint(self, points):
+        """ Returns footprint of a WGS84 route, all touched cells of the base grid
+        """
+        coordinates = np.asarray(self.transformation.TransformPoints(np.asarray(points, dtype=np.float64)[:, 0:2]))
+
+        xcoords = coordinates[:, 0]
+        ycoords = coordinates[:, 1]
+
+        # only for validating the route extent
+        self._snap(xcoords.min(), xcoords.max(), ycoords.min(), ycoords.max())
+
+        px = (xcoords - self.min_x) / self.cellsize
+        py = (self.max_y - ycoords) / self.cellsize_y
+
+        rows, cols = supercover(px, py)
+
+        assert (rows >= 0).all() and (rows < self.nr_rows).all()
+        assert (cols >= 0).all() and (cols < self.nr_cols).all()
+
+        indices = np.unique(rows * self.nr_cols + cols)
+
+        return Footprint(indices, self.nr_rows, self.nr_cols)
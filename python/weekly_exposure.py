@@ -1,7 +1,4 @@
-import copy
-import csv
-import sys
-import math
+import json
 import sqlite3
 import pathlib
 
@@ -10,201 +7,297 @@ import numpy as np
 import pandas as pd
 
 
+def read_exp_day(fname, agent_ids=None, cache=None):
+    """ Returns agent ids, exposure column names and (agents, columns) values of exp_day, NULL as NaN
+
+    Rows are aligned with agent_ids when given, sorted by agent id otherwise.
+    Tables are kept in cache, a dict by filename, when given
+    """
+    if cache is not None and fname in cache:
+        day_ids, names, values = cache[fname]
+    else:
+        source = sqlite3.connect(f"file:{fname}?mode=ro", uri=True)
+        data = pd.read_sql_query("SELECT * FROM exp_day", source)
+        source.close()
+
+        day_ids = data.iloc[:, 0].to_numpy(dtype=np.int64)
+        names = list(data.columns[1:])
+        values = data.iloc[:, 1:].to_numpy(dtype=np.float64)
+
+        if cache is not None:
+            cache[fname] = (day_ids, names, values)
+
+    if agent_ids is None:
+        agent_ids = np.sort(day_ids)
+
+    order = np.argsort(day_ids)
+    pos = np.minimum(np.searchsorted(day_ids, agent_ids, sorter=order), len(order) - 1)
+    rows = order[pos]
+
+    assert (day_ids[rows] == agent_ids).all(), f"agents missing in {fname}"
+
+    return agent_ids, names, values[rows]
+
+
+class Accumulator(object):
+    def __init__(self, nr_agents):
+        """ Running count, mean, sum of squared deviations, min and max per agent """
+        self.count = np.zeros(nr_agents, dtype=np.int64)
+        self.mean = np.zeros(nr_agents)
+        self.m2 = np.zeros(nr_agents)
+        self.min = np.full(nr_agents, np.inf)
+        self.max = np.full(nr_agents, -np.inf)
+
+    def add(self, values):
+        """ Folds in the values of one realisation, NaN makes the statistics of an agent NaN """
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+        self.min = np.minimum(self.min, values)
+        self.max = np.maximum(self.max, values)
+
+    def var(self):
+        return self.m2 / self.count
+
+    def std(self):
+        return np.sqrt(self.var())
+
+
 class Weekly(object):
-    def __init__(self, directory, filename, realisations, combine, output_path):
+    # tables of the exp_day columns 1, 2 and 3
+    pollutants = ("no2", "pm25", "noise")
+    # agent_id index of each table, the names of the former outputs
+    indices = {"no2": "no2_agent_ixd", "pm25": "pm25_agent_ixd", "noise": "no2_agent_ixd2"}
 
+    def __init__(self, directory, filename, realisations, combine, output_path, run=True):
+        """ Combines daily exposures into weekly exposures per realisation
+
+        Realisations in an existing output are kept, only later ones are added.
+        Without run, do_realisation and finish are left to the caller
+        """
         self.directory = directory
         self.db_con = sqlite3.connect(":memory:")
         self.combine = combine
 
         self.out_path = pathlib.Path(output_path, f"{filename}.sqlite3")
-        if self.out_path.exists():
-            return
 
-        self._init_db(realisations)
+        self._init_db()
+
+        self.new_realisations = range(self.nr_realisations + 1, realisations + 1)
+
+        # (agents, realisations) matrix per pollutant of the added realisations
+        self.values = {pollutant: np.full((len(self.agent_ids), len(self.new_realisations)), np.nan) for pollutant in self.pollutants}
+
+        if run:
+            # exp_day of profiles without realisations is read once
+            cache = {}
+            fixed = self.fixed_files()
+
+            for idx in self.new_realisations:
+                self.do_realisation(idx, cache)
+                cache = {fname: data for fname, data in cache.items() if fname in fixed}
+
+            self.finish()
 
-        for idx in range(1, realisations + 1):
-            self.do_realisation(idx)
+    def finish(self):
+        """ Calculates the statistics and writes the output, if realisations were added """
+        if len(self.new_realisations) > 0:
+            for pollutant in self.pollutants:
+                self.stats(pollutant)
 
-        self.stats("no2")
-        self.stats("pm25")
-        self.stats("noise")
+            self.nr_realisations = self.new_realisations[-1]
 
-        self.db_con.commit()
+            self.db_con.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+            self.db_con.execute("INSERT OR REPLACE INTO metadata(key, value) VALUES ('source', ?)", (self._source(),))
+            self.db_con.commit()
 
-        dest = sqlite3.connect(self.out_path)
+            dest = sqlite3.connect(self.out_path)
+
+            with dest:
+                self.db_con.backup(dest)
+            dest.close()
 
-        with dest:
-            self.db_con.backup(dest)
-        dest.close()
         self.db_con.close()
 
-    def _init_db(self, nr_realisations):
+    def fixed_files(self):
+        """ Returns the databases of the combined profiles without realisations """
+        return {pathlib.Path(self.directory, f"{item[1]}_1.sqlite3") for item in self.combine if not item[2]}
+
+    def _source(self):
+        """ Returns the combined profiles and pollutants of the output as JSON """
+        combine = [[float(item[0]), str(item[1]), bool(item[2])] for item in self.combine]
+
+        return json.dumps({"combine": combine, "pollutants": list(self.pollutants)})
 
-        realisations = range(1, nr_realisations + 1)
-        columns = ",".join(map("R{} REAL".format, realisations))
+    def _stored_source(self):
+        """ Returns the combined profiles and pollutants stored in the output, None in older outputs """
+        exists = self.db_con.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='metadata'").fetchone()[0]
+        if not exists:
+            return None
 
-        cmd = f"""CREATE TABLE no2 (
-agent_id INTEGER PRIMARY KEY,
-{columns},
-mean REAL,
-std REAL,
-var REAL,
-min REAL,
-max REAL
-)"""
-        self.db_con.execute(cmd)
+        stored = self.db_con.execute("SELECT value FROM metadata WHERE key='source'").fetchone()
 
-        in_path = pathlib.Path(self.directory, f"{self.combine[0][1]}_1.sqlite3")
-        assert in_path.exists(), in_path
+        return None if stored is None else stored[0]
 
-        agents = sqlite3.connect(in_path)
+    def _init_db(self):
+
+        if self.out_path.exists():
+            source = sqlite3.connect(self.out_path)
+            source.backup(self.db_con)
+            source.close()
 
-        for row in agents.execute('SELECT DISTINCT agent_id FROM file1'):
-            self.db_con.execute("INSERT INTO no2(agent_id) VALUES (?)", row)
+            # realisations are only added to an output of the same combination, outputs
+            # written before the combination was stored are resumed as they are
+            stored = self._stored_source()
+            assert stored is None or stored == self._source(), f"{self.out_path} combines other profiles or pollutants, remove it to recompute"
 
-        self.db_con.execute("CREATE INDEX no2_agent_ixd ON no2 (agent_id)")
+            self.agent_ids = np.array(self.db_con.execute(f"SELECT agent_id FROM {self.pollutants[0]} ORDER BY agent_id").fetchall(), dtype=np.int64).reshape(-1)
 
-        cmd = f"""CREATE TABLE pm25 (
-agent_id INTEGER PRIMARY KEY,
-{columns},
-mean REAL,
-std REAL,
-var REAL,
-min REAL,
-max REAL
-)"""
-        self.db_con.execute(cmd)
+            columns = [row[1] for row in self.db_con.execute(f"PRAGMA table_info({self.pollutants[0]})")]
+            self.nr_realisations = len([column for column in columns if column.startswith("R")])
 
-        agents = sqlite3.connect(in_path)
+            self.accumulators = {pollutant: self._load_accumulator(pollutant) for pollutant in self.pollutants}
+        else:
+            in_path = pathlib.Path(self.directory, f"{self.combine[0][1]}_1.sqlite3")
+            assert in_path.exists(), in_path
 
-        for row in agents.execute('SELECT DISTINCT agent_id FROM file1'):
-            self.db_con.execute("INSERT INTO pm25(agent_id) VALUES (?)", row)
+            agents = sqlite3.connect(in_path)
+            self.agent_ids = np.unique(np.array(agents.execute('SELECT DISTINCT agent_id FROM file1').fetchall(), dtype=np.int64).reshape(-1))
+            agents.close()
 
-        self.db_con.execute("CREATE INDEX pm25_agent_ixd ON pm25 (agent_id)")
+            self.nr_realisations = 0
 
-        cmd = f"""CREATE TABLE noise (
-agent_id INTEGER PRIMARY KEY,
-{columns},
-mean REAL,
-std REAL,
-var REAL,
-min REAL,
-max REAL
-)"""
-        self.db_con.execute(cmd)
+            self.accumulators = {pollutant: Accumulator(len(self.agent_ids)) for pollutant in self.pollutants}
 
-        agents = sqlite3.connect(in_path)
+    def _realisation_values(self, pollutant):
+        """ Returns (agents, realisations) matrix of the realisations in the output """
+        if self.nr_realisations == 0:
+            return np.zeros((len(self.agent_ids), 0))
 
-        for row in agents.execute('SELECT DISTINCT agent_id FROM file1'):
-            self.db_con.execute("INSERT INTO noise(agent_id) VALUES (?)", row)
+        columns = ",".join(map("R{}".format, range(1, self.nr_realisations + 1)))
+        rows = self.db_con.execute(f"SELECT {columns} FROM {pollutant} ORDER BY agent_id").fetchall()
 
-        self.db_con.execute("CREATE INDEX no2_agent_ixd2 ON noise (agent_id)")
+        return np.array(rows, dtype=np.float64).reshape(len(self.agent_ids), self.nr_realisations)
 
-        self.db_con.commit()
+    def _load_accumulator(self, pollutant):
+        """ Returns the stored accumulator, or one folded from the realisation columns of older outputs """
+        accumulator = Accumulator(len(self.agent_ids))
+
+        exists = self.db_con.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?", (f"{pollutant}_acc",)).fetchone()[0]
+
+        if exists:
+            data = pd.read_sql_query(f"SELECT count,mean,m2,min,max FROM {pollutant}_acc ORDER BY agent_id", self.db_con)
+            accumulator.count = np.array(data["count"], dtype=np.int64)
+            accumulator.mean = np.array(data["mean"], dtype=np.float64)
+            accumulator.m2 = np.array(data["m2"], dtype=np.float64)
+            accumulator.min = np.array(data["min"], dtype=np.float64)
+            accumulator.max = np.array(data["max"], dtype=np.float64)
+        else:
+            for values in self._realisation_values(pollutant).T:
+                accumulator.add(values)
+
+        return accumulator
 
     def to_db(self, val):
-        return 10 * math.log10(val)
+        """ Returns val in decibel, NaN stays NaN """
+        assert not (val <= 0).any(), "noise levels of zero or less have no decibel value"
+
+        return 10 * np.log10(val)
+
+    def exp_day(self, fname, cache=None):
+        """ Returns the exposure columns of exp_day as (agents, pollutants) array aligned with the agents, NULL as NaN """
+        return read_exp_day(fname, self.agent_ids, cache)[2][:, :len(self.pollutants)]
 
-    def do_realisation(self, idx):
+    def do_realisation(self, idx, cache=None):
 
-        databases = []
+        combined = np.zeros((len(self.agent_ids), len(self.pollutants)))
+        sum_factor = 0
 
+        # get the agent values from the realisation databases
         for item in self.combine:
+            factor = item[0]
+
             if item[2]:
                 fname = pathlib.Path(self.directory, f"{item[1]}_{idx:d}.sqlite3")
             else:
                 fname = pathlib.Path(self.directory, f"{item[1]}_1.sqlite3")
 
             assert fname.exists(), fname
+            values = self.exp_day(fname, cache)
 
-            source = sqlite3.connect(fname)
-
-            tmp_conection = sqlite3.connect(":memory:")
-            source.backup(tmp_conection)
-            source.close()
-
-            databases.append(tmp_conection)
-
-        col_name = f"R{idx}"
+            # NULL in any of the profiles gives NULL
+            combined += factor * values
+            sum_factor += factor
 
-        count = 1
+        combined /= sum_factor
 
-        for row in self.db_con.execute('SELECT DISTINCT agent_id FROM no2'):
+        for column, pollutant in enumerate(self.pollutants):
+            res = combined[:, column]
 
-            count += 1
+            if pollutant == "noise":
+                res = self.to_db(res)
 
-            agent_id = row[0]
+            self.values[pollutant][:, idx - self.nr_realisations - 1] = res
 
-            no2_value = 0
-            pm25_value = 0
-            noise_value = 0
-            sum_factor = 0
+    def _write_table(self, table, columns, data):
+        """ Writes agent rows of data columns, a list of (name, type), to a table, NaN as NULL
 
-            # get the agent values from the realisation databases
-            for idx, item in enumerate(self.combine):
-                factor = self.combine[idx][0]
-                cur = databases[idx].cursor()
-                cur.execute("SELECT * FROM exp_day WHERE agent_id=?", row)
-                values = cur.fetchone()
-                exp_1 = values[1]
-                exp_2 = values[2]
-                exp_3 = values[3]
+        Columns missing in an existing table are added, only the given columns are written
+        """
+        data = np.column_stack(data)
+        rows = data.astype(object)
+        rows[np.isnan(data)] = None
 
-                if no2_value is not None and exp_1 is not None:
-                    no2_value += factor * exp_1
-                else:
-                    no2_value = None
+        existing = [row[1] for row in self.db_con.execute(f"PRAGMA table_info({table})")]
 
-                if pm25_value is not None and exp_2 is not None:
-                    pm25_value += factor * exp_2
-                else:
-                    pm25_value = None
+        if len(existing) == 0:
+            definitions = ",\n".join(f"{name} {sql_type}" for name, sql_type in columns)
+            self.db_con.execute(f"CREATE TABLE {table} (\nagent_id INTEGER PRIMARY KEY,\n{definitions}\n)")
 
-                if noise_value is not None and exp_3 is not None:
-                    noise_value += factor * exp_3
-                else:
-                    noise_value = None
+            marks = ", ".join(["?"] * (data.shape[1] + 1))
+            self.db_con.executemany(f"INSERT INTO {table} VALUES ({marks})", [(agent_id, *row) for agent_id, row in zip(self.agent_ids.tolist(), rows.tolist())])
+            self.db_con.execute(f"CREATE INDEX {self.indices.get(table, f'{table}_agent_ixd')} ON {table} (agent_id)")
+        else:
+            for name, sql_type in columns:
+                if name not in existing:
+                    self.db_con.execute(f"ALTER TABLE {table} ADD COLUMN {name} {sql_type}")
 
-                sum_factor += factor
+            assignments = ",".join(f"{name}=?" for name, _ in columns)
+            self.db_con.executemany(f"UPDATE {table} SET {assignments} WHERE agent_id=?", [(*row, agent_id) for agent_id, row in zip(self.agent_ids.tolist(), rows.tolist())])
 
-            if no2_value is not None:
-                no2_value /= sum_factor
-            else:
-                no2_value = "NULL"
+    def stats(self, pollutant):
+        """ Adds the realisation columns of the new realisations and writes the statistics of all """
+        accumulator = self.accumulators[pollutant]
 
-            if pm25_value is not None:
-                pm25_value /= sum_factor
-            else:
-                pm25_value = "NULL"
+        for values in self.values[pollutant].T:
+            accumulator.add(values)
 
-            if noise_value is not None:
-                noise_value /= sum_factor
-                noise_value = self.to_db(noise_value)
-            else:
-                noise_value = "NULL"
+        realisations = [(f"R{idx}", "REAL") for idx in self.new_realisations]
+        statistics = [(name, "REAL") for name in ("mean", "std", "var", "min", "max")]
 
-            no2 = f"UPDATE no2 SET {col_name}={no2_value} WHERE agent_id={agent_id}"
-            pm25 = f"UPDATE pm25 SET {col_name}={pm25_value} WHERE agent_id={agent_id}"
-            noise = f"UPDATE noise SET {col_name}={noise_value} WHERE agent_id={agent_id}"
+        self._write_table(pollutant, realisations + statistics, [self.values[pollutant], accumulator.mean, accumulator.std(), accumulator.var(), accumulator.min, accumulator.max])
 
-            self.db_con.execute(no2)
-            self.db_con.execute(pm25)
-            self.db_con.execute(noise)
+        columns = [("count", "INTEGER"), ("mean", "REAL"), ("m2", "REAL"), ("min", "REAL"), ("max", "REAL")]
+        self._write_table(f"{pollutant}_acc", columns, [accumulator.count, accumulator.mean, accumulator.m2, accumulator.min, accumulator.max])
 
-        for d in databases:
-            d.close()
+def weekly_exposures(directory, targets, realisations, output_path):
+    """ Combines daily exposures into several weekly outputs, reading each realisation database once
 
-    def stats(self, pollutant):
+    targets is a list of (filename, combine) of the outputs
+    """
+    weeklies = [Weekly(directory, filename, realisations, combine, output_path, run=False) for filename, combine in targets]
+    fixed = set().union(*[weekly.fixed_files() for weekly in weeklies])
 
-        for row in self.db_con.execute(f'SELECT * FROM {pollutant}'):
-            agent_id = row[0]
+    cache = {}
 
-            db_values = row[1:len(row) - 5]
-            db_values = [np.nan if x == None else x for x in db_values]
-            values = np.array(db_values)
+    for idx in range(1, realisations + 1):
+        for weekly in weeklies:
+            if idx in weekly.new_realisations:
+                weekly.do_realisation(idx, cache)
 
-            updates = (np.mean(values), np.std(values), np.var(values), np.min(values), np.max(values), agent_id)
-            query = f"UPDATE {pollutant} SET mean=?,std=?,var=?,min=?,max=? WHERE agent_id=?"
+        # keep the profiles without realisations only
+        cache = {fname: data for fname, data in cache.items() if fname in fixed}
 
-            self.db_con.cursor().execute(query, updates)
+    for weekly in weeklies:
+        weekly.finish()
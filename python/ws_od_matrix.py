@@ -1,27 +1,131 @@
+import os
+import pathlib
+
+import numpy as np
 import pandas as pd
 from .ws_base import Work_location
 
 
+def read_od_csv(filename):
+    """ Returns origins, row pointers, destinations and cumulative weights of an OD matrix CSV
+
+    Rows are normalised the way rng.choice does, empty cells are left out and
+    origins with zero total weight get no destinations
+    """
+    transition = pd.read_csv(filename, delimiter=',', index_col=0)
+    order = np.argsort(transition.index.values, kind="stable")
+
+    values = transition.to_numpy(dtype=np.float64)[order]
+    columns = np.array([int(float(column)) for column in transition.columns], dtype=np.int64)
+
+    origins = transition.index.values.astype(np.int64)[order]
+    indptr = np.zeros(len(origins) + 1, dtype=np.int64)
+    destinations = []
+    cdfs = []
+
+    for idx, row in enumerate(values):
+        present = ~np.isnan(row)
+        weights = row[present]
+
+        assert (weights >= 0).all(), f"negative weights of origin {origins[idx]}"
+
+        if weights.sum() > 0:
+            cdf = (weights / weights.sum()).cumsum()
+            cdf /= cdf[-1]
+        else:
+            present[:] = False
+            cdf = np.zeros(0)
+
+        destinations.append(columns[present])
+        cdfs.append(cdf)
+        indptr[idx + 1] = indptr[idx] + len(cdf)
+
+    return origins, indptr, np.concatenate(destinations), np.concatenate(cdfs)
+
+
 class ODMatrixSelect(Work_location):
     def __init__(self, rng):
         Work_location.__init__(self, rng)
 
-        self._weights = {}
+        # CSR rows of the origins, sorted by origin
+        self._origins = np.zeros(0, dtype=np.int64)
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._destinations = np.zeros(0, dtype=np.int64)
+        self._cdf = np.zeros(0)
+
+        # cdf plus the row of each destination, increasing over all rows
+        self._row_cdf = np.zeros(0)
 
     def init(self, filename):
-        transition = pd.read_csv(filename, delimiter=',', index_col=0)
-        for idx, row in transition.iterrows():
-            row = row.dropna()
-            row_sum = row.sum()
-            row = row.divide(row_sum)
-            self._weights[idx] = row
+        """ Loads the OD matrix, from the .npz cache next to the CSV when it was made of a CSV of the same size and modification time """
+        filename = pathlib.Path(filename)
+        cache = filename.with_name(f"{filename.name}.npz")
+
+        stat = filename.stat()
+        stamp = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+        data = None
+        if cache.exists():
+            with np.load(cache) as npz:
+                if "stamp" in npz and np.array_equal(npz["stamp"], stamp):
+                    data = {name: npz[name] for name in ("origins", "indptr", "destinations", "cdf")}
+
+        if data is None:
+            data = dict(zip(("origins", "indptr", "destinations", "cdf"), read_od_csv(filename)))
+
+            # written under another name first, other processes read a complete cache or none
+            tmp = cache.with_name(f"{cache.name}.{os.getpid()}.tmp")
+            try:
+                with open(tmp, "wb") as f:
+                    np.savez(f, stamp=stamp, **data)
+                os.replace(tmp, cache)
+            except OSError:
+                tmp.unlink(missing_ok=True)
+
+        self._origins = data["origins"]
+        self._indptr = data["indptr"]
+        self._destinations = data["destinations"]
+        self._cdf = data["cdf"]
+
+        self._row_cdf = self._cdf + np.repeat(np.arange(len(self._origins)), np.diff(self._indptr))
+
+    def _rows(self, origins):
+        """ Returns row of each origin, -1 for origins without destinations """
+        origins = np.asarray(origins, dtype=np.int64)
+
+        if len(self._origins) == 0:
+            return np.full(origins.shape, -1, dtype=np.int64)
+
+        pos = np.minimum(np.searchsorted(self._origins, origins), len(self._origins) - 1)
+        found = (self._origins[pos] == origins) & (self._indptr[pos + 1] > self._indptr[pos])
+
+        return np.where(found, pos, -1)
+
+    def _sample(self, rows, uniform):
+        """ Returns destination of each row for uniform samples, searchsorted right within the rows """
+        pos = np.searchsorted(self._row_cdf, uniform + rows, side="right")
+
+        return self._destinations[np.minimum(pos, self._indptr[rows + 1] - 1)]
 
     def obtain(self, idx):
-        try:
-            row = self._weights[idx]
-            weights = row.values
-            val = self._rng.choice(len(weights), 1, p=weights)[0]
+        row = self._rows([idx])[0]
 
-            return int(row.index[val])
-        except KeyError:
+        if row < 0:
             return -1
+
+        return int(self._sample(np.array([row]), self._rng.random(1))[0])
+
+    def obtain_many(self, origins, rng=None):
+        """ Returns destination of each origin, -1 for unknown origins
+
+        Draws one uniform sample per known origin, the same destinations as repeated obtain calls
+        """
+        rng = self._rng if rng is None else rng
+        rows = self._rows(origins)
+
+        res = np.full(rows.shape, -1, dtype=np.int64)
+        known = rows >= 0
+
+        res[known] = self._sample(rows[known], rng.random(int(known.sum())))
+
+        return res
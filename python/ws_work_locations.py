@@ -0,0 +1,81 @@
+import numpy as np
+
+
+def distance(x1, y1, x2, y2):
+    """ Returns Euclidean distance between points, element wise for arrays """
+    return np.hypot(np.subtract(x2, x1), np.subtract(y2, y1))
+
+
+class WorkLocations(object):
+    def __init__(self, connection, table="work"):
+        """ Work locations grouped by postcode2, read once from the building database
+
+        Locations of a postcode are kept in database order, draws match the former per postcode query
+        """
+        rows = connection.execute(f"SELECT postcode2,rd_x,rd_y,wgs_x,wgs_y FROM {table} ORDER BY postcode2,rowid").fetchall()
+        values = np.array([tuple(row) for row in rows], dtype=np.float64).reshape(-1, 5)
+
+        area_ids = values[:, 0].astype(np.int64)
+
+        # locations of postcodes[i] are offsets[i]:offsets[i + 1]
+        self.postcodes, first = np.unique(area_ids, return_index=True)
+        self.offsets = np.append(first, len(area_ids))
+
+        self.x = values[:, 1]
+        self.y = values[:, 2]
+        self.ll_x = values[:, 3]
+        self.ll_y = values[:, 4]
+
+        # maximum number of (point, location) distances calculated at once by in_band
+        self.gather_pairs = 2 ** 22
+
+    def __len__(self):
+        return len(self.x)
+
+    def in_band(self, area_ids, x, y, min_distance, max_distance):
+        """ Returns number of locations of each postcode strictly between min_distance and max_distance of (x, y), 0 for unknown postcodes """
+        area_ids = np.asarray(area_ids, dtype=np.int64)
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+
+        counts = np.zeros(len(area_ids), dtype=np.int64)
+        if len(self.postcodes) == 0:
+            return counts
+
+        pos = np.minimum(np.searchsorted(self.postcodes, area_ids), len(self.postcodes) - 1)
+        known = self.postcodes[pos] == area_ids
+
+        first = self.offsets[pos]
+        sizes = np.where(known, self.offsets[pos + 1] - first, 0)
+        ends = np.cumsum(sizes)
+
+        # (point, location) pairs in blocks of about gather_pairs
+        start = 0
+        while start < len(area_ids):
+            offset = ends[start - 1] if start > 0 else 0
+            stop = max(start + 1, int(np.searchsorted(ends, offset + self.gather_pairs, side="right")))
+
+            block_sizes = sizes[start:stop]
+            point = np.repeat(np.arange(start, stop), block_sizes)
+            location = np.arange(len(point)) - np.repeat(ends[start:stop] - block_sizes - offset, block_sizes) + first[point]
+
+            dist = distance(x[point], y[point], self.x[location], self.y[location])
+            inside = (dist > min_distance) & (dist < max_distance)
+            counts[start:stop] = np.bincount(point - start, weights=inside, minlength=stop - start).astype(np.int64)
+
+            start = stop
+
+        return counts
+
+    def draw_many(self, area_ids, rng):
+        """ Returns arrays of rd_x, rd_y, wgs_x and wgs_y of a random location of each postcode, rounded to 6 decimals """
+        area_ids = np.asarray(area_ids, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.postcodes, area_ids), len(self.postcodes) - 1)
+
+        unknown = self.postcodes[pos] != area_ids
+        assert not unknown.any(), f"no work locations in {np.unique(area_ids[unknown])[:10]}"
+
+        first = self.offsets[pos]
+        locations = first + rng.integers(0, self.offsets[pos + 1] - first)
+
+        return tuple(np.round(values[locations], 6) for values in (self.x, self.y, self.ll_x, self.ll_y))
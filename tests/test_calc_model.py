@@ -0,0 +1,270 @@
+import concurrent.futures
+import datetime
+import logging
+import math
+import sqlite3
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+pytest.importorskip("lue")
+pytest.importorskip("campo")
+
+from osgeo import gdal
+
+from python.actgen.batch import ScheduleBatch
+from python.actgen.config import ActivityType, ActivityDescription, BufferCalculation, CommuteType
+from python.actgen.schedules import Schedules
+from python.actgen.time_axis import TimeAxis
+from python.calc_model import ExposureCalculator
+from python.factors import EnvFactors
+from python.route_cache import RouteCache
+from python.shared_cube import SharedCube, attach
+from python.routing_backend import StubBackend
+from python.spatial_context import SpatialContext
+
+import config
+
+
+props = ["no2", "pm25"]
+
+t_start = datetime.datetime(2019, 1, 7)
+t_end = datetime.datetime(2019, 1, 8)
+t_delta = datetime.timedelta(minutes=1)
+
+# 100 m cells around Utrecht in EPSG:28992
+extent = (120000.0, 465000.0, 140000.0, 445000.0, 100.0, 100.0, 200, 200)
+
+
+def exposure():
+    """ Returns EnvFactors of hourly random cubes, with missing values """
+    rng = np.random.default_rng(1)
+    timesteps = TimeAxis.regular(t_start, t_end).timesteps
+
+    cubes = {}
+    for prop in props:
+        cube = rng.uniform(0, 50, (len(timesteps), extent[6], extent[7])).astype(np.float32)
+        cube[rng.random(cube.shape) < 0.05] = np.nan
+        cubes[prop] = cube
+
+    grid = {"filename": "synthetic.lue", "phenomenon": "concentration", "property_set": "area", "prop": props,
+            "extent": extent, "timesteps": timesteps.values}
+
+    return EnvFactors.from_cubes(grid, cubes)
+
+
+def schedule_database():
+    """ Returns in-memory schedule database of commuters with point, buffer and route activities """
+    rng = np.random.default_rng(2)
+    nr_agents = 25
+
+    home_x = rng.uniform(122000, 138000, nr_agents)
+    home_y = rng.uniform(447000, 463000, nr_agents)
+    work_x = rng.uniform(122000, 138000, nr_agents)
+    work_y = rng.uniform(447000, 463000, nr_agents)
+    home_lon = rng.uniform(5.05, 5.15, nr_agents)
+    home_lat = rng.uniform(52.04, 52.12, nr_agents)
+    work_lon = rng.uniform(5.05, 5.15, nr_agents)
+    work_lat = rng.uniform(52.04, 52.12, nr_agents)
+
+    slots = [
+        {"duration": rng.uniform(6 * 60, 9 * 60, nr_agents), "group": ActivityType.buffer.value, "description": ActivityDescription.home.value,
+         "xcoord": home_x, "ycoord": home_y, "buffer_size": 50, "buffer_method": BufferCalculation.mean.value},
+        {"duration": rng.uniform(10, 90, nr_agents), "group": ActivityType.route.value, "description": ActivityDescription.commute_home_to_work.value,
+         "xcoord": home_lon, "ycoord": home_lat, "xcoord2": work_lon, "ycoord2": work_lat, "travel_mode": CommuteType.car.value},
+        {"duration": 8 * 60, "group": ActivityType.point.value, "description": ActivityDescription.work.value, "xcoord": work_x, "ycoord": work_y},
+        {"duration": rng.uniform(10, 90, nr_agents), "group": ActivityType.route.value, "description": ActivityDescription.commute_work_to_home.value,
+         "xcoord": work_lon, "ycoord": work_lat, "xcoord2": home_lon, "ycoord2": home_lat, "travel_mode": CommuteType.bike.value},
+        {"duration": None, "group": ActivityType.buffer.value, "description": ActivityDescription.leisure.value,
+         "xcoord": home_x, "ycoord": home_y, "buffer_size": 300, "buffer_method": BufferCalculation.sum.value},
+    ]
+
+    schedules = Schedules("test", t_start, t_end, t_delta, props)
+    schedules.add_batch(ScheduleBatch.from_slots(np.arange(1, nr_agents + 1), t_start, t_end, t_delta, slots))
+    schedules._split()
+    schedules.db_con.commit()
+
+    return schedules.db_con
+
+
+def enrich(calculator, source, method):
+    """ Returns the process rows after enriching a copy of the schedule database """
+    connection = sqlite3.connect(":memory:")
+    source.backup(connection)
+    connection.row_factory = sqlite3.Row
+
+    calculator.conn = connection
+    method(calculator)
+
+    connection.row_factory = None
+
+    return connection.execute(f"SELECT activity_id,activity_description,{','.join(props)} FROM process ORDER BY activity_id").fetchall()
+
+
+def baseline_buffer(context, xcoord, ycoord, buffer_size):
+    """ Returns GDAL MEM dataset of the buffer mask as built by the former SpatialContext.buffer """
+    if buffer_size == 0:
+        env_minX, env_maxX, env_minY, env_maxY, rows, cols = context._snap(xcoord, xcoord, ycoord, ycoord)
+        array = np.ones((rows, cols), dtype=np.int32)
+    else:
+        env_minX, env_maxX, env_minY, env_maxY, rows, cols = context._snap(xcoord, xcoord, ycoord, ycoord)
+
+        bsize_cells = int(divmod(math.fabs(buffer_size / context.cellsize), 1)[0])
+
+        y, x = np.ogrid[-bsize_cells: bsize_cells + 1, -bsize_cells: bsize_cells + 1]
+        array = (x * x + y * y <= bsize_cells * bsize_cells).astype(np.int32)
+
+        rows, cols = array.shape
+        multiplier = (rows - 1) / 2
+        env_minX = env_minX - multiplier * context.cellsize
+        env_maxY = env_maxY + multiplier * context.cellsize
+
+    target_ds = gdal.GetDriverByName('MEM').Create('', xsize=cols, ysize=rows, bands=1, eType=gdal.GDT_Byte)
+    target_ds.SetGeoTransform((env_minX, context.cellsize, 0, env_maxY, 0, -context.cellsize_y))
+    target_ds.SetProjection(context.proj.ExportToWkt())
+
+    target_band = target_ds.GetRasterBand(1)
+    target_band.WriteArray(array, 0, 0)
+    target_band.FlushCache()
+
+    return target_ds
+
+
+def test_footprints_equal_datasets():
+    env = exposure()
+    context = SpatialContext(StubBackend(), extent, 28992)
+    rng = np.random.default_rng(6)
+    timestep = TimeAxis.regular(t_start, t_end).timesteps[8]
+
+    for buffer_size in (0, 50, 300, 1000):
+        for xcoord, ycoord in zip(rng.uniform(122000, 138000, 10), rng.uniform(447000, 463000, 10)):
+            footprint = context.buffer(xcoord, ycoord, buffer_size)
+            dataset = baseline_buffer(context, xcoord, ycoord, buffer_size)
+
+            np.testing.assert_array_equal(np.sort(footprint.indices), np.sort(context._dataset_footprint(dataset).indices))
+
+            for prop in props:
+                # the former path masked the bounding box of the dataset, the footprint gathers its cells
+                expected = env.data(timestep, dataset, prop)
+                res = env.data(timestep, footprint, prop)
+
+                np.testing.assert_array_equal(np.sort(res[~np.isnan(res)]), np.sort(expected[~np.isnan(expected)]))
+
+
+def attached_values(descriptor, timesteps):
+    """ Returns the rasters of the timesteps of each property, as read by a worker process """
+    exposure = attach(descriptor)
+
+    values = {prop: [np.array(exposure.values(timestep, prop)) for timestep in timesteps] for prop in props}
+    readonly = all(not exposure.cube(prop).flags.writeable for prop in props)
+
+    return values, readonly
+
+
+def test_shared_cube_equals_cleaning():
+    rng = np.random.default_rng(7)
+    timesteps = TimeAxis.regular(t_start, t_end).timesteps
+
+    # raw dataset values, with broken no data values and values slightly below 0
+    raw = {}
+    for prop in props:
+        cube = rng.uniform(-2, 50, (len(timesteps), extent[6], extent[7])).astype(np.float32)
+        cube[rng.random(cube.shape) < 0.05] = -9999
+        raw[prop] = cube
+
+    grid = {"filename": "synthetic.lue", "phenomenon": "concentration", "property_set": "area", "prop": props,
+            "extent": extent, "timesteps": timesteps.values}
+
+    # a loader reading the raw values the way campo provides them
+    loader = EnvFactors.from_cubes(grid, {})
+    loader.area_propertyset = {prop: [types.SimpleNamespace(data=raw[prop])] for prop in props}
+
+    shared = SharedCube(loader, props)
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            res, readonly = executor.submit(attached_values, shared.descriptor, timesteps[[0, 8, 23]]).result()
+    finally:
+        shared.close()
+
+    assert readonly
+
+    for prop in props:
+        for values, idx in zip(res[prop], [0, 8, 23]):
+            # the cleaning of the former calc per activity window
+            expected = np.where(raw[prop][idx] < -10, np.nan, raw[prop][idx])
+            expected = np.maximum(0.0, expected)
+
+            np.testing.assert_array_equal(values, expected)
+
+
+def test_batch_equals_calc():
+    calculator = ExposureCalculator("synthetic.lue", props, 28992, logging.getLogger("test"), StubBackend(), None, exposure())
+    source = schedule_database()
+
+    expected = enrich(calculator, source, ExposureCalculator.calc)
+    res = enrich(calculator, source, ExposureCalculator.calc_batch)
+
+    assert len(res) == len(expected) > 0
+
+    for row, expected_row in zip(res, expected):
+        assert row[0:2] == expected_row[0:2]
+
+        for value, expected_value in zip(row[2:], expected_row[2:]):
+            if expected_value is None:
+                assert value is None, row
+            else:
+                assert value == pytest.approx(expected_value, rel=1e-5), row
+
+
+def test_workers_kept_over_calls(monkeypatch):
+    monkeypatch.setattr(config, "routing_backend", "stub")
+    monkeypatch.setattr(config, "route_cache", None)
+    monkeypatch.setattr(config, "shared_exposure", True)
+
+    calculator = ExposureCalculator("synthetic.lue", props, 28992, logging.getLogger("test"), StubBackend(), None, exposure())
+    source = schedule_database()
+
+    expected = enrich(calculator, source, ExposureCalculator.calc_batch)
+
+    calculator.start_workers(2)
+    executor = calculator._executor
+    descriptor = calculator._shared.descriptor
+
+    try:
+        # chunks of a stream enriched by the same workers and shared arrays
+        for _ in range(2):
+            res = enrich(calculator, source, lambda calc: calc.calc_parallel(None, 2))
+
+            assert calculator._executor is executor
+            assert calculator._shared.descriptor is descriptor
+            assert res == expected
+    finally:
+        calculator.stop_workers()
+
+    assert calculator._executor is None and calculator._shared is None
+
+
+def test_workers_read_route_cache(monkeypatch, tmp_path):
+    filename = str(tmp_path / "routes.sqlite3")
+    monkeypatch.setattr(config, "routing_backend", "stub")
+    monkeypatch.setattr(config, "route_cache", filename)
+    monkeypatch.setattr(config, "shared_exposure", True)
+
+    route_cache = RouteCache(filename, source=StubBackend().source())
+    calculator = ExposureCalculator("synthetic.lue", props, 28992, logging.getLogger("test"), StubBackend(), route_cache, exposure())
+    source = schedule_database()
+
+    expected = enrich(calculator, source, ExposureCalculator.calc_batch)
+    route_cache.db_con.execute("DELETE FROM footprints")
+    route_cache.db_con.commit()
+
+    # the workers route, the parent writes their routes to the cache
+    res = enrich(calculator, source, lambda calc: calc.calc_parallel(None, 2))
+
+    assert res == expected
+    assert route_cache.db_con.execute("SELECT COUNT(*) FROM footprints").fetchone()[0] == 2 * 25
+
+    route_cache.close()
@@ -0,0 +1,69 @@
+import logging
+import sqlite3
+
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+
+from profiles.commute import CommuteWorkday
+from python.route_cache import RouteCache
+from python.routing_backend import StubBackend
+from python.ws_work_locations import WorkLocations
+
+
+class HomeDestinations(object):
+    def obtain_many(self, area_ids):
+        """ Destination of each home municipality, no OD for municipality 20 """
+        return np.where(area_ids == 20, -1, area_ids)
+
+
+def commute_workday(rng):
+    """ Returns a CommuteWorkday drawing from postcode 10, two locations in the distance band and four beyond,
+    and postcode 20 only beyond the distance band """
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE work (postcode2 INTEGER, rd_x REAL, rd_y REAL, wgs_x REAL, wgs_y REAL)")
+
+    locations = [(10, 8000, 0), (10, 0, 9000), *[(10, 300000, 0)] * 4, (20, 0, 300000)]
+    connection.executemany("INSERT INTO work VALUES (?, ?, ?, ?, ?)", [(postcode, x, y, 5 + x / 1e5, 52 + y / 1e5) for postcode, x, y in locations])
+
+    profile = CommuteWorkday.__new__(CommuteWorkday)
+    profile.rng = profile._rng = rng
+    profile.logger = logging.getLogger("test")
+    profile.od_matrix = HomeDestinations()
+    profile.work_locations = WorkLocations(connection)
+    profile.route_cache = RouteCache()
+    profile.r = StubBackend()
+    profile.min_eucl = 25
+    profile.max_eucl = 180000
+    profile.max_commute_time = 150
+
+    return profile
+
+
+def test_draw_work_locations_left_out():
+    rng = np.random.default_rng(21)
+    profile = commute_workday(rng)
+
+    home_municipality = np.array([10, 20, 10, 10, 20, 10])
+    home_x, home_y = rng.uniform(0, 100, (2, len(home_municipality)))
+
+    # postcodes evaluated for the distance band
+    evaluated = []
+    in_band = profile.work_locations.in_band
+
+    def counted(area_ids, *args):
+        evaluated.extend(area_ids.tolist())
+        return in_band(area_ids, *args)
+
+    profile.work_locations.in_band = counted
+
+    work, mode, distance, duration, found = profile.draw_work_locations(home_municipality, home_x, home_y, 5 + home_x / 1e5, 52 + home_y / 1e5)
+
+    # agents of municipality 20 have no work location in the band, the others all do
+    np.testing.assert_array_equal(found, home_municipality == 10)
+    assert np.isin(work[0, found], [8000, 0]).all()
+    assert (distance[found] > 0).all() and (duration[found] > 0).all()
+
+    # the band of each agent and postcode is evaluated once over all rounds
+    assert sorted(evaluated) == sorted(home_municipality.tolist())
@@ -0,0 +1,30 @@
+import sqlite3
+
+import numpy as np
+
+from python.convergence import Convergence
+
+
+def write_day(path, rows):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE exp_day (agent_id INTEGER PRIMARY KEY, no2 REAL)")
+    connection.executemany("INSERT INTO exp_day VALUES (?, ?)", rows)
+    connection.commit()
+    connection.close()
+
+
+def test_zero_mean_agents(tmp_path):
+    convergence = Convergence(0.1, quantile=1.0)
+
+    # agent 2 without exposure, agent 3 with a zero mean, agent 4 outside the dataset
+    realisations = [[10.0, 0.0, -1.0, None], [11.0, 0.0, 1.0, None], [12.0, 0.0, 0.0, None]]
+
+    for idx, values in enumerate(realisations, 1):
+        write_day(tmp_path / f"day_{idx}.sqlite3", list(zip([1, 2, 3, 4], values)))
+        convergence.add(tmp_path / f"day_{idx}.sqlite3", idx)
+
+    # only agent 1 counts
+    expected = np.std([10.0, 11.0, 12.0], ddof=1) / np.sqrt(3) / 11.0
+
+    assert np.isclose(convergence.errors()["no2"], expected)
+    assert convergence.converged()
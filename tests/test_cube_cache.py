@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from python.cube_cache import read_cube_cache, write_cube_cache
+
+
+class Exposure(object):
+    def __init__(self, filename, cubes):
+        self.filename = filename
+        self.cubes = cubes
+
+    def grid(self):
+        return {"filename": self.filename, "phenomenon": "concentration", "property_set": "area", "prop": list(self.cubes),
+                "extent": (0.0, 20.0, 30.0, 0.0, 1.0, 1.0, 20, 30), "timesteps": self.timesteps().values}
+
+    def timesteps(self):
+        return pd.date_range("2019-01-07", periods=4, freq="h")
+
+    def cube(self, prop):
+        return self.cubes[prop]
+
+    def release(self, prop):
+        pass
+
+
+def test_stale_cache(tmp_path):
+    filename = tmp_path / "dataset.lue"
+    filename.write_bytes(b"first")
+
+    cubes = {"no2": np.arange(4 * 20 * 30, dtype=np.float64).reshape(4, 20, 30)}
+    write_cube_cache(Exposure(filename, cubes), ["no2"])
+
+    grid, cached = read_cube_cache(filename, ["no2"])
+    np.testing.assert_array_equal(cached["no2"], cubes["no2"])
+    assert grid["extent"] == (0.0, 20.0, 30.0, 0.0, 1.0, 1.0, 20, 30)
+    assert read_cube_cache(filename, ["no2", "pm25"]) is None
+
+    # arrays of another property are merged with those of the same dataset
+    write_cube_cache(Exposure(filename, {"pm25": cubes["no2"] * 2}), ["pm25"])
+    assert read_cube_cache(filename, ["no2", "pm25"]) is not None
+
+    filename.write_bytes(b"second version")
+    os.utime(filename, ns=(0, 0))
+
+    assert read_cube_cache(filename, ["no2"]) is None
+
+    # and not with those of an earlier version
+    write_cube_cache(Exposure(filename, {"pm25": cubes["no2"] * 3}), ["pm25"])
+    assert read_cube_cache(filename, ["no2"]) is None
+    assert read_cube_cache(filename, ["pm25"]) is not None
@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from python.actgen.config import BufferCalculation
+from python.focal import FocalSurfaces, focal_statistics
+
+
+class Exposure(object):
+    def __init__(self, value):
+        self.value = value
+
+    def values(self, timestep, prop):
+        return np.full((20, 30), self.value)
+
+
+def circle(radius):
+    y, x = np.ogrid[-radius: radius + 1, -radius: radius + 1]
+    return x * x + y * y <= radius * radius
+
+
+def test_focal_statistics_edges():
+    rng = np.random.default_rng(3)
+    values = rng.uniform(0, 10, (20, 30))
+    values[rng.random(values.shape) < 0.2] = np.nan
+    mask = circle(3)
+
+    focal_sum, focal_mean = focal_statistics(values, mask)
+
+    # cells outside the raster are missing values
+    padded = np.pad(values, 3, constant_values=np.nan)
+
+    for row in range(values.shape[0]):
+        for col in range(values.shape[1]):
+            window = padded[row:row + 7, col:col + 7][mask]
+            assert np.isclose(focal_sum[row, col], np.nansum(window))
+
+            if np.isnan(window).all():
+                assert np.isnan(focal_mean[row, col])
+            else:
+                assert np.isclose(focal_mean[row, col], np.nanmean(window))
+
+
+def test_cache_follows_dataset(tmp_path):
+    filename = tmp_path / "dataset.lue"
+    filename.write_bytes(b"first")
+
+    timestep = pd.Timestamp("2019-01-07 08:00")
+    mask = circle(1)
+
+    surface = FocalSurfaces(Exposure(1.0), filename).surface(timestep, "no2", mask, BufferCalculation.sum.value)
+    assert np.isclose(surface[10, 10], 5.0)
+
+    # reused as long as the dataset is unchanged
+    surface = FocalSurfaces(Exposure(2.0), filename).surface(timestep, "no2", mask, BufferCalculation.sum.value)
+    assert np.isclose(surface[10, 10], 5.0)
+
+    filename.write_bytes(b"second version")
+    os.utime(filename, ns=(0, 0))
+
+    surface = FocalSurfaces(Exposure(2.0), filename).surface(timestep, "no2", mask, BufferCalculation.sum.value)
+    assert np.isclose(surface[10, 10], 10.0)
+
+    # the rasters of the first version are kept for runs still reading them
+    assert len(list(tmp_path.glob("dataset.focal/*/no2_*_sum.npy"))) == 2
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from python.footprint import supercover
+
+
+def cells(line):
+    line = np.asarray(line, dtype=np.float64)
+    rows, cols = supercover(line[:, 0], line[:, 1])
+
+    return set(zip(rows.tolist(), cols.tolist()))
+
+
+def touches(x0, y0, x1, y1, row, col):
+    """ Returns whether a segment intersects the closed cell (row, col), by clipping it to the cell """
+    low, high = 0.0, 1.0
+
+    for p, q in ((x0 - x1, x0 - col), (x1 - x0, col + 1 - x0), (y0 - y1, y0 - row), (y1 - y0, row + 1 - y0)):
+        if p == 0:
+            if q < 0:
+                return False
+        elif p < 0:
+            low = max(low, q / p)
+        else:
+            high = min(high, q / p)
+
+    return low <= high
+
+
+@pytest.mark.parametrize("line, expected", [
+    # passing corners with a positive slope, the cells beside the corners are left out
+    ([(1, 1), (4, 4)], {(1, 1), (2, 2), (3, 3)}),
+    # and with a negative slope, with the cells below and right of the corners
+    ([(2, 8), (5, 5)], {(8, 2), (7, 2), (6, 3), (5, 4), (7, 3), (6, 4)}),
+    ([(1.5, 2.5), (4.5, 2.5)], {(2, 1), (2, 2), (2, 3), (2, 4)}),
+    ([(3.5, 0.5), (3.5, 2.0)], {(0, 3), (1, 3)}),
+])
+def test_supercover_corners(line, expected):
+    assert cells(line) == expected
+
+
+def test_supercover_touched_cells():
+    rng = np.random.default_rng(6)
+
+    for _ in range(200):
+        line = rng.uniform(-1, 13, (rng.integers(2, 8), 2))
+        res = cells(line)
+
+        for (x0, y0), (x1, y1) in zip(line[:-1], line[1:]):
+            # cells of points along the segment
+            t = np.linspace(0, 1, 1001)
+            assert set(zip(np.floor(y0 + t * (y1 - y0)).astype(int).tolist(), np.floor(x0 + t * (x1 - x0)).astype(int).tolist())) <= res
+
+        # and only cells touched by a segment
+        for row, col in res:
+            assert any(touches(x0, y0, x1, y1, row, col) for (x0, y0), (x1, y1) in zip(line[:-1], line[1:])), (row, col, line.tolist())
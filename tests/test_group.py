@@ -0,0 +1,194 @@
+import concurrent.futures
+import datetime
+import sqlite3
+
+import numpy as np
+import pytest
+
+from python.actgen.schedules import Schedules
+from python.actgen.time_axis import TimeAxis
+from python.group import _exposure_rows, _load_exposure, agent_chunks, exposure_per_activity, in_order
+
+from test_schedules import home_work_home, t_start, t_end, t_delta
+
+
+props = ["no2", "pm25"]
+
+
+def baseline_exposure(connection, props):
+    """ Returns exp_act and exp_day rows as aggregated by the former per agent loop """
+    c = ",".join(props)
+    act_rows = []
+    day_rows = []
+
+    for agents in connection.execute("SELECT DISTINCT agent_id FROM file1").fetchall():
+        agent_id = agents[0]
+        act_cnt = 0
+        day_value = {p: 0 for p in props}
+
+        for act_start, act_end in connection.execute("SELECT time_start,time_end FROM file1 WHERE agent_id=?", (agent_id,)).fetchall():
+            act_delta_minutes = int((datetime.datetime.fromisoformat(act_end) - datetime.datetime.fromisoformat(act_start)).total_seconds() / 60)
+
+            act_value = {p: 0 for p in props}
+            query = f"SELECT time_start,time_end,activity_group,activity_index,activity_description,{c} FROM process WHERE agent_id=? AND time_start>=? AND time_end<=?"
+
+            for split in connection.execute(query, (agent_id, act_start, act_end)).fetchall():
+                activity_group = split[2]
+                route_descr_val = None
+                if activity_group == 3:
+                    route_descr_val = connection.execute("SELECT travel_descr FROM route_activities WHERE activity_index=?", (split[3],)).fetchone()[0]
+
+                act_type = activity_group
+                descr = split[4]
+                commute_mode = route_descr_val
+
+                if activity_group == 3:
+                    descr = route_descr_val
+                    commute_mode = split[4]
+
+                split_delta_minutes = int((datetime.datetime.fromisoformat(split[1]) - datetime.datetime.fromisoformat(split[0])).total_seconds() / 60)
+
+                for idx, p in enumerate(props):
+                    value = split[5 + idx]
+                    if value is not None:
+                        if act_value[p] is not None:
+                            act_value[p] += value * split_delta_minutes
+                        if day_value[p] is not None:
+                            day_value[p] += value * split_delta_minutes
+                    else:
+                        act_value[p] = None
+                        day_value[p] = None
+
+            for p in props:
+                if act_value[p] is not None:
+                    act_value[p] /= act_delta_minutes
+
+            act_rows.append((agent_id, act_cnt, act_delta_minutes, act_type, descr, commute_mode, *[act_value[p] for p in props]))
+            act_cnt += 1
+
+        for p in props:
+            if day_value[p] is not None:
+                day_value[p] /= 1440
+
+        day_rows.append((agent_id, *[day_value[p] for p in props]))
+
+    return act_rows, day_rows
+
+
+def assert_rows_equal(res, expected):
+    assert len(res) == len(expected)
+
+    for row, expected_row in zip(res, expected):
+        assert len(row) == len(expected_row)
+
+        for value, expected_value in zip(row, expected_row):
+            if expected_value is None or value is None:
+                assert value is expected_value, (row, expected_row)
+            else:
+                assert np.isclose(value, expected_value), (row, expected_row)
+
+
+def test_exposure_rows_equal_baseline():
+    # no activity shorter than a minute, the former loop divided by its whole minutes
+    rng = np.random.default_rng(4)
+
+    schedules = Schedules("test", t_start, t_end, t_delta, props, TimeAxis.regular(t_start, t_end))
+    schedules.add_batch(home_work_home([17, 3, 42, 8, 25], rng))
+    schedules.add_batch(home_work_home([1, 30, 12, 2], rng))
+    schedules._split()
+
+    connection = schedules.db_con
+    nr_splits = connection.execute("SELECT COUNT(*) FROM process").fetchone()[0]
+
+    # enriched splits, the descriptions as written by the enrichment
+    values = rng.uniform(5, 40, (nr_splits, len(props)))
+    connection.executemany("UPDATE process SET activity_description=?,no2=?,pm25=? WHERE activity_id=?",
+                           [(int(idx % 4 + 1), *row, idx + 1) for idx, row in enumerate(values.tolist())])
+
+    # a split of the work activity of agent 8 outside the pollutant dataset
+    connection.execute("""UPDATE process SET no2=NULL WHERE activity_id=(
+SELECT activity_id FROM process WHERE agent_id=8 AND activity_group=1 ORDER BY activity_id LIMIT 1 OFFSET 1)""")
+    connection.commit()
+
+    expected_act, expected_day = baseline_exposure(connection, props)
+
+    agent_ids = [row[0] for row in connection.execute("SELECT DISTINCT agent_id FROM file1 ORDER BY agent_id")]
+    act_rows = []
+    day_rows = []
+
+    for agent_min, agent_max in agent_chunks(agent_ids, 3):
+        act, day = _exposure_rows(props, *_load_exposure(connection, props, agent_min, agent_max))
+        act_rows.extend(act)
+        day_rows.extend(day)
+
+    assert_rows_equal(act_rows, expected_act)
+    assert_rows_equal(day_rows, expected_day)
+
+    # the NULL split makes the activity and the day value of the agent NULL, not the other variable
+    assert sum(row[6] is None for row in act_rows) == 1
+    assert [row[0] for row in day_rows if row[1] is None] == [8]
+    assert all(row[2] is not None for row in day_rows)
+
+
+def test_exposure_rows_short_activity():
+    # the commutes of agent 3 last 53 seconds, the former loop divided by zero minutes
+    rng = np.random.default_rng(7)
+
+    schedules = Schedules("test", t_start, t_end, t_delta, props, TimeAxis.regular(t_start, t_end))
+    schedules.add_batch(home_work_home([17, 3, 42, 8, 25], rng))
+    schedules._split()
+
+    with pytest.raises(AssertionError, match=r"agents \[3\]"):
+        _exposure_rows(props, *_load_exposure(schedules.db_con, props, 0, 100))
+
+
+def test_in_order_window():
+    submitted = []
+    merged = []
+
+    def submit(chunk):
+        # chunks submitted but not merged yet
+        assert len(submitted) - len(merged) < 3
+        submitted.append(chunk)
+
+        future = concurrent.futures.Future()
+        future.set_result(chunk * 2)
+        return future
+
+    for res in in_order(submit, range(10), 3):
+        merged.append(res)
+
+    assert merged == [chunk * 2 for chunk in range(10)]
+
+
+def test_shared_executor_chunks(tmp_path):
+    def enriched():
+        rng = np.random.default_rng(4)
+
+        schedules = Schedules("test", t_start, t_end, t_delta, props, TimeAxis.regular(t_start, t_end))
+        schedules.add_batch(home_work_home(list(range(1, 40)), rng))
+        schedules._split()
+
+        connection = schedules.db_con
+        connection.execute("UPDATE process SET activity_description=1,no2=activity_id*0.5,pm25=activity_id*0.25")
+        connection.commit()
+
+        return connection
+
+    def read(path):
+        connection = sqlite3.connect(path)
+        res = connection.execute("SELECT * FROM exp_act").fetchall(), connection.execute("SELECT * FROM exp_day").fetchall()
+        connection.close()
+
+        return res
+
+    exposure_per_activity(tmp_path / "serial.sqlite3", props, connection=enriched())
+
+    # the workers of one pool query the in-memory databases of consecutive calls
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+        for name in ("first", "second"):
+            exposure_per_activity(tmp_path / f"{name}.sqlite3", props, 2, connection=enriched(), executor=executor)
+
+    assert read(tmp_path / "first.sqlite3") == read(tmp_path / "serial.sqlite3")
+    assert read(tmp_path / "second.sqlite3") == read(tmp_path / "serial.sqlite3")
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["first.sqlite3", "second.sqlite3", "serial.sqlite3"]
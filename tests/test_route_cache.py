@@ -0,0 +1,206 @@
+import numpy as np
+import pytest
+
+from python.actgen.config import CommuteType
+from python.footprint import Footprint
+from python.route_cache import RouteCache
+from python.routing_backend import StubBackend
+
+
+class CountingBackend(StubBackend):
+    def __init__(self):
+        StubBackend.__init__(self)
+        self.routed = 0
+
+    def distances(self, pairs):
+        self.routed += len(pairs)
+        return StubBackend.distances(self, pairs)
+
+    def routes(self, pairs):
+        self.routed += len(pairs)
+        return StubBackend.routes(self, pairs)
+
+
+# grid of 100 m cells around Utrecht in EPSG:28992, as returned by EnvFactors.extent
+extent = (120000.0, 465000.0, 140000.0, 445000.0, 100.0, 100.0, 200, 200)
+
+x1 = np.array([5.10, 5.11, 5.10, 5.13, 5.10])
+y1 = np.array([52.08, 52.09, 52.08, 52.10, 52.08])
+x2 = np.array([5.14, 5.12, 5.14, 5.11, 5.14])
+y2 = np.array([52.10, 52.07, 52.10, 52.09, 52.10])
+modes = np.array([CommuteType.car.value, CommuteType.bike.value, CommuteType.car.value, CommuteType.foot.value, CommuteType.foot.value])
+
+
+def rasterize(points):
+    """ Returns footprint of the points on a 1000 x 1000 grid of 0.001 degree cells """
+    points = np.asarray(points)
+    return Footprint.from_cells(((53 - points[:, 1]) * 1000).astype(np.int64), ((points[:, 0] - 5) * 1000).astype(np.int64), 1000, 1000)
+
+
+def test_distances_stub():
+    backend = CountingBackend()
+    cache = RouteCache()
+
+    distance, duration = cache.distances(backend, x1, y1, x2, y2, modes)
+    expected = np.array(StubBackend().distances(list(zip(x1, y1, x2, y2, modes))))
+
+    np.testing.assert_allclose(distance, expected[:, 0])
+    np.testing.assert_allclose(duration, expected[:, 1])
+
+    # the repeated car route is routed once
+    assert backend.routed == 4
+    assert cache.misses == 4 and cache.hits == 1
+
+    # foot routes are found in both directions
+    res = cache.distance(backend, x2[3], y2[3], x1[3], y1[3], CommuteType.foot.value)
+    assert backend.routed == 4
+    np.testing.assert_allclose(res, expected[3])
+
+
+def test_distances_persistent(tmp_path):
+    filename = tmp_path / "routes.sqlite3"
+
+    cache = RouteCache(filename)
+    expected = cache.distances(CountingBackend(), x1, y1, x2, y2, modes)
+    cache.close()
+
+    backend = CountingBackend()
+    cache = RouteCache(filename)
+    res = cache.distances(backend, x1, y1, x2, y2, modes)
+    cache.close()
+
+    assert backend.routed == 0
+    np.testing.assert_allclose(res, expected)
+
+
+def test_footprints_stub(tmp_path):
+    pairs = list(zip(x1.tolist(), y1.tolist(), x2.tolist(), y2.tolist(), modes.tolist()))
+    grid = ("degrees", 1000, 1000)
+
+    backend = CountingBackend()
+    cache = RouteCache(tmp_path / "routes.sqlite3")
+    footprints = cache.footprints(backend, pairs, grid, rasterize)
+
+    assert backend.routed == 4
+
+    for pair, footprint in zip(pairs, footprints):
+        np.testing.assert_array_equal(footprint.indices, rasterize(StubBackend().routes([pair])[0]).indices)
+
+    single = cache.footprint(backend, *pairs[1], grid, rasterize)
+    np.testing.assert_array_equal(single.indices, footprints[1].indices)
+    cache.close()
+
+    backend = CountingBackend()
+    cache = RouteCache(tmp_path / "routes.sqlite3")
+    stored = cache.footprints(backend, pairs, grid, rasterize)
+    cache.close()
+
+    assert backend.routed == 0
+    for footprint, expected in zip(stored, footprints):
+        np.testing.assert_array_equal(footprint.indices, expected.indices)
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_spatial_context_routes(cached):
+    pytest.importorskip("osgeo")
+    from python.spatial_context import SpatialContext
+
+    backend = CountingBackend()
+    context = SpatialContext(backend, extent, 28992, RouteCache() if cached else None)
+
+    footprints = context.routes(x1, y1, x2, y2, modes, 4326)
+
+    assert len(footprints) == len(x1)
+
+    for idx, footprint in enumerate(footprints):
+        points = StubBackend().routes([(x1[idx], y1[idx], x2[idx], y2[idx], modes[idx])])[0]
+        np.testing.assert_array_equal(footprint.indices, context._route_footprint(points).indices)
+
+        single = context.route(x1[idx], y1[idx], x2[idx], y2[idx], modes[idx], 4326)
+        np.testing.assert_array_equal(single.indices, footprint.indices)
+
+
+def test_routing_data_changed(tmp_path):
+    filename = tmp_path / "routes.sqlite3"
+
+    cache = RouteCache(filename, source="first")
+    cache.distances(CountingBackend(), x1, y1, x2, y2, modes)
+    cache.close()
+
+    backend = CountingBackend()
+    cache = RouteCache(filename, source="first")
+    cache.distances(backend, x1, y1, x2, y2, modes)
+    cache.close()
+    assert backend.routed == 0
+
+    # routes of other routing data are removed
+    backend = CountingBackend()
+    cache = RouteCache(filename, source="second")
+    cache.distances(backend, x1, y1, x2, y2, modes)
+    cache.close()
+    assert backend.routed == 4
+
+
+def test_single_routes_written_in_batches(tmp_path):
+    filename = tmp_path / "routes.sqlite3"
+    backend = CountingBackend()
+
+    cache = RouteCache(filename, source=backend.source())
+    cache.commit_rows = 3
+
+    def stored():
+        return cache.db_con.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+
+    # distinct routes
+    for idx in (0, 1, 3, 4):
+        cache.distance(backend, x1[idx], y1[idx], x2[idx], y2[idx], modes[idx])
+
+    assert stored() == 3
+
+    cache.close()
+
+    cache = RouteCache(filename, source=backend.source())
+    assert stored() == 4
+    cache.close()
+
+
+def test_readonly_worker_cache(tmp_path):
+    filename = tmp_path / "routes.sqlite3"
+    parent = RouteCache(filename, source="first")
+
+    # workers read the file and hand their new routes to the parent
+    backend = CountingBackend()
+    worker = RouteCache(filename, readonly=True)
+    expected = worker.distances(backend, x1, y1, x2, y2, modes)
+
+    assert parent.db_con.execute("SELECT COUNT(*) FROM routes").fetchone()[0] == 0
+
+    parent.store(*worker.take_pending())
+    assert parent.db_con.execute("SELECT COUNT(*) FROM routes").fetchone()[0] == 4
+
+    # another worker finds them in the file
+    backend = CountingBackend()
+    res = RouteCache(filename, readonly=True).distances(backend, x1, y1, x2, y2, modes)
+
+    assert backend.routed == 0
+    np.testing.assert_allclose(res, expected)
+
+    parent.close()
+
+
+def test_round_digits(tmp_path):
+    filename = tmp_path / "routes.sqlite3"
+
+    # points 0.3 m apart have their own routes
+    backend = CountingBackend()
+    cache = RouteCache(filename)
+    cache.distance(backend, 5.100001, 52.08, 5.14, 52.10, CommuteType.car.value)
+    cache.distance(backend, 5.100002, 52.08, 5.14, 52.10, CommuteType.car.value)
+    cache.close()
+
+    assert backend.routed == 2
+
+    # routes stored with another rounding are removed
+    cache = RouteCache(filename, round_digits=5)
+    assert cache.db_con.execute("SELECT COUNT(*) FROM routes").fetchone()[0] == 0
+    cache.close()
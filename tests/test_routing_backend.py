@@ -0,0 +1,40 @@
+import urllib.parse
+
+from python.actgen.config import CommuteType
+from python.routing_backend import HttpBackend, StubBackend
+
+
+def test_http_tables_per_source():
+    backend = HttpBackend({"car": "http://localhost:5000", "bike": "http://localhost:5001"}, table_size=2)
+    stub = StubBackend()
+    requests = []
+
+    def get(mode, path):
+        # a table of the stub distances of the requested source and destinations
+        requests.append((mode, path))
+        url = urllib.parse.urlsplit(path)
+        query = urllib.parse.parse_qs(url.query)
+
+        points = [tuple(map(float, point.split(","))) for point in url.path.split("/")[-1].split(";")]
+        sources = [points[int(idx)] for idx in query["sources"][0].split(";")]
+        destinations = [points[int(idx)] for idx in query["destinations"][0].split(";")]
+
+        values = [[stub._distance(*source, *destination, mode) for destination in destinations] for source in sources]
+
+        return {"code": "Ok", "distances": [[value[0] for value in row] for row in values], "durations": [[value[1] * 60 for value in row] for row in values]}
+
+    backend._get = get
+
+    car = CommuteType.car.value
+    bike = CommuteType.bike.value
+    pairs = [(5.1, 52.1, 5.2, 52.2, car), (5.3, 52.3, 5.2, 52.2, car), (5.1, 52.1, 5.4, 52.4, car),
+             (5.1, 52.1, 5.5, 52.5, car), (5.1, 52.1, 5.2, 52.2, bike), (5.1, 52.1, 5.2, 52.2, car)]
+
+    res = backend.distances(pairs)
+
+    for pair, values in zip(pairs, res):
+        assert values == stub._distance(*pair)
+
+    # one request per mode, source and block of at most two destinations, each with its own profile
+    assert sorted((mode, path.split("/")[3]) for mode, path in requests) == [(car, "driving")] * 3 + [(bike, "cycling")]
+    assert all("sources=0&" in path for mode, path in requests)
@@ -0,0 +1,200 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from python.actgen.act import Buffer_Final, Buffer_Fixed, Commute
+from python.actgen.batch import ScheduleBatch
+from python.actgen.config import ActivityType, ActivityDescription, BufferCalculation, CommuteType
+from python.actgen.schedules import Schedules
+from python.actgen.time_axis import TICKS_PER_MINUTE, ScheduleTimes, TimeAxis
+from python.actgen.timer import Schedule
+
+import config
+
+
+t_start = datetime.datetime(2020, 7, 1)
+t_end = datetime.datetime(2020, 7, 2)
+t_delta = datetime.timedelta(minutes=1)
+
+
+def baseline_make(connection, agent_id, exp_starts, exp_ends):
+    """ Returns process rows of an agent as split by the former per agent splitter """
+    rows = connection.execute("SELECT agent_id,time_start,time_end,activity_group,activity_index FROM file1 WHERE agent_id=?", (agent_id,)).fetchall()
+
+    res = []
+    act_row_idx = 0
+    exp_ts_idx = 0
+    nr_to_test = len(exp_starts) - 1
+
+    curr_id, start, end, curr_group, curr_index = rows[0]
+    start = pd.Timestamp(start)
+    end = pd.Timestamp(end)
+
+    while exp_ts_idx <= nr_to_test:
+        exp_start = exp_starts[exp_ts_idx]
+        exp_end = exp_ends[exp_ts_idx]
+
+        if end > exp_end:
+            res.append((curr_id, start, exp_end, curr_group, curr_index))
+            exp_ts_idx += 1
+            start = exp_end
+        elif start >= exp_start and end < exp_end:
+            res.append((curr_id, start, end, curr_group, curr_index))
+            act_row_idx += 1
+            curr_id, _, time_end, curr_group, curr_index = rows[act_row_idx]
+            start = end
+            end = pd.Timestamp(time_end)
+        elif start >= exp_start and end == exp_end:
+            res.append((curr_id, start, end, curr_group, curr_index))
+            exp_ts_idx += 1
+
+            if exp_ts_idx <= nr_to_test:
+                act_row_idx += 1
+                curr_id, _, time_end, curr_group, curr_index = rows[act_row_idx]
+                start = end
+                end = pd.Timestamp(time_end)
+        else:
+            raise NotImplementedError
+
+    return [(agent, str(start.to_pydatetime()), str(end.to_pydatetime()), group, index) for agent, start, end, group, index in res]
+
+
+def baseline_process(connection):
+    """ Returns process rows of all agents in the order of the former splitter """
+    exp_starts = list(pd.date_range(t_start, periods=24, freq="h"))
+    exp_ends = list(pd.date_range(t_start + datetime.timedelta(hours=1), periods=24, freq="h"))
+
+    # scans the index on agent_id, the agents are visited in id order whatever order they were added in
+    res = []
+    for row in connection.execute("SELECT DISTINCT agent_id FROM file1").fetchall():
+        res.extend(baseline_make(connection, row[0], exp_starts, exp_ends))
+
+    return res
+
+
+def home_work_home(agent_ids, rng):
+    """ Returns schedules of agents with fractional minute durations, some ending on or next to a full hour """
+    nr_agents = len(agent_ids)
+
+    home = rng.uniform(5 * 60, 9 * 60, nr_agents)
+    home[:3] = [6 * 60, 7 * 60 - 1e-6, 8 * 60 + 1e-6]
+    commute = rng.uniform(0.5, 75, nr_agents)
+    commute[3] = 60 * 9 - home[3]
+
+    slots = [
+        {"duration": home, "group": ActivityType.buffer.value, "description": ActivityDescription.home.value, "xcoord": 1.0, "ycoord": 2.0,
+         "buffer_size": 50, "buffer_method": BufferCalculation.mean.value},
+        {"duration": commute, "group": ActivityType.route.value, "description": ActivityDescription.commute_home_to_work.value,
+         "xcoord": 5.1, "ycoord": 52.1, "xcoord2": 5.2, "ycoord2": 52.0, "travel_mode": 1},
+        {"duration": rng.uniform(7 * 60, 9 * 60, nr_agents), "group": ActivityType.point.value, "description": ActivityDescription.work.value, "xcoord": 3.0, "ycoord": 4.0},
+        {"duration": commute, "group": ActivityType.route.value, "description": ActivityDescription.commute_work_to_home.value,
+         "xcoord": 5.2, "ycoord": 52.0, "xcoord2": 5.1, "ycoord2": 52.1, "travel_mode": 1},
+        {"duration": None, "group": ActivityType.buffer.value, "description": ActivityDescription.home.value, "xcoord": 1.0, "ycoord": 2.0,
+         "buffer_size": 50, "buffer_method": BufferCalculation.mean.value},
+    ]
+
+    return ScheduleBatch.from_slots(agent_ids, t_start, t_end, t_delta, slots)
+
+
+@pytest.mark.parametrize("make_agents", [100000, 3])
+def test_split_equals_baseline(make_agents):
+    rng = np.random.default_rng(6)
+
+    schedules = Schedules("test", t_start, t_end, t_delta, ["no2"], TimeAxis.regular(t_start, t_end))
+    schedules.make_agents = make_agents
+
+    # agents are not added in the order of their ids
+    schedules.add_batch(home_work_home([17, 3, 42, 8, 25], rng))
+    schedules.add_batch(home_work_home([1, 30, 12, 2], rng))
+
+    schedules._split()
+
+    res = schedules.db_con.execute("SELECT agent_id,time_start,time_end,activity_group,activity_index FROM process ORDER BY activity_id").fetchall()
+    expected = baseline_process(schedules.db_con)
+
+    assert len(res) > 8 * 5
+    assert res == expected
+
+    # fractional seconds are kept
+    assert any("." in row[1] for row in res)
+
+
+def test_from_slots_equals_generate():
+    rng = np.random.default_rng(12)
+    agent_ids = np.array([5, 2, 9, 14])
+    nr_agents = len(agent_ids)
+
+    # draws of the commuter profile
+    act_end = rng.integers(6 * 60 + 30, 7 * 60 + 30, nr_agents)
+    duration = rng.uniform(5, 150, nr_agents)
+    mode = rng.choice([CommuteType.foot.value, CommuteType.bike.value, CommuteType.car.value], nr_agents)
+    home_x, home_y, work_x, work_y = rng.uniform(120000, 140000, (4, nr_agents))
+    home_ll_x, home_ll_y, work_ll_x, work_ll_y = rng.uniform(5, 5.2, (4, nr_agents))
+
+    # former construction, one Schedule per agent
+    schedules = []
+    for idx, agent_id in enumerate(agent_ids.tolist()):
+        schedule = Schedule(t_start, t_end, t_delta, agent_id)
+        schedule.add_activity(Buffer_Fixed(ActivityDescription.home, home_x[idx], home_y[idx], int(act_end[idx]) * t_delta, 50))
+        schedule.add_activity(Commute(ActivityDescription.commute_home_to_work, home_ll_x[idx], home_ll_y[idx], work_ll_x[idx], work_ll_y[idx], CommuteType(mode[idx]), duration[idx]))
+        schedule.add_activity(Buffer_Fixed(ActivityDescription.work, work_x[idx], work_y[idx], 8 * 60 * t_delta, 50))
+        schedule.add_activity(Commute(ActivityDescription.commute_work_to_home, work_ll_x[idx], work_ll_y[idx], home_ll_x[idx], home_ll_y[idx], CommuteType(mode[idx]), duration[idx]))
+        schedule.add_activity(Buffer_Final(ActivityDescription.home, home_x[idx], home_y[idx], int(act_end[idx]) * t_delta, 50))
+        schedule.generate()
+        schedules.append(schedule)
+
+    expected = ScheduleBatch.from_schedules(schedules)
+
+    home = {"group": ActivityType.buffer.value, "description": ActivityDescription.home.value, "xcoord": home_x, "ycoord": home_y, "buffer_size": 50, "buffer_method": BufferCalculation.mean.value}
+    work = {"group": ActivityType.buffer.value, "description": ActivityDescription.work.value, "xcoord": work_x, "ycoord": work_y, "buffer_size": 50, "buffer_method": BufferCalculation.mean.value}
+    route = {"group": ActivityType.route.value, "travel_mode": mode, "duration": duration}
+
+    slots = [
+        dict(home, duration=act_end),
+        dict(route, description=ActivityDescription.commute_home_to_work.value, xcoord=home_ll_x, ycoord=home_ll_y, xcoord2=work_ll_x, ycoord2=work_ll_y),
+        dict(work, duration=8 * 60),
+        dict(route, description=ActivityDescription.commute_work_to_home.value, xcoord=work_ll_x, ycoord=work_ll_y, xcoord2=home_ll_x, ycoord2=home_ll_y),
+        dict(home, duration=None),
+    ]
+
+    res = ScheduleBatch.from_slots(agent_ids, t_start, t_end, t_delta, slots)
+
+    for name in ScheduleBatch.columns:
+        np.testing.assert_array_equal(getattr(res, name), getattr(expected, name), err_msg=name)
+
+
+def test_time_axis_covers():
+    axis = TimeAxis.regular(t_start - datetime.timedelta(hours=2), t_end)
+
+    assert axis.covers(t_start, t_end)
+    assert not axis.covers(t_start, t_end + t_delta)
+    assert not axis.covers(t_start - datetime.timedelta(days=1), t_end)
+
+    # the schedule day of main, the first whole day of the axis
+    day = axis.timesteps[0].ceil("D").to_pydatetime()
+    assert day == t_start and axis.covers(day, day + datetime.timedelta(days=1))
+
+
+def test_integer_times_split_rows(monkeypatch):
+    def split_rows(integer_times):
+        monkeypatch.setattr(config, "integer_times", integer_times)
+
+        schedules = Schedules("test", t_start, t_end, t_delta, ["no2"], TimeAxis.regular(t_start, t_end))
+        schedules.add_batch(home_work_home(list(range(1, 40)), np.random.default_rng(7)))
+        schedules._split()
+
+        connection = schedules.db_con
+        times = ScheduleTimes.read(connection)
+        rows = connection.execute("SELECT agent_id,time_start,time_end,activity_group,activity_index FROM process ORDER BY activity_id").fetchall()
+
+        agent_ids, starts, ends, groups, indices = zip(*rows)
+        starts = times.decode(list(starts)) // TICKS_PER_MINUTE
+        ends = times.decode(list(ends)) // TICKS_PER_MINUTE
+
+        # pieces of less than a minute past a timestep boundary are left out of the minutes
+        return [row for row in zip(agent_ids, starts.tolist(), ends.tolist(), groups, indices) if row[1] < row[2]]
+
+    # times with seconds, boundaries are truncated to whole minutes in both encodings
+    assert split_rows(True) == split_rows(False)
@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+
+from osgeo import gdal, ogr
+
+from python.actgen.config import CommuteType
+from python.footprint import supercover
+from python.routing_backend import StubBackend
+from python.spatial_context import SpatialContext
+
+
+def all_touched(line, nr_rows, nr_cols):
+    """ Returns cells burned by GDAL with ALL_TOUCHED of a polyline in pixel coordinates """
+    raster = gdal.GetDriverByName("MEM").Create("", nr_cols, nr_rows, 1, gdal.GDT_Byte)
+    raster.SetGeoTransform((0, 1, 0, 0, 0, -1))
+
+    source = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = source.CreateLayer("route", geom_type=ogr.wkbLineString)
+
+    geometry = ogr.Geometry(ogr.wkbLineString)
+    for x, y in line:
+        geometry.AddPoint_2D(float(x), -float(y))
+
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+
+    gdal.RasterizeLayer(raster, [1], layer, burn_values=[1], options=["ALL_TOUCHED=TRUE"])
+    rows, cols = np.nonzero(raster.ReadAsArray())
+
+    return set(zip(rows.tolist(), cols.tolist()))
+
+
+def supercover_cells(line, nr_rows, nr_cols):
+    """ Returns cells of supercover within the raster """
+    line = np.asarray(line, dtype=np.float64)
+    rows, cols = supercover(line[:, 0], line[:, 1])
+    inside = (rows >= 0) & (rows < nr_rows) & (cols >= 0) & (cols < nr_cols)
+
+    return set(zip(rows[inside].tolist(), cols[inside].tolist()))
+
+
+lines = {
+    "diagonal": [(0.5, 0.5), (9.3, 7.8)],
+    "diagonal reversed": [(9.3, 7.8), (0.5, 0.5)],
+    "steep": [(3.2, 0.1), (4.9, 11.7)],
+    "rising": [(0.2, 11.3), (11.6, 0.4)],
+    "horizontal": [(1.2, 3.5), (8.7, 3.5)],
+    "vertical": [(4.5, 1.1), (4.5, 10.2)],
+    "horizontal on cell boundary": [(2, 5), (9, 5)],
+    "vertical on cell boundary": [(6, 1), (6, 9)],
+    "vertices on corners": [(1, 1), (4, 4), (7, 2)],
+    "through corners": [(2, 8), (5, 5), (8, 8), (10, 6)],
+    "vertex on corner": [(0.3, 0.7), (4, 4), (7.6, 2.2)],
+    "out of extent": [(-3.2, 2.5), (15.4, 9.1)],
+    "vertical out of extent": [(5.5, -2), (5.5, 14)],
+    "diagonal out of extent": [(-2, -2), (14, 14)],
+    "ending on the edge": [(3.3, 4.4), (12, 12)],
+}
+
+
+@pytest.mark.parametrize("name", lines)
+def test_supercover_all_touched(name):
+    assert supercover_cells(lines[name], 12, 12) == all_touched(lines[name], 12, 12)
+
+
+def test_supercover_random_polylines():
+    rng = np.random.default_rng(4)
+
+    for _ in range(200):
+        line = rng.uniform(-1, 13, (rng.integers(2, 8), 2))
+        assert supercover_cells(line, 12, 12) == all_touched(line, 12, 12), line.tolist()
+
+
+# 100 m cells around Utrecht in EPSG:28992
+extent = (120000.0, 465000.0, 140000.0, 445000.0, 100.0, 100.0, 200, 200)
+
+
+def rasterize_route(context, points):
+    """ Returns footprint of the cells burned by GDAL with ALL_TOUCHED of a WGS84 route, in a raster snapped to the base grid """
+    geometry = ogr.Geometry(ogr.wkbLineString)
+    for x, y, *_ in context.transformation.TransformPoints(np.asarray(points, dtype=np.float64)[:, 0:2]):
+        geometry.AddPoint_2D(x, y)
+
+    source = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = source.CreateLayer("route", context.proj, geom_type=ogr.wkbLineString)
+
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+
+    min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+    env_min_x, env_max_x, env_min_y, env_max_y, nr_rows, nr_cols = context._snap(min_x, max_x, min_y, max_y)
+
+    raster = gdal.GetDriverByName("MEM").Create("", nr_cols, nr_rows, 1, gdal.GDT_Byte)
+    raster.SetGeoTransform((env_min_x, context.cellsize, 0, env_max_y, 0, -context.cellsize))
+    raster.SetProjection(context.proj.ExportToWkt())
+
+    gdal.RasterizeLayer(raster, [1], layer, burn_values=[1], options=["ALL_TOUCHED=TRUE"])
+
+    return context._dataset_footprint(raster)
+
+
+def test_route_footprint():
+    context = SpatialContext(StubBackend(), extent, 28992)
+    rng = np.random.default_rng(5)
+
+    for _ in range(20):
+        x1, x2 = rng.uniform(5.05, 5.15, 2)
+        y1, y2 = rng.uniform(52.04, 52.12, 2)
+        points = StubBackend().routes([(x1, y1, x2, y2, CommuteType.car.value)])[0]
+
+        footprint = context._route_footprint(points)
+        expected = rasterize_route(context, points)
+
+        np.testing.assert_array_equal(footprint.indices, np.sort(expected.indices))
+
+
+def test_route_outside_grid():
+    context = SpatialContext(StubBackend(), extent, 28992)
+
+    # beyond the eastern edge of the grid
+    points = StubBackend().routes([(5.1, 52.08, 5.5, 52.08, CommuteType.car.value)])[0]
+
+    with pytest.raises(AssertionError):
+        context._route_footprint(points)
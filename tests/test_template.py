@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from python.actgen.act import Buffer_Final, Buffer_Fixed
+from python.actgen.batch import ScheduleBatch
+from python.actgen.config import ActivityDescription
+from python.actgen.template import compile_template
+from python.actgen.timer import Schedule
+
+import config
+
+from test_schedules import t_start, t_end, t_delta
+
+
+def baseline_homemaker(agents, rng, arg):
+    """ Returns ScheduleBatch of the former HomemakerBufferWorkday.construct and HomemakerBufferWeekend.construct """
+    schedules = []
+
+    for agent_id, xcoord, ycoord in zip(agents["agent_id"], agents["home_x"], agents["home_y"]):
+        schedule = Schedule(t_start, t_end, t_delta, agent_id)
+
+        # 0-8
+        # two hours between 8-23
+        end_min = 8 * 60
+        end_max = 21 * 60
+        x = np.arange(end_min, end_max)
+        act_end = rng.choice(x, size=1)[0] * t_delta
+
+        home1 = Buffer_Fixed(ActivityDescription.home, xcoord, ycoord, act_end, 50)
+
+        delta = 120 * t_delta
+        leisure = Buffer_Fixed(ActivityDescription.leisure, xcoord, ycoord, delta, arg)
+
+        home2 = Buffer_Final(ActivityDescription.home, xcoord, ycoord, act_end, 50)
+
+        schedule.add_activity(home1)
+        schedule.add_activity(leisure)
+        schedule.add_activity(home2)
+        schedule.generate()
+        schedules.append(schedule)
+
+    return ScheduleBatch.from_schedules(schedules)
+
+
+@pytest.mark.parametrize("template", ["homemaker_buffer_workday", "homemaker_buffer_weekend"])
+def test_homemaker_equals_baseline(template):
+    rng = np.random.default_rng(12)
+
+    agents = {"agent_id": np.array([5, 9, 2, 14, 7, 11]), "home_x": rng.uniform(120000, 140000, 6), "home_y": rng.uniform(445000, 465000, 6)}
+
+    expected = baseline_homemaker(agents, np.random.default_rng(3), 400)
+    res = compile_template(config.templates[template]["activities"], agents, t_start, t_end, t_delta, np.random.default_rng(3), 400)
+
+    for name in ScheduleBatch.columns:
+        np.testing.assert_array_equal(getattr(res, name), getattr(expected, name), err_msg=name)
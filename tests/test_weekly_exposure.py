@@ -0,0 +1,215 @@
+import math
+import sqlite3
+
+import numpy as np
+import pytest
+
+import python.weekly_exposure
+from python.weekly_exposure import Weekly, read_exp_day, weekly_exposures
+
+
+agent_ids = [4, 11, 2, 7, 9, 5]
+
+
+def write_day(path, rng, nulls=()):
+    """ Writes a realisation database with file1 agents and exp_day values, NULL for the (agent, column) in nulls """
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE file1 (activity_id INTEGER PRIMARY KEY, agent_id INTEGER NOT NULL)")
+    connection.execute("CREATE TABLE exp_day (agent_id INTEGER PRIMARY KEY, no2 REAL, pm25 REAL, noise REAL)")
+
+    rows = []
+    for agent_id in agent_ids:
+        row = [agent_id, rng.uniform(10, 40), rng.uniform(5, 20), 10 ** (rng.uniform(40, 70) / 10)]
+        for agent, column in nulls:
+            if agent == agent_id:
+                row[column] = None
+        rows.append(row)
+
+    connection.executemany("INSERT INTO file1(agent_id) VALUES (?)", [(agent_id,) for agent_id in agent_ids for _ in range(3)])
+    connection.executemany("INSERT INTO exp_day VALUES (?, ?, ?, ?)", rows[::-1])
+    connection.commit()
+    connection.close()
+
+
+def write_profiles(directory, realisations, rng):
+    """ Writes the realisations of a workday profile and a single weekend realisation """
+    for idx in range(1, realisations + 1):
+        write_day(directory / f"workday_{idx}.sqlite3", rng, [(7, 1)] if idx == 2 else [])
+    write_day(directory / "weekend_1.sqlite3", rng, [(9, 3)])
+
+
+combine = [(5, "workday", True), (2, "weekend", False)]
+
+
+def baseline_weekly(directory, realisations, combine):
+    """ Returns the rows per pollutant as combined by the former per agent loop """
+    values = {pollutant: {agent_id: [] for agent_id in agent_ids} for pollutant in ("no2", "pm25", "noise")}
+
+    for idx in range(1, realisations + 1):
+        databases = []
+        for item in combine:
+            fname = directory / (f"{item[1]}_{idx:d}.sqlite3" if item[2] else f"{item[1]}_1.sqlite3")
+            databases.append(sqlite3.connect(fname))
+
+        for agent_id in agent_ids:
+            combined = [0, 0, 0]
+            sum_factor = 0
+
+            for item, database in zip(combine, databases):
+                row = database.execute("SELECT * FROM exp_day WHERE agent_id=?", (agent_id,)).fetchone()
+                for column in range(3):
+                    if combined[column] is not None and row[column + 1] is not None:
+                        combined[column] += item[0] * row[column + 1]
+                    else:
+                        combined[column] = None
+                sum_factor += item[0]
+
+            combined = [None if value is None else value / sum_factor for value in combined]
+            if combined[2] is not None:
+                combined[2] = 10 * math.log10(combined[2])
+
+            for column, pollutant in enumerate(("no2", "pm25", "noise")):
+                values[pollutant][agent_id].append(np.nan if combined[column] is None else combined[column])
+
+        for database in databases:
+            database.close()
+
+    res = {}
+    for pollutant, agents in values.items():
+        res[pollutant] = []
+        for agent_id in sorted(agents):
+            row = np.array(agents[agent_id])
+            res[pollutant].append((agent_id, *row, np.mean(row), np.std(row), np.var(row), np.min(row), np.max(row)))
+
+    return res
+
+
+def read_output(path, pollutant):
+    """ Returns the rows of a table, realisation columns in order and before the statistics, NULL as NaN """
+    connection = sqlite3.connect(path)
+
+    # realisations of resumed outputs are added after the statistics
+    columns = [row[1] for row in connection.execute(f"PRAGMA table_info({pollutant})")]
+    realisations = sorted((column for column in columns if column.startswith("R")), key=lambda column: int(column[1:]))
+    columns = ["agent_id"] + realisations + [column for column in columns if column not in realisations and column != "agent_id"]
+
+    rows = connection.execute(f"SELECT {','.join(columns)} FROM {pollutant} ORDER BY agent_id").fetchall()
+    connection.close()
+
+    return [tuple(np.nan if value is None else value for value in row) for row in rows]
+
+
+def test_weekly_equals_baseline(tmp_path):
+    write_profiles(tmp_path, 4, np.random.default_rng(8))
+
+    Weekly(tmp_path, "weekly", 4, combine, tmp_path)
+    expected = baseline_weekly(tmp_path, 4, combine)
+
+    for pollutant in Weekly.pollutants:
+        res = read_output(tmp_path / "weekly.sqlite3", pollutant)
+
+        np.testing.assert_allclose(np.array(res), np.array(expected[pollutant]))
+
+    # the index names of the former outputs
+    connection = sqlite3.connect(tmp_path / "weekly.sqlite3")
+    indices = dict(connection.execute("SELECT tbl_name,name FROM sqlite_master WHERE type='index'").fetchall())
+    connection.close()
+    assert [indices[pollutant] for pollutant in Weekly.pollutants] == ["no2_agent_ixd", "pm25_agent_ixd", "no2_agent_ixd2"]
+
+    # NULL in a single realisation makes the statistics of the agent NULL
+    assert np.isnan(read_output(tmp_path / "weekly.sqlite3", "no2")[3][1:]).sum() == 6
+
+
+def test_weekly_noise_zero(tmp_path):
+    write_profiles(tmp_path, 1, np.random.default_rng(9))
+
+    connection = sqlite3.connect(tmp_path / "workday_1.sqlite3")
+    connection.execute("UPDATE exp_day SET noise=0 WHERE agent_id=2")
+    connection.commit()
+    connection.close()
+
+    connection = sqlite3.connect(tmp_path / "weekend_1.sqlite3")
+    connection.execute("UPDATE exp_day SET noise=0 WHERE agent_id=2")
+    connection.commit()
+    connection.close()
+
+    with pytest.raises(AssertionError):
+        Weekly(tmp_path, "weekly", 1, combine, tmp_path)
+
+
+def test_weekly_incremental(tmp_path):
+    write_profiles(tmp_path, 5, np.random.default_rng(10))
+
+    for realisations in (2, 2, 3, 5):
+        Weekly(tmp_path, "incremental", realisations, combine, tmp_path)
+
+        if realisations == 2:
+            # resuming adds the new realisation columns, the stored ones are not rewritten
+            connection = sqlite3.connect(tmp_path / "incremental.sqlite3")
+            connection.execute("UPDATE no2 SET R1=-1 WHERE agent_id=2")
+            connection.commit()
+            connection.close()
+    Weekly(tmp_path, "full", 5, combine, tmp_path)
+
+    assert read_output(tmp_path / "incremental.sqlite3", "no2")[0][1] == -1
+
+    connection = sqlite3.connect(tmp_path / "incremental.sqlite3")
+    connection.execute("UPDATE no2 SET R1=? WHERE agent_id=2", (read_output(tmp_path / "full.sqlite3", "no2")[0][1],))
+    connection.commit()
+    connection.close()
+
+    for table in (*Weekly.pollutants, *[f"{pollutant}_acc" for pollutant in Weekly.pollutants]):
+        res = read_output(tmp_path / "incremental.sqlite3", table)
+        expected = read_output(tmp_path / "full.sqlite3", table)
+
+        np.testing.assert_allclose(np.array(res), np.array(expected))
+
+
+def test_weekly_other_combination(tmp_path):
+    write_profiles(tmp_path, 3, np.random.default_rng(11))
+
+    Weekly(tmp_path, "weekly", 2, combine, tmp_path)
+
+    with pytest.raises(AssertionError):
+        Weekly(tmp_path, "weekly", 3, [(5, "workday", True), (1, "weekend", False)], tmp_path)
+
+    with pytest.raises(AssertionError):
+        Weekly(tmp_path, "weekly", 3, [(5, "workday", True)], tmp_path)
+
+    # the factors are compared as numbers
+    Weekly(tmp_path, "weekly", 3, [(5.0, "workday", True), (2.0, "weekend", False)], tmp_path)
+    assert len(read_output(tmp_path / "weekly.sqlite3", "no2")[0]) == 1 + 3 + 5
+
+
+def test_weekly_exposures_equal_separate(tmp_path, monkeypatch):
+    rng = np.random.default_rng(12)
+    write_profiles(tmp_path, 3, rng)
+    for idx in range(1, 4):
+        write_day(tmp_path / f"commute_{idx}.sqlite3", rng, [(11, 2)] if idx == 3 else [])
+
+    # both outputs combine the weekend profile, as weekly_homemaker and weekly_commuter do
+    targets = [("homemaker", combine), ("commuter", [(5, "commute", True), (2, "weekend", False)])]
+
+    # databases read from disk
+    reads = []
+
+    def read(fname, agent_ids=None, cache=None):
+        if cache is None or fname not in cache:
+            reads.append(fname.name)
+        return read_exp_day(fname, agent_ids, cache)
+
+    monkeypatch.setattr(python.weekly_exposure, "read_exp_day", read)
+    weekly_exposures(tmp_path, targets, 3, tmp_path)
+    monkeypatch.undo()
+
+    assert sorted(reads) == sorted({*reads}) and len(reads) == 7
+
+    for filename, target in targets:
+        Weekly(tmp_path, f"{filename}_separate", 3, target, tmp_path)
+
+    for filename, target in targets:
+        for table in (*Weekly.pollutants, *[f"{pollutant}_acc" for pollutant in Weekly.pollutants]):
+            res = read_output(tmp_path / f"{filename}.sqlite3", table)
+            expected = read_output(tmp_path / f"{filename}_separate.sqlite3", table)
+
+            np.testing.assert_array_equal(np.array(res), np.array(expected))
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from python.ws_od_matrix import ODMatrixSelect, read_od_csv
+
+
+def write_csv(path, rng):
+    """ Writes an OD matrix of 40 origins, with empty cells, zero weights and an origin of zero total weight """
+    origins = rng.permutation(np.arange(100, 140))
+    columns = np.arange(100, 140)
+
+    weights = rng.uniform(0, 50, (len(origins), len(columns)))
+    weights[rng.random(weights.shape) < 0.3] = np.nan
+    weights[rng.random(weights.shape) < 0.1] = 0
+    weights[origins == 117] = 0
+
+    pd.DataFrame(weights, index=origins, columns=[f"{column}.0" for column in columns]).to_csv(path)
+
+
+def baseline_obtain(filename, origins, rng):
+    """ Returns destinations drawn by the former per origin rows and rng.choice """
+    transition = pd.read_csv(filename, delimiter=',', index_col=0)
+
+    weights = {}
+    for idx, row in transition.iterrows():
+        row = row.dropna()
+        weights[idx] = row.divide(row.sum())
+
+    res = []
+    for origin in origins:
+        if origin not in weights:
+            res.append(-1)
+        else:
+            row = weights[origin]
+            res.append(int(float(row.index[rng.choice(len(row.values), 1, p=row.values)[0]])))
+
+    return res
+
+
+def test_obtain_many_equals_baseline(tmp_path):
+    rng = np.random.default_rng(17)
+    write_csv(tmp_path / "od.csv", rng)
+
+    # origins of zero total weight made rng.choice fail, they have no destinations now
+    origins = rng.choice(np.append(np.arange(95, 145), 117), 500)
+    expected = baseline_obtain(tmp_path / "od.csv", origins[origins != 117], np.random.default_rng(3))
+
+    od_matrix = ODMatrixSelect(np.random.default_rng(3))
+    od_matrix.init(tmp_path / "od.csv")
+    res = od_matrix.obtain_many(origins)
+
+    np.testing.assert_array_equal(res[origins != 117], expected)
+    assert (res[origins == 117] == -1).all()
+
+    # the same rows from the cache
+    cached = ODMatrixSelect(np.random.default_rng(3))
+    cached.init(tmp_path / "od.csv")
+    np.testing.assert_array_equal(cached.obtain_many(origins), res)
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["od.csv", "od.csv.npz"]
+
+
+def test_cache_stamp(tmp_path):
+    write_csv(tmp_path / "od.csv", np.random.default_rng(18))
+    mtime = (tmp_path / "od.csv").stat().st_mtime_ns
+
+    od_matrix = ODMatrixSelect(np.random.default_rng(3))
+    od_matrix.init(tmp_path / "od.csv")
+
+    # another CSV, the cache is not used
+    write_csv(tmp_path / "od.csv", np.random.default_rng(19))
+    os.utime(tmp_path / "od.csv", ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+    od_matrix.init(tmp_path / "od.csv")
+
+    origins, indptr, destinations, cdf = read_od_csv(tmp_path / "od.csv")
+
+    np.testing.assert_array_equal(od_matrix._indptr, indptr)
+    np.testing.assert_array_equal(od_matrix._destinations, destinations)
+    np.testing.assert_array_equal(od_matrix._cdf, cdf)
@@ -0,0 +1,77 @@
+import sqlite3
+
+import numpy as np
+
+from python.ws_work_locations import WorkLocations, distance
+
+
+def work_locations(rng):
+    """ Returns WorkLocations of random locations in postcodes 10, 20 and 30, not inserted in postcode order """
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE work (postcode2 INTEGER, rd_x REAL, rd_y REAL, wgs_x REAL, wgs_y REAL)")
+
+    postcodes = rng.choice([30, 10, 20], 300)
+    x, y = rng.uniform(0, 10000, (2, len(postcodes)))
+    connection.executemany("INSERT INTO work VALUES (?, ?, ?, ?, ?)", zip(postcodes.tolist(), x.tolist(), y.tolist(), (x / 1e5).tolist(), (y / 1e5).tolist()))
+
+    rows = connection.execute("SELECT postcode2,rd_x,rd_y FROM work").fetchall()
+
+    return WorkLocations(connection), rows
+
+
+def test_in_band():
+    rng = np.random.default_rng(13)
+    locations, rows = work_locations(rng)
+
+    area_ids = rng.choice([10, 20, 30, 40], 50)
+    x, y = rng.uniform(0, 10000, (2, len(area_ids)))
+
+    expected = []
+    for area_id, point_x, point_y in zip(area_ids, x, y):
+        dist = [distance(point_x, point_y, row[1], row[2]) for row in rows if row[0] == area_id]
+        expected.append(sum(3000 < value < 6000 for value in dist))
+
+    np.testing.assert_array_equal(locations.in_band(area_ids, x, y, 3000, 6000), expected)
+
+    # the unknown postcode 40 has no locations
+    assert (locations.in_band(area_ids, x, y, 3000, 6000)[area_ids == 40] == 0).all()
+
+    # pairs calculated in several blocks
+    locations.gather_pairs = 150
+    np.testing.assert_array_equal(locations.in_band(area_ids, x, y, 3000, 6000), expected)
+
+
+def baseline_draw(connection, area_id, rng):
+    """ Returns location drawn by the former per postcode query of CommuteWorkday.pot_work_location """
+    query = f"SELECT idx,postcode,rd_x,rd_y,wgs_x,wgs_y FROM work WHERE postcode2={area_id}"
+    sql = connection.execute(query)
+    res = sql.fetchall()
+    nr_pot_work_locations = len(res)
+
+    pot_work_idx = rng.choice(nr_pot_work_locations, 1)[0]
+    row = res[pot_work_idx]
+
+    return round(row["rd_x"], 6), round(row["rd_y"], 6), round(row["wgs_x"], 6), round(row["wgs_y"], 6)
+
+
+def test_draw_many_equals_baseline():
+    rng = np.random.default_rng(14)
+
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    connection.execute("CREATE TABLE work (idx INTEGER, postcode TEXT, postcode2 INTEGER, rd_x REAL, rd_y REAL, wgs_x REAL, wgs_y REAL)")
+
+    # postcodes of very different sizes, not inserted in postcode order
+    postcodes = rng.choice([35, 12, 20, 8], 400, p=[0.6, 0.3, 0.09, 0.01])
+    x, y = rng.uniform(120000, 140000, (2, len(postcodes)))
+    connection.executemany("INSERT INTO work VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           zip(range(len(postcodes)), map(str, postcodes.tolist()), postcodes.tolist(), x.tolist(), y.tolist(), (x / 1e5).tolist(), (y / 1e5).tolist()))
+
+    area_ids = rng.choice(np.unique(postcodes), 300)
+
+    draw_rng = np.random.default_rng(5)
+    expected = np.array([baseline_draw(connection, area_id, draw_rng) for area_id in area_ids.tolist()]).T
+
+    res = WorkLocations(connection).draw_many(area_ids, np.random.default_rng(5))
+
+    np.testing.assert_array_equal(np.array(res), expected)